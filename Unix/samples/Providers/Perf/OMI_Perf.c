@@ -9,14 +9,52 @@
 
 /* @migen@ */
 #include <MI.h>
+#include <stdlib.h>
 #include "OMI_Perf.h"
 
+/* Number of instances enumerated and of string properties set on each one, read from the OMI_PERF_INSTANCES and
+   OMI_PERF_WIDTH environment variables of omiserver when the provider is loaded */
+static MI_Uint32 s_instances = 1000000;
+static MI_Uint32 s_width = 20;
+
+static MI_Uint32 ReadSetting(const char* name, MI_Uint32 defaultValue, MI_Uint32 maxValue)
+{
+    const char* value = getenv(name);
+    char* end;
+    unsigned long result;
+
+    if (!value || !*value)
+        return defaultValue;
+
+    result = strtoul(value, &end, 10);
+    if (*end)
+        return defaultValue;
+
+    return result > maxValue ? maxValue : (MI_Uint32)result;
+}
+
+/* Construct an instance with the first s_width string properties set, the key is set by the caller */
+static MI_Result MakeInstance(OMI_Perf* inst, MI_Context* context)
+{
+    MI_Uint32 i;
+    MI_Result r = OMI_Perf_Construct(inst, context);
+
+    for (i = 1; r == MI_RESULT_OK && i <= s_width; i++)
+    {
+        const MI_Char* str = MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ");
+        r = MI_Instance_SetElementAt(&inst->__instance, i, (MI_Value*)&str, MI_STRING, 0);
+    }
+    return r;
+}
+
 void MI_CALL OMI_Perf_Load(
     OMI_Perf_Self** self,
     MI_Module_Self* selfModule,
     MI_Context* context)
 {
     *self = NULL;
+    s_instances = ReadSetting("OMI_PERF_INSTANCES", 1000000, 0xFFFFFFFF);
+    s_width = ReadSetting("OMI_PERF_WIDTH", 20, 20);
     MI_PostResult(context, MI_RESULT_OK);
 }
 
@@ -38,37 +76,24 @@ void MI_CALL OMI_Perf_EnumerateInstances(
 {
     OMI_Perf inst;
     MI_Uint32 i;
+    MI_Result r = MakeInstance(&inst, context);
 
-    OMI_Perf_Construct(&inst, context);
-
-    OMI_Perf_Set_Prop01(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop02(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop03(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop04(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop05(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop06(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop07(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop08(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop09(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop10(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop11(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop12(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop13(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop14(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop15(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop16(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop17(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop18(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop19(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-    OMI_Perf_Set_Prop20(&inst, MI_T("ABCDEFGHIJKLMNOPQRSTUVWXYZ"));
-
-    for (i = 0; i < 1000000; i++)
+    for (i = 0; r == MI_RESULT_OK && i < s_instances; i++)
     {
+        MI_Boolean match = MI_TRUE;
+
         OMI_Perf_Set_Key(&inst, i);
-        OMI_Perf_Post(&inst, context);
+
+        /* The module declares filter support, so queries are evaluated here */
+        if (filter && MI_Filter_Evaluate(filter, &inst.__instance, &match) != MI_RESULT_OK)
+            match = MI_FALSE;
+
+        if (match)
+            r = OMI_Perf_Post(&inst, context);
     }
 
-    MI_PostResult(context, MI_RESULT_OK);
+    OMI_Perf_Destruct(&inst);
+    MI_PostResult(context, r);
 }
 
 void MI_CALL OMI_Perf_GetInstance(
@@ -79,7 +104,24 @@ void MI_CALL OMI_Perf_GetInstance(
     const OMI_Perf* instanceName,
     const MI_PropertySet* propertySet)
 {
-    MI_PostResult(context, MI_RESULT_NOT_SUPPORTED);
+    OMI_Perf inst;
+    MI_Result r;
+
+    if (!instanceName->Key.exists || instanceName->Key.value >= s_instances)
+    {
+        MI_PostResult(context, MI_RESULT_NOT_FOUND);
+        return;
+    }
+
+    r = MakeInstance(&inst, context);
+    if (r == MI_RESULT_OK)
+    {
+        OMI_Perf_Set_Key(&inst, instanceName->Key.value);
+        r = OMI_Perf_Post(&inst, context);
+    }
+
+    OMI_Perf_Destruct(&inst);
+    MI_PostResult(context, r);
 }
 
 void MI_CALL OMI_Perf_CreateInstance(
@@ -113,3 +155,25 @@ void MI_CALL OMI_Perf_DeleteInstance(
     MI_PostResult(context, MI_RESULT_NOT_SUPPORTED);
 }
 
+
+void MI_CALL OMI_Perf_Invoke_Ping(
+    OMI_Perf_Self* self,
+    MI_Context* context,
+    const MI_Char* nameSpace,
+    const MI_Char* className,
+    const MI_Char* methodName,
+    const OMI_Perf* instanceName,
+    const OMI_Perf_Ping* in)
+{
+    OMI_Perf_Ping out;
+    MI_Result r = OMI_Perf_Ping_Construct(&out, context);
+
+    if (r == MI_RESULT_OK)
+    {
+        OMI_Perf_Ping_Set_MIReturn(&out, 0);
+        r = OMI_Perf_Ping_Post(&out, context);
+        OMI_Perf_Ping_Destruct(&out);
+    }
+
+    MI_PostResult(context, r);
+}
@@ -794,6 +794,74 @@ MI_INLINE MI_Result MI_CALL OMI_Perf_Clear_Prop20(
         20);
 }
 
+/*
+**==============================================================================
+**
+** OMI_Perf.Ping()
+**
+**==============================================================================
+*/
+
+typedef struct _OMI_Perf_Ping
+{
+    MI_Instance __instance;
+    /*OUT*/ MI_ConstUint32Field MIReturn;
+}
+OMI_Perf_Ping;
+
+MI_EXTERN_C MI_CONST MI_MethodDecl OMI_Perf_Ping_rtti;
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Construct(
+    OMI_Perf_Ping* self,
+    MI_Context* context)
+{
+    return MI_ConstructParameters(context, &OMI_Perf_Ping_rtti,
+        (MI_Instance*)&self->__instance);
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Clone(
+    const OMI_Perf_Ping* self,
+    OMI_Perf_Ping** newInstance)
+{
+    return MI_Instance_Clone(
+        &self->__instance, (MI_Instance**)newInstance);
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Destruct(
+    OMI_Perf_Ping* self)
+{
+    return MI_Instance_Destruct(&self->__instance);
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Delete(
+    OMI_Perf_Ping* self)
+{
+    return MI_Instance_Delete(&self->__instance);
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Post(
+    const OMI_Perf_Ping* self,
+    MI_Context* context)
+{
+    return MI_PostInstance(context, &self->__instance);
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Set_MIReturn(
+    OMI_Perf_Ping* self,
+    MI_Uint32 x)
+{
+    ((MI_Uint32Field*)&self->MIReturn)->value = x;
+    ((MI_Uint32Field*)&self->MIReturn)->exists = 1;
+    return MI_RESULT_OK;
+}
+
+MI_INLINE MI_Result MI_CALL OMI_Perf_Ping_Clear_MIReturn(
+    OMI_Perf_Ping* self)
+{
+    memset((void*)&self->MIReturn, 0, sizeof(self->MIReturn));
+    return MI_RESULT_OK;
+}
+
 /*
 **==============================================================================
 **
@@ -853,5 +921,14 @@ MI_EXTERN_C void MI_CALL OMI_Perf_DeleteInstance(
     const MI_Char* className,
     const OMI_Perf* instanceName);
 
+MI_EXTERN_C void MI_CALL OMI_Perf_Invoke_Ping(
+    OMI_Perf_Self* self,
+    MI_Context* context,
+    const MI_Char* nameSpace,
+    const MI_Char* className,
+    const MI_Char* methodName,
+    const OMI_Perf* instanceName,
+    const OMI_Perf_Ping* in);
+
 
 #endif /* _OMI_Perf_h */
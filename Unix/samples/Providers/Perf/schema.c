@@ -418,6 +418,48 @@ static MI_PropertyDecl MI_CONST* MI_CONST OMI_Perf_props[] =
     &OMI_Perf_Prop20_prop,
 };
 
+/* parameter OMI_Perf.Ping(): MIReturn */
+static MI_CONST MI_ParameterDecl OMI_Perf_Ping_MIReturn_param =
+{
+    MI_FLAG_PARAMETER|MI_FLAG_OUT, /* flags */
+    0x006D6E08, /* code */
+    MI_T("MIReturn"), /* name */
+    NULL, /* qualifiers */
+    0, /* numQualifiers */
+    MI_UINT32, /* type */
+    NULL, /* className */
+    0, /* subscript */
+    offsetof(OMI_Perf_Ping, MIReturn), /* offset */
+};
+
+static MI_ParameterDecl MI_CONST* MI_CONST OMI_Perf_Ping_params[] =
+{
+    &OMI_Perf_Ping_MIReturn_param,
+};
+
+/* method OMI_Perf.Ping() */
+MI_CONST MI_MethodDecl OMI_Perf_Ping_rtti =
+{
+    MI_FLAG_METHOD|MI_FLAG_STATIC, /* flags */
+    0x00706704, /* code */
+    MI_T("Ping"), /* name */
+    NULL, /* qualifiers */
+    0, /* numQualifiers */
+    OMI_Perf_Ping_params, /* parameters */
+    MI_COUNT(OMI_Perf_Ping_params), /* numParameters */
+    sizeof(OMI_Perf_Ping), /* size */
+    MI_UINT32, /* returnType */
+    MI_T("OMI_Perf"), /* origin */
+    MI_T("OMI_Perf"), /* propagator */
+    &schemaDecl, /* schema */
+    (MI_ProviderFT_Invoke)OMI_Perf_Invoke_Ping, /* method */
+};
+
+static MI_MethodDecl MI_CONST* MI_CONST OMI_Perf_meths[] =
+{
+    &OMI_Perf_Ping_rtti,
+};
+
 static MI_CONST MI_ProviderFT OMI_Perf_funcs =
 {
   (MI_ProviderFT_Load)OMI_Perf_Load,
@@ -449,8 +491,8 @@ MI_CONST MI_ClassDecl OMI_Perf_rtti =
     sizeof(OMI_Perf), /* size */
     NULL, /* superClass */
     NULL, /* superClassDecl */
-    NULL, /* methods */
-    0, /* numMethods */
+    OMI_Perf_meths, /* methods */
+    MI_COUNT(OMI_Perf_meths), /* numMethods */
     &schemaDecl, /* schema */
     &OMI_Perf_funcs, /* functions */
     NULL, /* owningClass */
@@ -31,8 +31,8 @@ print ("Result:")
 
 if options.Keys == None:
 #if not specified key properties, do an enumerate-instances operation
-	enum = session.enumerate_instances(options.Namespace,options.Classname)
-	for inst in enum:
+	#stream the instances so they are printed as soon as each pull batch arrives
+	for inst in session.iter_instances(options.Namespace,options.Classname):
 		mi.print_instance(inst)
 
 #otherwise, do a get-instance operation
@@ -7,7 +7,8 @@
 **==============================================================================
 */
 
-#include "/usr/include/python2.6/Python.h"
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
 #include "structmember.h"
 #include "MI.h"
 
@@ -24,7 +25,10 @@ typedef struct{
 /*Destructor of the PMI_Class Type Object*/
 static void PMI_Class_dealloc(PMI_Class *self)
 {
-	Py_XDECREF(self->miClass);
+	if(self->miClass)
+	{
+		MI_Class_Delete((MI_Class *)self->miClass);
+	}
 	Py_XDECREF(self->methods);
 	Py_XDECREF(self->propertyValues); 
 	Py_XDECREF(self->propertyTypes);
@@ -133,7 +137,7 @@ static PyObject *MakePropertyValueAndTypeDict(PMI_Class *pmiClass)
 		}
 
 		char *key = (char *)elementName;
-		PyObject *value = Get_Element_Value(&elementValue,elementType);
+		PyObject *value = Get_Element_Value(&elementValue,elementType,0);
 		if(PyDict_SetItemString(propertyValues,key,value))
 		{
 			PyErr_SetString(PyExc_Exception,"Property dictionary insert item failed");
@@ -279,19 +283,14 @@ static PyTypeObject PMI_ClassType = {
 };	    
 
 
-#define PyMODINIT_FUNC void
-#ifndef PyMODINIT_FUNC
-#endif
-PyMODINIT_FUNC
-initPMI_Class(void)
+/* Ready the class type and export it into the mi module, called once from initmi */
+static int AddClassTypes(PyObject *m)
 { 
-    PyObject *m;
     PMI_ClassType.tp_new = PyType_GenericNew;
     /*Make sure the new type object is initialized properly*/
     if (PyType_Ready(&PMI_ClassType) <0)
-	return;
+	return -1;
     /*New type objects are all exported into mi module*/
-    m = Py_InitModule3("mi",PMI_Class_methods, "MI_Class object");
     Py_INCREF(&PMI_ClassType);
-    PyModule_AddObject(m, "PMI_Class", (PyObject *)&PMI_ClassType);
+    return PyModule_AddObject(m, "PMI_Class", (PyObject *)&PMI_ClassType);
 }
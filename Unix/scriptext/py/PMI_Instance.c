@@ -7,7 +7,8 @@
 **==============================================================================
 */
 
-#include "/usr/include/python2.6/Python.h"
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
 #include "structmember.h"
 #include "MI.h"
 #include <stdlib.h>
@@ -15,6 +16,10 @@
 
 static PyObject *MIError;
 
+/* Decode flags, controls how the property values of an instance are converted to Python objects */
+#define PMI_DECODE_LAZY 0x1 /* only decode a property the first time it is accessed */
+#define PMI_DECODE_ARRAYBUFFERS 0x2 /* numeric arrays become bytearray/array.array objects instead of tuples */
+
 /*Defines a PMI_Instance Type Object which is a Python Object that contains a reference to an intance of MI_Instance */
 typedef struct{
     PyObject_HEAD
@@ -22,6 +27,8 @@ typedef struct{
     PyObject *propertyValues;
     PyObject *propertyTypes;
     PyObject *propertyFlags;
+    PyObject *propertyCache; /* properties decoded so far when PMI_DECODE_LAZY is set */
+    int decodeFlags;
 } PMI_Instance;
 
 
@@ -33,6 +40,7 @@ static void PMI_Instance_dealloc(PMI_Instance *self)
 	Py_CLEAR(self->propertyValues);
 	Py_CLEAR(self->propertyTypes);
 	Py_CLEAR(self->propertyFlags);
+	Py_CLEAR(self->propertyCache);
 	self->ob_type->tp_free((PyObject*) self); 
 
 }
@@ -46,6 +54,8 @@ static PyObject* PMI_Instance_new(PyTypeObject *type)
 		self-> propertyValues = NULL;
 		self-> propertyTypes = NULL;
 		self-> propertyFlags = NULL;
+		self-> propertyCache = NULL;
+		self-> decodeFlags = 0;
     }
     return (PyObject *)self;
 }
@@ -61,17 +71,121 @@ static PyObject* initPMI()
 
 static PyObject* MakePropertyDict(PMI_Instance *pmiInstance);
 
-static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type elementType)
+/* Wrap a copy of an embedded instance so it stays valid after the instance that contains it is deleted */
+static PyObject* WrapEmbeddedInstance(const MI_Instance *miInstance, int decodeFlags)
+{
+	MI_Instance *cloneInstance = NULL;
+	if(miInstance != NULL && MI_Instance_Clone(miInstance,&cloneInstance) != MI_RESULT_OK)
+	{
+		PyErr_SetString(MIError,"MI_Instance_Clone failed for embedded instance");
+		return NULL;
+	}
+
+	PMI_Instance *embedded = (PMI_Instance *)PyObject_CallObject((PyObject *)&PMI_InstanceType, NULL);
+	if(embedded == NULL)
+	{
+		if(cloneInstance != NULL)
+			MI_Instance_Delete(cloneInstance);
+		return NULL;
+	}
+	embedded->miInstance = cloneInstance;
+	embedded->decodeFlags = decodeFlags;
+	if(cloneInstance != NULL && !(decodeFlags & PMI_DECODE_LAZY))
+	{
+		if(MakePropertyDict(embedded) == NULL)
+		{
+			Py_DECREF(embedded);
+			return NULL;
+		}
+		Py_DECREF(Py_None);
+	}
+	return (PyObject *)embedded;
+}
+
+/* array module typecode and item size holding a non-array MI_Type, 0 if the values have to stay Python objects */
+static char ValueTypecode(MI_Type type, size_t *itemSize)
+{
+	switch(type)
+	{
+	case MI_BOOLEAN: *itemSize = 1; return 'B';
+	case MI_UINT8: *itemSize = 1; return 'B';
+	case MI_SINT8: *itemSize = 1; return 'b';
+	case MI_UINT16: *itemSize = 2; return 'H';
+	case MI_SINT16: *itemSize = 2; return 'h';
+	case MI_CHAR16: *itemSize = 2; return 'H';
+	case MI_UINT32: *itemSize = 4; return sizeof(unsigned int) == 4 ? 'I' : 0;
+	case MI_SINT32: *itemSize = 4; return sizeof(int) == 4 ? 'i' : 0;
+	/* The array module has no 64-bit typecode of its own, long is 64 bits on LP64 platforms */
+	case MI_UINT64: *itemSize = 8; return sizeof(unsigned long) == 8 ? 'L' : 0;
+	case MI_SINT64: *itemSize = 8; return sizeof(long) == 8 ? 'l' : 0;
+	case MI_REAL32: *itemSize = 4; return 'f';
+	case MI_REAL64: *itemSize = 8; return 'd';
+	default: *itemSize = 0; return 0;
+	}
+}
+
+/* Create an array.array of the typecode holding a copy of the packed values in data */
+static PyObject *NewTypedArray(char typecode, const void *data, size_t length)
+{
+	static PyObject *arrayModule = NULL;
+	PyObject *array;
+	if(arrayModule == NULL)
+	{
+		arrayModule = PyImport_ImportModule("array");
+		if(arrayModule == NULL)
+		{
+			return NULL;
+		}
+	}
+	array = PyObject_CallMethod(arrayModule,"array","c",typecode);
+	if(array != NULL && length > 0)
+	{
+		PyObject *ignored = PyObject_CallMethod(array,"fromstring","s#",(const char *)data,(Py_ssize_t)length);
+		if(ignored == NULL)
+		{
+			Py_CLEAR(array);
+		}
+		Py_XDECREF(ignored);
+	}
+	return array;
+}
+
+/* Convert a numeric MI_*A array with one contiguous copy: a bytearray for MI_UINT8A, an array.array otherwise.
+   Returns NULL without an exception set if the type has no typed array */
+static PyObject *MakeArrayBuffer(const MI_Value *elementValue, MI_Type elementType)
+{
+	size_t itemSize;
+	char typecode = ValueTypecode((MI_Type)(elementType & (~MI_ARRAY)),&itemSize);
+	/* All the MI_*A structures start with the data pointer followed by the size */
+	const MI_Uint8A *array = &elementValue->uint8a;
+	if(!(elementType & MI_ARRAY) || typecode == 0)
+	{
+		return NULL;
+	}
+	if(elementType == MI_UINT8A)
+	{
+		return PyByteArray_FromStringAndSize((const char *)array->data,array->size);
+	}
+	return NewTypedArray(typecode,array->data,(size_t)array->size * itemSize);
+}
+
+static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type elementType, int decodeFlags)
 
 {
 	MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
+	if(decodeFlags & PMI_DECODE_ARRAYBUFFERS)
+	{
+		PyObject *buffer = MakeArrayBuffer(elementValue,elementType);
+		if(buffer != NULL || PyErr_Occurred())
+		{
+			return buffer;
+		}
+	}
     switch (elementType)
     {
         case MI_BOOLEAN:
         {
-			if(elementValue->boolean)
-	    		return Py_True;	
-			return Py_False;
+			return PyBool_FromLong(elementValue->boolean);
         }
 
         case MI_SINT8:
@@ -164,7 +278,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.boolean = elementValue->booleana.data[i];
-                PyObject* propertyValue= Get_Element_Value(&value, nonArrayType);
+                PyObject* propertyValue= Get_Element_Value(&value, nonArrayType, decodeFlags);
 	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;	
@@ -178,7 +292,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.sint8 = elementValue->sint8a.data[i];
-                PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+                PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
 	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -192,7 +306,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.uint8 = elementValue->uint8a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -206,7 +320,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.sint16 = elementValue->sint16a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -220,7 +334,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.uint16 = elementValue->uint16a.data[i];
-	  			PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	  			PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue); 
             }
 			return valueSets;
@@ -234,7 +348,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.sint32 = elementValue->sint32a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);  
             }
 			return valueSets;
@@ -248,7 +362,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.uint32 = elementValue->uint32a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
 	    		PyTuple_SetItem(valueSets,i,propertyValue);
 			}
 			return valueSets;
@@ -262,7 +376,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
 	            MI_Value value;
                 value.sint64 = elementValue->sint64a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -276,7 +390,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.uint64 = elementValue->uint64a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -290,7 +404,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
 	            MI_Value value;
                 value.real32 = elementValue->real32a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	   		 	PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -304,7 +418,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.real64 = elementValue->real64a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
 	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -318,7 +432,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.char16 = elementValue->char16a.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -332,7 +446,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
                 MI_Value value;
                 value.datetime = elementValue->datetimea.data[i];
-	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	    		PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	   			PyTuple_SetItem(valueSets,i,propertyValue); 
             }
 			return valueSets;
@@ -346,7 +460,7 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
             {
 	            MI_Value value;
                 value.string = elementValue->stringa.data[i];
-	   		 	PyObject* propertyValue = Get_Element_Value(&value, nonArrayType);
+	   		 	PyObject* propertyValue = Get_Element_Value(&value, nonArrayType, decodeFlags);
  	    		PyTuple_SetItem(valueSets,i,propertyValue);
             }
 			return valueSets;
@@ -354,26 +468,12 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
 
         case MI_INSTANCE:
         {
-			MI_Instance* inst = elementValue->instance;
-			PMI_Instance* embedded = (PMI_Instance*) initPMI();
-			embedded-> miInstance = inst;
-			if(inst!=NULL)
-			{			
-				MakePropertyDict(embedded);
-			}			
-			return (PyObject *)embedded;
+			return WrapEmbeddedInstance(elementValue->instance,decodeFlags);
         }
 
         case MI_REFERENCE:
         {
-			MI_Instance* inst = elementValue->reference;
-			PMI_Instance* embedded = (PMI_Instance*) initPMI();
-			embedded-> miInstance = inst;
-			if(inst!=NULL)
-			{
-				MakePropertyDict(embedded);
-			}
-			return (PyObject *)embedded;
+			return WrapEmbeddedInstance(elementValue->reference,decodeFlags);
         }
 
         case MI_INSTANCEA:
@@ -384,17 +484,21 @@ static PyObject* Get_Element_Value(const MI_Value *elementValue, MI_Type element
 		 	PyObject* valueSets = PyTuple_New(inst->size);
 			for (i = 0; i< inst->size; i++)
 			{
-		   		PMI_Instance* embedded = (PMI_Instance*) initPMI();
 				if(inst->data[i]!=NULL)
-				{	    		
-		   			embedded-> miInstance = inst->data[i];
-					MakePropertyDict(embedded);
-		   			PyTuple_SetItem(valueSets,i,(PyObject *)embedded);
+				{
+					PyObject *embedded = WrapEmbeddedInstance(inst->data[i],decodeFlags);
+					if(embedded == NULL)
+					{
+						Py_DECREF(valueSets);
+						return NULL;
+					}
+		   			PyTuple_SetItem(valueSets,i,embedded);
 				}
 				else
 				{
+					Py_INCREF(Py_None);
 					PyTuple_SetItem(valueSets,i,Py_None);
-				}				
+				}
 			}	
 			return valueSets;	
         }
@@ -469,7 +573,11 @@ static PyObject* MakePropertyDict(PMI_Instance *pmiInstance)
 			return NULL;
 		}
 
-		PyObject *value = Get_Element_Value(&elementValue,elementType);
+		PyObject *value = Get_Element_Value(&elementValue,elementType,pmiInstance->decodeFlags);
+		if(value == NULL)
+		{
+			return NULL;
+		}
 		if(PyDict_SetItemString(propertyValues,key,value))
 		{
 			PyErr_SetString(MIError,"Property dictionary insert item failed");
@@ -978,24 +1086,118 @@ static PyObject *EnumerateProperties(PMI_Instance *pmiInstance, char *propertyNa
 	}
 }
 
+/* Decode a single property of a lazy instance and memoize it in the property cache */
+static PyObject *GetLazyProperty(PMI_Instance *self, char *propertyName)
+{
+	MI_Instance *miInstance = self->miInstance;
+	PyObject *value;
+	MI_Result miResult;
+
+	if(self->propertyCache == NULL)
+	{
+		self->propertyCache = PyDict_New();
+		if(self->propertyCache == NULL)
+		{
+			return NULL;
+		}
+	}
+	value = PyDict_GetItemString(self->propertyCache,propertyName);
+	if(value != NULL)
+	{
+		return value;
+	}
+
+	/* nameSpace and classDecl are part of the property dictionary built by MakePropertyDict */
+	if(!strcmp(propertyName,"nameSpace") || !strcmp(propertyName,"classDecl"))
+	{
+		const MI_Char *name;
+		if(!strcmp(propertyName,"nameSpace"))
+			miResult = MI_Instance_GetNameSpace(miInstance,&name);
+		else
+			miResult = MI_Instance_GetClassName(miInstance,&name);
+		if(miResult != MI_RESULT_OK)
+		{
+			PyErr_SetString(MIError,"MI_Instance doesn't have the property");
+			return NULL;
+		}
+		value = Py_BuildValue("s",name);
+	}
+	else
+	{
+		MI_Value elementValue;
+		MI_Type elementType;
+		MI_Uint32 elementFlags;
+		miResult = MI_Instance_GetElement(miInstance,propertyName,&elementValue,&elementType,&elementFlags,NULL);
+		if(miResult != MI_RESULT_OK)
+		{
+			PyErr_SetString(MIError,"MI_Instance doesn't have the property");
+			return NULL;
+		}
+		value = Get_Element_Value(&elementValue,elementType,self->decodeFlags);
+	}
+	if(value == NULL)
+	{
+		return NULL;
+	}
+
+	if(PyDict_SetItemString(self->propertyCache,propertyName,value))
+	{
+		Py_DECREF(value);
+		return NULL;
+	}
+	Py_DECREF(value);
+	return value;
+}
+
 static PyObject *GetProperty(PMI_Instance *self, char* propertyName)
 {
+	/* A lazy instance only builds its property dictionaries when they are asked for as a whole */
+	if(self->propertyValues == NULL && (self->decodeFlags & PMI_DECODE_LAZY) && self->miInstance != NULL)
+	{
+		if(strcmp(propertyName,"propertyValues") && strcmp(propertyName,"propertyTypes") && strcmp(propertyName,"propertyFlags"))
+		{
+			return GetLazyProperty(self,propertyName);
+		}
+		if(MakePropertyDict(self) == NULL)
+		{
+			return NULL;
+		}
+		Py_DECREF(Py_None);
+		Py_CLEAR(self->propertyCache);
+	}
     return EnumerateProperties(self,propertyName);
 }
 
-static void SetProperty(PMI_Instance *self, char* propertyName, PyObject* value)
+/* Returns -1 with the Python exception set if the property could not be set */
+static int SetProperty(PMI_Instance *self, char* propertyName, PyObject* value)
 {
 	MI_Instance *miInstance = self->miInstance;
+	if(self->propertyValues == NULL && (self->decodeFlags & PMI_DECODE_LAZY) && miInstance != NULL)
+	{
+		if(MakePropertyDict(self) == NULL)
+		{
+			return -1;
+		}
+		Py_DECREF(Py_None);
+		Py_CLEAR(self->propertyCache);
+	}
+	if(self->propertyValues == NULL || self->propertyTypes == NULL)
+	{
+		PyErr_SetString(MIError,"MI_Instance is not valid");
+		return -1;
+	}
 	PyObject *propertyValues = self->propertyValues;
 	PyObject *newValue = PyDict_GetItemString(propertyValues,propertyName);
 	if(newValue == NULL)
 	{
 		PyErr_SetString(MIError,"MI_Instance doesn't have the property");
+		return -1;
 	}	
 	newValue = value;
 	if(PyDict_SetItemString(propertyValues,propertyName,newValue)<0)
 	{
 		PyErr_SetString(MIError,"Set instance property failed");
+		return -1;
 	}
 
 	PyObject *propertyTypes = self->propertyTypes;
@@ -1003,17 +1205,23 @@ static void SetProperty(PMI_Instance *self, char* propertyName, PyObject* value)
 	if(valueType == NULL)
 	{
 		PyErr_SetString(MIError,"MI_Instance doesn't have the property");
+		return -1;
 	}
 	MI_Type miType = PyInt_AsLong(valueType);
 	MI_Value miValue;
 	MI_Result miResult = MI_RESULT_OK;
 	SetPropertyValues(miType,value,&miValue);
+	if(PyErr_Occurred())
+	{
+		return -1;
+	}
 	miResult = MI_Instance_SetElement(miInstance,propertyName,&miValue,miType,0);
 	if(miResult != MI_RESULT_OK)
 	{
 		PyErr_SetString(MIError,"MI_Instance set element failed");
+		return -1;
 	}
-
+	return 0;
 }
 
 static int PMI_Instance_init(PMI_Instance *self)
@@ -1022,6 +1230,8 @@ static int PMI_Instance_init(PMI_Instance *self)
 	self->propertyValues = NULL;
 	self->propertyTypes = NULL;
 	self->propertyFlags = NULL;
+	self->propertyCache = NULL;
+	self->decodeFlags = 0;
     return 0;
 }
 
@@ -1032,14 +1242,13 @@ static PyMethodDef PMI_Instance_methods [] = {
 static PyObject* PMI_Instance_getattr(PMI_Instance* self, char* propertyName)
 {
     PyObject *propertyValue = GetProperty(self, propertyName);
-    Py_INCREF(propertyValue);
+    Py_XINCREF(propertyValue);
     return propertyValue;
 }
 
 static int PMI_Instance_setattr(PMI_Instance* self, char* propertyName, PyObject* value)
 {
-   SetProperty(self,propertyName,value);	
-   return 0;
+   return SetProperty(self,propertyName,value);
 }
 
 static PyTypeObject PMI_InstanceType = {
@@ -1084,25 +1293,14 @@ static PyTypeObject PMI_InstanceType = {
 };	    
 
 
-#define PyMODINIT_FUNC void
-#ifndef PyMODINIT_FUNC
-#endif
-PyMODINIT_FUNC
-initPMI_Instance(void)
+/* Ready the instance type and export it into the mi module, called once from initmi */
+static int AddInstanceTypes(PyObject *m)
 { 
-    PyObject *m;
     /*Make sure the new type object is initialized properly*/
     if (PyType_Ready(&PMI_InstanceType) <0)
-		return;
-    m = Py_InitModule3("mi",PMI_Instance_methods, "MI_Instance object");
-    //Py_INCREF(&PMI_InstanceType);
-    
-    /*Add the exception type to the module */
-    MIError = PyErr_NewException("mi.error",NULL,NULL);
-    Py_INCREF(MIError);
-    PyModule_AddObject(m,"MIError",MIError);
+		return -1;
 
     /*New type objects are all exported into mi module*/
-    PyModule_AddObject(m, "PMI_Instance", (PyObject *)&PMI_InstanceType);
-    PyDateTime_IMPORT;
+    Py_INCREF(&PMI_InstanceType);
+    return PyModule_AddObject(m, "PMI_Instance", (PyObject *)&PMI_InstanceType);
 }
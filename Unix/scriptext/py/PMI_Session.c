@@ -7,12 +7,16 @@
 **==============================================================================
 */
 
-#include "/usr/include/python2.6/Python.h"
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
 #include "structmember.h"
 #include "MI.h"
 #include "PMI_Instance.c"
 #include "PMI_Class.c"
 #include <stdlib.h>
+#include <ctype.h>
+#include <time.h>
+#include <pthread.h>
 #include "datetime.h"
 
 static PyObject *MIError;
@@ -21,12 +25,64 @@ static int errorBufferSize = 255;
 typedef struct{
     PyObject_HEAD
     MI_Session miSession;
+    int decodeFlags; /* PMI_DECODE_* flags applied to every instance returned by the session */
+    int closed; /* set once close() has been called, guarded by the GIL */
+    PyObject *poolKey; /* key of the session pool the session goes back to on close(), NULL if not pooled */
+    PyObject *classCache; /* class declarations returned by get_class, see LookupClass */
+    long classCacheMaxSize; /* 0 disables the cache */
+    double classCacheTtl; /* seconds a class declaration is reused, 0 never expires */
+    unsigned long classCacheHits;
+    unsigned long classCacheMisses;
+    struct _PMI_Metrics *metrics; /* operations of this session, allocated on first use while metrics are enabled */
+    struct _PMI_InstanceIterator *iterators; /* iterators with an open operation, closed by close(), guarded by the GIL */
+    long openOperations; /* calls in progress and operations not closed yet, close() only pools the session at 0 */
 
 } PMI_Session;
 
+/* Operation kinds the metrics are kept for, the names are in opTypeNames */
+#define PMI_OP_ENUMERATE 0
+#define PMI_OP_GET 1
+#define PMI_OP_GET_CLASS 2
+#define PMI_OP_CREATE 3
+#define PMI_OP_MODIFY 4
+#define PMI_OP_DELETE 5
+#define PMI_OP_INVOKE 6
+#define PMI_OP_ASSOCIATE 7
+#define PMI_OP_REFERENCE 8
+#define PMI_OP_QUERY 9
+#define PMI_OP_COUNT 10
+
+/* Measurements of the operation running on the current thread */
+typedef struct{
+    PMI_Session *session;
+    int opType;
+    double network;
+    double conversion;
+    unsigned long instances;
+} PMI_OpStats;
+
+/* Set only while metrics are enabled, so the instrumented code does nothing more than test it otherwise */
+static __thread PMI_OpStats *currentOpStats = NULL;
+
+static double PMI_Clock(void);
+
+/* Run a blocking MI client call without holding the GIL so other Python threads can run meanwhile.
+   The call must not touch any Python object. The time it blocks counts as network time of the current operation */
+#define PMI_ALLOW_THREADS(call) do { \
+	PMI_OpStats *_opStats = currentOpStats; \
+	Py_BEGIN_ALLOW_THREADS \
+	double _started = _opStats ? PMI_Clock() : 0; \
+	call; \
+	if(_opStats) _opStats->network += PMI_Clock() - _started; \
+	Py_END_ALLOW_THREADS \
+	} while(0)
+
 
 static void PMI_Session_dealloc(PMI_Session *self)
 {
+   Py_XDECREF(self->poolKey);
+   Py_XDECREF(self->classCache);
+   PyMem_Free(self->metrics);
    self->ob_type->tp_free((PyObject*) self);
 }
 
@@ -36,6 +92,22 @@ static PyObject* PMI_Session_new(PyTypeObject *type)
 	self = (PMI_Session*)type->tp_alloc(type,0);
     MI_Session miSession = MI_SESSION_NULL;
     self ->miSession = miSession;
+    self ->decodeFlags = 0;
+    self ->closed = 0;
+    self ->poolKey = NULL;
+    self ->classCache = PyDict_New();
+    if(self ->classCache == NULL)
+    {
+        Py_DECREF(self);
+        return NULL;
+    }
+    self ->classCacheMaxSize = 64;
+    self ->classCacheTtl = 0;
+    self ->classCacheHits = 0;
+    self ->classCacheMisses = 0;
+    self ->metrics = NULL;
+    self ->iterators = NULL;
+    self ->openOperations = 0;
     return (PyObject *)self;
 }
 
@@ -99,218 +171,2830 @@ MI_Result TestConnection(MI_Session *miSession)
     const MI_Instance *miInstance = NULL;
 	MI_Operation miOperation = MI_OPERATION_NULL;
 
-	MI_Session_TestConnection(miSession,0,NULL,&miOperation);   
-    _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+	PMI_ALLOW_THREADS(MI_Session_TestConnection(miSession,0,NULL,&miOperation));   
+    PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
+	PMI_ALLOW_THREADS(MI_Operation_Close(&miOperation));
+	if(_miResult != MI_RESULT_OK)
+	{
+		return _miResult;
+	}
 	return miResult;        
 }
 
+/* Idle sessions kept by mi.connect for reuse, keyed by destination and credentials. Only touched with the GIL held */
+typedef struct _PMI_PooledSession{
+    struct _PMI_PooledSession *next;
+    PyObject *key;
+    MI_Session miSession;
+    PyObject *classCache; /* class cache of the session, handed to the next session taken from the pool */
+    long classCacheMaxSize; /* configuration and counters of the class cache, handed over with it */
+    double classCacheTtl;
+    unsigned long classCacheHits;
+    unsigned long classCacheMisses;
+    double idleSince;
+} PMI_PooledSession;
+
+static PMI_PooledSession *sessionPool = NULL;
+static long poolMaxSize = 4; /* idle sessions kept per key, 0 disables pooling */
+static double poolIdleTimeout = 300; /* seconds an idle session is kept before it is closed */
+static double poolHealthCheckInterval = 30; /* a session idle for longer is tested before reuse, negative disables */
+
+/* Seconds on a monotonic clock, used for the pool and class cache timeouts */
+static double PMI_Clock(void)
+{
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC,&now);
+	return now.tv_sec + now.tv_nsec / 1e9;
+}
 
+/* Close the MI session of an entry taken out of the pool and free the entry */
+static void ClosePooledSession(PMI_PooledSession *entry)
+{
+	PMI_ALLOW_THREADS(MI_Session_Close(&entry->miSession,NULL,NULL));
+	Py_DECREF(entry->key);
+	Py_XDECREF(entry->classCache);
+	PyMem_Free(entry);
+}
 
-static PyObject* EnumerateInstances(PyObject* self, PyObject* args) 
+/* Close the idle sessions past the idle timeout, or all of them, and return how many were closed */
+static int EvictPooledSessions(int all)
 {
-    char *nameSpace,*className;
+	double now = PMI_Clock();
+	PMI_PooledSession **link = &sessionPool;
+	PMI_PooledSession *evicted = NULL;
+	int count = 0;
+	while(*link)
+	{
+		PMI_PooledSession *entry = *link;
+		if(all || now - entry->idleSince > poolIdleTimeout)
+		{
+			*link = entry->next;
+			entry->next = evicted;
+			evicted = entry;
+		}
+		else
+		{
+			link = &entry->next;
+		}
+	}
+	/* Entries are unlinked first so no other thread can take them while the GIL is released */
+	while(evicted)
+	{
+		PMI_PooledSession *entry = evicted;
+		evicted = entry->next;
+		ClosePooledSession(entry);
+		count++;
+	}
+	return count;
+}
 
-    PMI_Session *session = (PMI_Session*) self;
-    if(!PyArg_ParseTuple(args,"ss",&nameSpace,&className))
-    {
-		PyErr_SetString(MIError,"Please input correct nameSpace and className");
-		return NULL;
-    }
+/* Take the most recently used idle session for the key out of the pool, returns NULL if there is none */
+static PMI_PooledSession *TakePooledSession(PyObject *key)
+{
+	EvictPooledSessions(0);
+	PMI_PooledSession **link = &sessionPool;
+	while(*link)
+	{
+		PMI_PooledSession *entry = *link;
+		if(PyObject_RichCompareBool(entry->key,key,Py_EQ) == 1)
+		{
+			*link = entry->next;
+			return entry;
+		}
+		link = &entry->next;
+	}
+	return NULL;
+}
 
-    MI_Session miSession = session->miSession;
-    MI_Operation miOperation = MI_OPERATION_NULL;
-    MI_Result miResult;
-    MI_Boolean moreResults;
-    const MI_Char* errorString = NULL;
-    const MI_Instance *errorDetails = NULL;
-    MI_Result _miResult;
-   
-    MI_Session_EnumerateInstances(&miSession,0, NULL, nameSpace,className, MI_FALSE, NULL, &miOperation);
-    PyObject* instances = PyList_New(0);
-    do
-    {
-		const MI_Instance *miInstance;
-		MI_Result _miResult;
-        _miResult = MI_Operation_GetInstance(&miOperation,&miInstance,&moreResults,&miResult,&errorString,&errorDetails);
-	
-		if(_miResult != MI_RESULT_OK)
+/* Keep the MI session and class cache of the session for the next mi.connect with the same key, returns 0 if the
+   pool for the key is full */
+static int ReleasePooledSession(PyObject *key, PMI_Session *session)
+{
+	EvictPooledSessions(0);
+	PMI_PooledSession *entry;
+	long count = 0;
+	for(entry = sessionPool; entry != NULL; entry = entry->next)
+	{
+		if(PyObject_RichCompareBool(entry->key,key,Py_EQ) == 1)
 		{
-			/* Make sure the string buffer is big enough */
-			char error[errorBufferSize];
-			strcpy(error,"MI_Operation_GetInstance failed, error = ");
-			strcat(error,MI_Result_To_String(_miResult));
-	    	PyErr_SetString(MIError,error);
-	    	return NULL;
+			count++;
 		}
-		if(miInstance)
+	}
+	if(count >= poolMaxSize)
+	{
+		return 0;
+	}
+
+	entry = (PMI_PooledSession *)PyMem_Malloc(sizeof(PMI_PooledSession));
+	if(entry == NULL)
+	{
+		return 0;
+	}
+	Py_INCREF(key);
+	entry->key = key;
+	entry->miSession = session->miSession;
+	Py_XINCREF(session->classCache);
+	entry->classCache = session->classCache;
+	entry->classCacheMaxSize = session->classCacheMaxSize;
+	entry->classCacheTtl = session->classCacheTtl;
+	entry->classCacheHits = session->classCacheHits;
+	entry->classCacheMisses = session->classCacheMisses;
+	entry->idleSince = PMI_Clock();
+	entry->next = sessionPool;
+	sessionPool = entry;
+	return 1;
+}
+
+/* Operation metrics collected while mi.enable_stats(True) is in effect, see mi.stats() and session.stats() */
+#define PMI_HISTOGRAM_BUCKETS 128
+
+/* Latency histogram with 4 buckets per power of two microseconds, so a percentile is within 25% */
+typedef struct{
+    unsigned long count;
+    double total;
+    double max;
+    unsigned long buckets[PMI_HISTOGRAM_BUCKETS];
+} PMI_Histogram;
+
+typedef struct{
+    unsigned long count; /* calls made by Python code */
+    unsigned long errors;
+    unsigned long instances; /* result instances converted to PMI_Instance objects */
+    PMI_Histogram network; /* time blocked in the MI client waiting for the server */
+    PMI_Histogram conversion; /* time spent converting results into Python objects */
+} PMI_OpMetrics;
+
+typedef struct _PMI_Metrics{
+    PMI_OpMetrics operations[PMI_OP_COUNT];
+} PMI_Metrics;
+
+static const char *opTypeNames[PMI_OP_COUNT] =
+{
+    "enumerate_instances",
+    "get_instance",
+    "get_class",
+    "create_instance",
+    "modify_instance",
+    "delete_instance",
+    "invoke",
+    "associate",
+    "reference",
+    "query",
+};
+
+static int metricsEnabled = 0;
+static PMI_Metrics *globalMetrics = NULL; /* allocated the first time metrics are enabled, guarded by the GIL */
+
+static int HistogramBucket(double seconds)
+{
+	unsigned long long micros = seconds > 0 ? (unsigned long long)(seconds * 1e6) : 0;
+	int msb = 2;
+	if(micros < 4)
+	{
+		return (int)micros;
+	}
+	while((micros >> (msb + 1)) != 0)
+	{
+		msb++;
+	}
+	int bucket = (msb - 1) * 4 + (int)((micros >> (msb - 2)) & 3);
+	return bucket < PMI_HISTOGRAM_BUCKETS ? bucket : PMI_HISTOGRAM_BUCKETS - 1;
+}
+
+/* Upper bound of a bucket in seconds */
+static double HistogramBucketLimit(int bucket)
+{
+	int shift;
+	if(bucket < 4)
+	{
+		return (bucket + 1) / 1e6;
+	}
+	shift = bucket / 4 - 1;
+	return ((double)(4 + bucket % 4 + 1) * (double)(1ULL << shift)) / 1e6;
+}
+
+static void AddHistogramValue(PMI_Histogram *histogram, double seconds)
+{
+	histogram->count++;
+	histogram->total += seconds;
+	if(seconds > histogram->max)
+	{
+		histogram->max = seconds;
+	}
+	histogram->buckets[HistogramBucket(seconds)]++;
+}
+
+static double HistogramPercentile(const PMI_Histogram *histogram, double percentile)
+{
+	unsigned long rank = (unsigned long)(percentile * histogram->count + 0.5);
+	unsigned long seen = 0;
+	int bucket;
+	if(histogram->count == 0)
+	{
+		return 0;
+	}
+	for(bucket = 0; bucket < PMI_HISTOGRAM_BUCKETS; bucket++)
+	{
+		seen += histogram->buckets[bucket];
+		if(seen >= rank && seen > 0)
 		{
-	   		PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-			/*The miInstance won't exist once the operation is closed.*/
-	    	MI_Instance *cloneInstance;
-	    	MI_Instance_Clone(miInstance,&cloneInstance);
-	    	pmiInstance-> miInstance = cloneInstance;
-			MakePropertyDict(pmiInstance);
-	    	PyList_Append(instances, (PyObject *)pmiInstance);
+			break;
 		}
-    }while (miResult == MI_RESULT_OK && moreResults ==MI_TRUE);
+	}
+	double limit = HistogramBucketLimit(bucket);
+	return limit < histogram->max ? limit : histogram->max;
+}
 
-    if(miResult != MI_RESULT_OK)
-    {
-		char error[errorBufferSize];
-		strcpy(error,"Operation failed, error = ");
-		strcat(error,MI_Result_To_String(miResult));
-		if(errorString != NULL)
+/* Add the measurements of one call or result to the session and global metrics */
+static void RecordOpStats(PMI_OpStats *stats, unsigned long calls, unsigned long errors)
+{
+	PMI_Metrics **targets[2];
+	int i;
+	if(!metricsEnabled)
+	{
+		return;
+	}
+	targets[0] = &globalMetrics;
+	targets[1] = stats->session ? &stats->session->metrics : NULL;
+	for(i = 0; i < 2; i++)
+	{
+		PMI_OpMetrics *metrics;
+		if(targets[i] == NULL)
 		{
-			strcat(error,", errorMessage = ");
-			strcat(error,errorString);
+			continue;
 		}
-		PyErr_SetString(MIError,error); 		
-		return NULL;
-    }
-    
-    _miResult = MI_Operation_Close(&miOperation);
-    
-    if(_miResult != MI_RESULT_OK)
-    {
-		char error[errorBufferSize];
-		strcpy(error,"MI_Operation_Close failed, error = ");
-		strcat(error,MI_Result_To_String(_miResult));
-		PyErr_SetString(MIError,error);
-		return NULL;
-    } 
-    Py_INCREF(instances);
-    return (PyObject *)instances;
+		if(*targets[i] == NULL)
+		{
+			*targets[i] = (PMI_Metrics *)PyMem_Malloc(sizeof(PMI_Metrics));
+			if(*targets[i] == NULL)
+			{
+				continue;
+			}
+			memset(*targets[i],0,sizeof(PMI_Metrics));
+		}
+		metrics = &(*targets[i])->operations[stats->opType];
+		metrics->count += calls;
+		metrics->errors += errors;
+		metrics->instances += stats->instances;
+		if(stats->network > 0 || calls)
+		{
+			AddHistogramValue(&metrics->network,stats->network);
+		}
+		if(stats->instances > 0)
+		{
+			AddHistogramValue(&metrics->conversion,stats->conversion);
+		}
+	}
 }
 
+/* Callable set by mi.set_trace_hook, called as hook(event, info) around every measured session call */
+static PyObject *traceHook = NULL;
 
-static PyObject *CreateInboundInstance(MI_Session* miSession, const MI_Char *namespaceName, const MI_Char *className, MI_Boolean keysOnly, const MI_Instance **inboundInstance, PyObject *propertyDict)
+/* Namespace and class an operation targets, for the trace hook. The class is the className keyword, the first
+   string argument after the namespace or the class of the first PMI_Instance argument */
+static PyObject *TraceTarget(PyObject *args, PyObject *kwds, int opType, const char *method)
 {
-    MI_Operation miOperation = MI_OPERATION_NULL;
-    const MI_Class *miClass = NULL;
-    MI_Boolean moreResults;
-    MI_Result miResult = 0;
-    const MI_Char *errorMessage = NULL;
-    const MI_Instance *completionDetails = NULL;
-    MI_Application miApplication = MI_APPLICATION_NULL;
-    MI_Instance *miInstance = NULL;
-    MI_Uint32 numberElements = 0;
-    MI_Uint32 elementIndex;
+	PyObject *nameSpace = NULL;
+	PyObject *className = kwds ? PyDict_GetItemString(kwds,"className") : NULL;
+	Py_ssize_t index;
+	if(PyTuple_GET_SIZE(args) > 0)
+	{
+		nameSpace = PyTuple_GET_ITEM(args,0);
+	}
+	else if(kwds)
+	{
+		nameSpace = PyDict_GetItemString(kwds,"nameSpace");
+	}
+	/* The query arguments are the dialect and expression, invoke takes the method name first */
+	for(index = strcmp(method,"invoke") == 0 ? 2 : 1; className == NULL && opType != PMI_OP_QUERY && index < PyTuple_GET_SIZE(args); index++)
+	{
+		PyObject *arg = PyTuple_GET_ITEM(args,index);
+		if(PyString_Check(arg))
+		{
+			className = arg;
+		}
+		else if(PyObject_TypeCheck(arg,&PMI_InstanceType))
+		{
+			const MI_Char *name = NULL;
+			if(((PMI_Instance *)arg)->miInstance != NULL)
+			{
+				MI_Instance_GetClassName(((PMI_Instance *)arg)->miInstance,&name);
+			}
+			return Py_BuildValue("{s:s,s:s,s:O,s:z}","method",method,"operation",opTypeNames[opType],
+				"nameSpace",nameSpace ? nameSpace : Py_None,"className",name);
+		}
+	}
+	return Py_BuildValue("{s:s,s:s,s:O,s:O}","method",method,"operation",opTypeNames[opType],
+		"nameSpace",nameSpace ? nameSpace : Py_None,"className",className ? className : Py_None);
+}
+
+/* Call the trace hook, an exception it raises is reported and the operation goes on */
+static void CallTraceHook(PyObject *hook, const char *event, PyObject *info)
+{
+	PyObject *type, *value, *traceback;
+	PyObject *result;
+	PyErr_Fetch(&type,&value,&traceback);
+	result = PyObject_CallFunction(hook,"sO",event,info);
+	if(result == NULL)
+	{
+		PyErr_WriteUnraisable(hook);
+	}
+	Py_XDECREF(result);
+	PyErr_Restore(type,value,traceback);
+}
+
+/* Call a session method with the network and conversion time of the operation measured and the trace hook called
+   before and after it, a plain call when metrics are disabled and no hook is set */
+static PyObject *RunMeasured(PyObject *self, const char *method, int opType, PyCFunction function, PyObject *args, PyObject *kwds, int keywords)
+{
+	PMI_OpStats stats = {(PMI_Session *)self, opType, 0, 0, 0};
+	PMI_OpStats *previous = currentOpStats;
+	PyObject *hook = traceHook;
+	PyObject *info = NULL;
+	PyObject *result;
+	double started;
+	if(!metricsEnabled && hook == NULL)
+	{
+		((PMI_Session *)self)->openOperations++;
+		result = keywords ? ((PyCFunctionWithKeywords)function)(self,args,kwds) : function(self,args);
+		((PMI_Session *)self)->openOperations--;
+		return result;
+	}
+
+	if(hook != NULL)
+	{
+		/* The same dictionary is passed at the end, so the hook can keep its span in it */
+		Py_INCREF(hook);
+		info = TraceTarget(args,kwds,opType,method);
+		if(info == NULL)
+		{
+			Py_DECREF(hook);
+			return NULL;
+		}
+		CallTraceHook(hook,"start",info);
+	}
+	started = PMI_Clock();
+	currentOpStats = &stats;
+	((PMI_Session *)self)->openOperations++;
+	result = keywords ? ((PyCFunctionWithKeywords)function)(self,args,kwds) : function(self,args);
+	((PMI_Session *)self)->openOperations--;
+	currentOpStats = previous;
+	RecordOpStats(&stats,1,result == NULL ? 1 : 0);
+
+	if(hook != NULL)
+	{
+		PyObject *type = NULL, *value = NULL, *traceback = NULL;
+		if(result == NULL)
+		{
+			PyErr_Fetch(&type,&value,&traceback);
+			PyErr_NormalizeException(&type,&value,&traceback);
+		}
+		PyObject *timing = Py_BuildValue("{s:d,s:d,s:d,s:k,s:O}",
+			"elapsed",PMI_Clock() - started,
+			"network",stats.network,
+			"conversion",stats.conversion,
+			"instances",stats.instances,
+			"error",value ? value : Py_None);
+		if(timing == NULL || PyDict_Update(info,timing) < 0)
+		{
+			PyErr_WriteUnraisable(hook);
+		}
+		else
+		{
+			CallTraceHook(hook,"end",info);
+		}
+		Py_XDECREF(timing);
+		if(result == NULL)
+		{
+			PyErr_Restore(type,value,traceback);
+		}
+		Py_DECREF(info);
+		Py_DECREF(hook);
+	}
+	return result;
+}
+
+#define PMI_MEASURED(name, method, opType, function) \
+static PyObject *name(PyObject *self, PyObject *args) \
+{ \
+	return RunMeasured(self,method,opType,(PyCFunction)function,args,NULL,0); \
+}
+
+#define PMI_MEASURED_KEYWORDS(name, method, opType, function) \
+static PyObject *name(PyObject *self, PyObject *args, PyObject *kwds) \
+{ \
+	return RunMeasured(self,method,opType,(PyCFunction)function,args,kwds,1); \
+}
+
+static PyObject *MakeHistogramDict(const PMI_Histogram *histogram)
+{
+	return Py_BuildValue("{s:k,s:d,s:d,s:d,s:d,s:d}",
+		"count",histogram->count,
+		"total",histogram->total,
+		"max",histogram->max,
+		"p50",HistogramPercentile(histogram,0.50),
+		"p95",HistogramPercentile(histogram,0.95),
+		"p99",HistogramPercentile(histogram,0.99));
+}
+
+/* Build {operationName: {count, errors, instances, network, conversion}} for the operations used so far */
+static PyObject *MakeStatsDict(const PMI_Metrics *metrics)
+{
+	PyObject *result = PyDict_New();
+	int opType;
+	if(result == NULL || metrics == NULL)
+	{
+		return result;
+	}
+	for(opType = 0; opType < PMI_OP_COUNT; opType++)
+	{
+		const PMI_OpMetrics *operation = &metrics->operations[opType];
+		if(operation->count == 0 && operation->instances == 0 && operation->errors == 0)
+		{
+			continue;
+		}
+		PyObject *entry = Py_BuildValue("{s:k,s:k,s:k,s:N,s:N}",
+			"count",operation->count,
+			"errors",operation->errors,
+			"instances",operation->instances,
+			"network",MakeHistogramDict(&operation->network),
+			"conversion",MakeHistogramDict(&operation->conversion));
+		if(entry == NULL || PyDict_SetItemString(result,opTypeNames[opType],entry) < 0)
+		{
+			Py_XDECREF(entry);
+			Py_DECREF(result);
+			return NULL;
+		}
+		Py_DECREF(entry);
+	}
+	return result;
+}
+
+static void ResetMetrics(PMI_Metrics *metrics)
+{
+	if(metrics != NULL)
+	{
+		memset(metrics,0,sizeof(PMI_Metrics));
+	}
+}
 
-    *inboundInstance = NULL;
+/* Sessions can be shared between threads, make sure no new operation is started once it has been closed */
+static int CheckSessionOpen(PMI_Session *session)
+{
+	if(session->closed)
+	{
+		PyErr_SetString(MIError,"The session has been closed");
+		return 0;
+	}
+	return 1;
+}
 
-	MI_Session_GetClass(miSession, 0, NULL, namespaceName, className, NULL, &miOperation);
-	MI_Operation_GetClass(&miOperation, &miClass, &moreResults, &miResult, &errorMessage, &completionDetails);
+static PMI_Instance *ConvertResultInstance(PMI_Session *session, const MI_Instance *miInstance)
+{
+	MI_Instance *cloneInstance;
+	MI_Result miResult = MI_Instance_Clone(miInstance,&cloneInstance);
 	if(miResult != MI_RESULT_OK)
 	{
-		PyErr_SetString(MIError,"Failed to retrieve class declaration");
+		char error[errorBufferSize];
+		strcpy(error,"MI_Instance_Clone failed, error = ");
+		strcat(error,MI_Result_To_String(miResult));
+		PyErr_SetString(MIError,error);
 		return NULL;
 	}
-	
-	miResult = MI_Session_GetApplication(miSession, &miApplication);
-	if(miResult != MI_RESULT_OK)
+
+	PMI_Instance *pmiInstance = (PMI_Instance *)PyObject_CallObject((PyObject *)&PMI_InstanceType, NULL);
+	if(pmiInstance == NULL)
 	{
-		PyErr_SetString(MIError,"Failed to get the parent application of the session");
-		goto failedGetClass;
+		MI_Instance_Delete(cloneInstance);
+		return NULL;
+	}
+	pmiInstance->miInstance = cloneInstance;
+	pmiInstance->decodeFlags = session->decodeFlags;
+	if(session->decodeFlags & PMI_DECODE_LAZY)
+	{
+		/* Properties are decoded on first access by GetProperty */
+		return pmiInstance;
+	}
+	if(MakePropertyDict(pmiInstance) == NULL)
+	{
+		Py_DECREF(pmiInstance);
+		return NULL;
 	}
+	Py_DECREF(Py_None);
+	return pmiInstance;
+}
 
-	miResult = MI_Application_NewInstance(&miApplication,className,NULL,&miInstance);
-	if(miResult != MI_RESULT_OK)
+/* Clone an operation result into a new PMI_Instance, the result instance is only valid until the next
+   MI_Operation_GetInstance or MI_Operation_Close call on its operation */
+static PMI_Instance *WrapResultInstance(PMI_Session *session, const MI_Instance *miInstance)
+{
+	PMI_OpStats *stats = currentOpStats;
+	PMI_Instance *pmiInstance;
+	double started;
+	if(stats == NULL)
 	{
-		PyErr_SetString(MIError,"Failed to create an instance");
-		goto failedGetClass;
+		return ConvertResultInstance(session,miInstance);
 	}
-	
-	miResult = MI_Class_GetElementCount(miClass, &numberElements);
-	if(miResult != MI_RESULT_OK)
+	started = PMI_Clock();
+	pmiInstance = ConvertResultInstance(session,miInstance);
+	stats->conversion += PMI_Clock() - started;
+	if(pmiInstance != NULL)
 	{
-		PyErr_SetString(MIError,"Failed to get element count from class");
-		goto failedGetClass;
+		stats->instances++;
 	}
-	
-	for (elementIndex = 0; elementIndex != numberElements; elementIndex++)
-    {
-        const MI_Char *elementName;
-        MI_Type elementType;
-        MI_Uint32 elementFlags;
-   
-        miResult = MI_Class_GetElementAt(miClass, elementIndex, &elementName, NULL, NULL, &elementType, NULL, NULL, &elementFlags);
-        if (miResult != MI_RESULT_OK)
-        {
-            PyErr_SetString(MIError,"Failed to get element details from class");
-            goto failedGetClass;
-        }
+	return pmiInstance;
+}
 
-        if (keysOnly && ((elementFlags & MI_FLAG_KEY) == 0))
+
+/* Fetch a class declaration from the server and wrap a copy of it that outlives the operation */
+static PMI_Class *FetchClass(PMI_Session *session, const char *nameSpace, const char *className)
+{
+    MI_Operation miOperation = MI_OPERATION_NULL;
+    MI_Result miResult;
+    MI_Result _miResult;
+    MI_Boolean moreResults;
+    const MI_Char *errorMessage = NULL;
+    const MI_Instance *completionDetails = NULL;
+    const MI_Class *miClass = NULL;
+    MI_Class *cloneClass = NULL;
+
+    /* Callers can give up the GIL before the class is needed, the session may have been closed meanwhile */
+    if(!CheckSessionOpen(session))
+    {
+        return NULL;
+    }
+    PMI_ALLOW_THREADS(MI_Session_GetClass(&session->miSession,0,NULL,nameSpace,className,NULL,&miOperation));
+    PMI_ALLOW_THREADS(_miResult = MI_Operation_GetClass(&miOperation, &miClass, &moreResults, &miResult, &errorMessage, &completionDetails));
+    if (_miResult != MI_RESULT_OK)
+    {
+        char error[errorBufferSize];
+        strcpy(error,"MI_Operation_GetClass failed, errorString =");
+        strcat(error,MI_Result_To_String(_miResult));
+        PyErr_SetString(MIError,error);
+    }
+    else if (miResult != MI_RESULT_OK)
+    {
+        char error[errorBufferSize];
+        strcpy(error,"Get operation failed to retrieve the class,error ");
+        strcat(error,MI_Result_To_String(miResult));
+        if(errorMessage != NULL)
         {
-            continue;
+            strcat(error,", errorMessage = ");
+            strncat(error,errorMessage,errorBufferSize - strlen(error) - 1);
         }
-		//Iterate the dictionary and add property values to the instance
-		PyObject *key, *value;
+        PyErr_SetString(MIError,error);
+    }
+    else if (miClass == NULL)
+    {
+        PyErr_SetString(MIError,"Get operation did not return the class");
+    }
+    else if ((miResult = MI_Class_Clone(miClass,&cloneClass)) != MI_RESULT_OK)
+    {
+        char error[errorBufferSize];
+        strcpy(error,"MI_Class_Clone failed, error = ");
+        strcat(error,MI_Result_To_String(miResult));
+        PyErr_SetString(MIError,error);
+    }
+    /* The class returned by the operation is only valid until the operation is closed */
+    PMI_ALLOW_THREADS(MI_Operation_Close(&miOperation));
+    if (cloneClass == NULL)
+    {
+        return NULL;
+    }
+
+    PMI_Class *pmiClass = (PMI_Class*) init_PMI_Class();
+    if (pmiClass == NULL)
+    {
+        MI_Class_Delete(cloneClass);
+        return NULL;
+    }
+    pmiClass->miClass = cloneClass;
+    if (MakeMethodsDict(pmiClass) == NULL || MakePropertyValueAndTypeDict(pmiClass) == NULL)
+    {
+        Py_DECREF(pmiClass);
+        return NULL;
+    }
+    Py_DECREF(Py_None);
+    Py_DECREF(Py_None);
+    return pmiClass;
+}
+
+/* Drop the least recently used class declarations until there is room for one more */
+static void EvictCachedClasses(PMI_Session *session)
+{
+	while(PyDict_Size(session->classCache) > 0 && PyDict_Size(session->classCache) >= session->classCacheMaxSize)
+	{
+		PyObject *key, *entry;
+		PyObject *oldestKey = NULL;
+		unsigned long oldestTick = 0;
 		Py_ssize_t pos = 0;
-		while (PyDict_Next(propertyDict, &pos, &key, &value))
+		while(PyDict_Next(session->classCache,&pos,&key,&entry))
 		{
-			MI_Value miValue;
-			char *propertyName;
-			PyObject *propertyValue;
-			//need to check if the value is array of single instance
-			if(!PyArg_Parse(key,"s",&propertyName))
-				return Py_BuildValue("s","property name not correct");
-			if(!PyArg_Parse(value,"O",&propertyValue))
-				return Py_BuildValue("s","property value not correct");
+			unsigned long tick = PyLong_AsUnsignedLong(PyList_GET_ITEM(entry,2));
+			if(oldestKey == NULL || tick < oldestTick)
+			{
+				oldestKey = key;
+				oldestTick = tick;
+			}
+		}
+		PyDict_DelItem(session->classCache,oldestKey);
+	}
+}
+
+/* Return the class declaration for nameSpace and className, from the session cache when it is fresh enough.
+   Cache entries are [PMI_Class, time cached, last use] lists keyed by (nameSpace, className) */
+static PMI_Class *LookupClass(PMI_Session *session, const char *nameSpace, const char *className)
+{
+	static unsigned long classCacheTick = 0;
+	PMI_Class *pmiClass;
+	PyObject *key, *entry;
+
+	if(session->classCacheMaxSize <= 0 || session->classCache == NULL)
+	{
+		session->classCacheMisses++;
+		return FetchClass(session,nameSpace,className);
+	}
+
+	key = Py_BuildValue("(ss)",nameSpace,className);
+	if(key == NULL)
+	{
+		return NULL;
+	}
+	entry = PyDict_GetItem(session->classCache,key);
+	if(entry != NULL)
+	{
+		double cachedAt = PyFloat_AsDouble(PyList_GET_ITEM(entry,1));
+		if(session->classCacheTtl <= 0 || PMI_Clock() - cachedAt <= session->classCacheTtl)
+		{
+			pmiClass = (PMI_Class *)PyList_GET_ITEM(entry,0);
+			PyList_SetItem(entry,2,PyLong_FromUnsignedLong(++classCacheTick));
+			session->classCacheHits++;
+			Py_INCREF(pmiClass);
+			Py_DECREF(key);
+			return pmiClass;
+		}
+		PyDict_DelItem(session->classCache,key);
+	}
+
+	session->classCacheMisses++;
+	pmiClass = FetchClass(session,nameSpace,className);
+	if(pmiClass != NULL)
+	{
+		EvictCachedClasses(session);
+		entry = Py_BuildValue("[OdN]",pmiClass,PMI_Clock(),PyLong_FromUnsignedLong(++classCacheTick));
+		if(entry == NULL || PyDict_SetItem(session->classCache,key,entry) < 0)
+		{
+			/* The class is still usable, it just isn't cached */
+			PyErr_Clear();
+		}
+		Py_XDECREF(entry);
+	}
+	Py_DECREF(key);
+	return pmiClass;
+}
+
+
+/*Defines a PMI_InstanceIterator Type Object which yields the results of an operation as they arrive from the server */
+typedef struct _PMI_InstanceIterator{
+    PyObject_HEAD
+    PyObject *session; /* keeps the session alive while the operation is running */
+    MI_Operation miOperation;
+    int finished;
+    int busy; /* set while a thread is waiting on the operation without the GIL */
+    int opType; /* PMI_OP_* the results are measured as */
+    int interrupted; /* set when close() on the session closed the operation before it finished */
+    struct _PMI_InstanceIterator *next; /* list of the session iterators with an open operation */
+    struct _PMI_InstanceIterator **previous;
+} PMI_InstanceIterator;
+
+static PyTypeObject PMI_InstanceIteratorType;
+
+/* Cancel the operation if the consumer stopped early, drain any results still queued and close it */
+static MI_Result CloseInstanceIterator(PMI_InstanceIterator *iterator)
+{
+	MI_Operation miOperation = iterator->miOperation;
+	MI_Result _miResult;
+	if(miOperation.ft == NULL)
+	{
+		return MI_RESULT_OK;
+	}
+
+	/* Take the operation before the GIL is released to drain it, so no other thread pulls from it or closes it */
+	iterator->miOperation.ft = NULL;
+	if(iterator->next)
+	{
+		iterator->next->previous = iterator->previous;
+	}
+	*iterator->previous = iterator->next;
+	if(!iterator->finished)
+	{
+		MI_Boolean moreResults = MI_TRUE;
+		iterator->finished = 1;
+		PMI_ALLOW_THREADS(MI_Operation_Cancel(&miOperation,MI_REASON_NONE));
+		while(moreResults == MI_TRUE)
+		{
+			const MI_Instance *miInstance;
+			const MI_Char *errorString;
+			const MI_Instance *errorDetails;
+			MI_Result miResult;
+			MI_Result _miResult;
+			PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation,&miInstance,&moreResults,&miResult,&errorString,&errorDetails));
+			if(_miResult != MI_RESULT_OK)
+			{
+				break;
+			}
+		}
+	}
+	_miResult = MI_Operation_Close(&miOperation);
+	((PMI_Session *)iterator->session)->openOperations--;
+	return _miResult;
+}
+
+static void PMI_InstanceIterator_dealloc(PMI_InstanceIterator *self)
+{
+	CloseInstanceIterator(self);
+	Py_CLEAR(self->session);
+	self->ob_type->tp_free((PyObject*) self);
+}
+
+static PyObject *NextResultInstance(PMI_InstanceIterator *self)
+{
+	while(!self->finished)
+	{
+		const MI_Instance *miInstance = NULL;
+		const MI_Char *errorString = NULL;
+		const MI_Instance *errorDetails = NULL;
+		MI_Boolean moreResults;
+		MI_Result miResult;
+		MI_Result _miResult;
+		PMI_Instance *pmiInstance = NULL;
+
+		PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&self->miOperation,&miInstance,&moreResults,&miResult,&errorString,&errorDetails));
+		if(_miResult != MI_RESULT_OK)
+		{
+			char error[errorBufferSize];
+			strcpy(error,"MI_Operation_GetInstance failed, error = ");
+			strcat(error,MI_Result_To_String(_miResult));
+			PyErr_SetString(MIError,error);
+			CloseInstanceIterator(self);
+			return NULL;
+		}
+
+		if(moreResults == MI_FALSE)
+		{
+			self->finished = 1;
+			if(miResult != MI_RESULT_OK)
+			{
+				char error[errorBufferSize];
+				strcpy(error,"Operation failed, error = ");
+				strcat(error,MI_Result_To_String(miResult));
+				if(errorString != NULL)
+				{
+					strcat(error,", errorMessage = ");
+					strncat(error,errorString,errorBufferSize - strlen(error) - 1);
+				}
+				PyErr_SetString(MIError,error);
+				CloseInstanceIterator(self);
+				return NULL;
+			}
+		}
+
+		if(miInstance)
+		{
+			pmiInstance = WrapResultInstance((PMI_Session *)self->session,miInstance);
+		}
+
+		if(self->finished)
+		{
+			_miResult = CloseInstanceIterator(self);
+			if(_miResult != MI_RESULT_OK)
+			{
+				char error[errorBufferSize];
+				strcpy(error,"MI_Operation_Close failed, error = ");
+				strcat(error,MI_Result_To_String(_miResult));
+				PyErr_SetString(MIError,error);
+				Py_CLEAR(pmiInstance);
+			}
+		}
+
+		if(pmiInstance != NULL || PyErr_Occurred())
+		{
+			return (PyObject *)pmiInstance;
+		}
+	}
+	/* Returning NULL without an exception set raises StopIteration */
+	return NULL;
+}
+
+static PyObject *PMI_InstanceIterator_next(PMI_InstanceIterator *self)
+{
+	PyObject *result;
+	/* The GIL is released while waiting for results, only one thread can pull from the operation at a time */
+	if(self->busy)
+	{
+		PyErr_SetString(MIError,"The iterator is already being read by another thread");
+		return NULL;
+	}
+	if(!self->finished && ((PMI_Session *)self->session)->closed)
+	{
+		/* close() on the session is waiting for the operation */
+		self->interrupted = 1;
+		CloseInstanceIterator(self);
+	}
+	if(self->interrupted)
+	{
+		PyErr_SetString(MIError,"The session has been closed");
+		return NULL;
+	}
+	self->busy = 1;
+	if(metricsEnabled)
+	{
+		PMI_OpStats stats = {(PMI_Session *)self->session, self->opType, 0, 0, 0};
+		PMI_OpStats *previous = currentOpStats;
+		currentOpStats = &stats;
+		result = NextResultInstance(self);
+		currentOpStats = previous;
+		RecordOpStats(&stats,0,result == NULL && PyErr_Occurred() ? 1 : 0);
+	}
+	else
+	{
+		result = NextResultInstance(self);
+	}
+	self->busy = 0;
+	return result;
+}
+
+static PyObject *CloseIterator(PyObject *self)
+{
+	if(((PMI_InstanceIterator *)self)->busy)
+	{
+		PyErr_SetString(MIError,"The iterator is already being read by another thread");
+		return NULL;
+	}
+	MI_Result _miResult = CloseInstanceIterator((PMI_InstanceIterator *)self);
+	if(_miResult != MI_RESULT_OK)
+	{
+		char error[errorBufferSize];
+		strcpy(error,"MI_Operation_Close failed, error = ");
+		strcat(error,MI_Result_To_String(_miResult));
+		PyErr_SetString(MIError,error);
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyMethodDef PMI_InstanceIterator_methods [] = {
+    {"close",(PyCFunction)CloseIterator,METH_NOARGS,"Cancel the operation and discard any results that have not been read"},
+    {NULL}
+};
+
+static PyTypeObject PMI_InstanceIteratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "PMI_Session.PMI_InstanceIterator",             /* tp_name */
+    sizeof(PMI_InstanceIterator), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)PMI_InstanceIterator_dealloc,     /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Iterator over the instances returned by an MI operation",           /* tp_doc */
+    0,			       /* tp_traverse */
+    0,		               /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    PyObject_SelfIter,         /* tp_iter */
+    (iternextfunc)PMI_InstanceIterator_next,   /* tp_iternext */
+    PMI_InstanceIterator_methods,             /* tp_methods */
+};
+
+/* Take ownership of a started operation and return an iterator that pulls its results on demand */
+static PyObject *NewInstanceIterator(PyObject *session, MI_Operation *miOperation, int opType)
+{
+	PMI_InstanceIterator *iterator = PyObject_New(PMI_InstanceIterator,&PMI_InstanceIteratorType);
+	if(iterator == NULL)
+	{
+		MI_Operation_Cancel(miOperation,MI_REASON_NONE);
+		MI_Operation_Close(miOperation);
+		return NULL;
+	}
+	Py_INCREF(session);
+	iterator->session = session;
+	iterator->miOperation = *miOperation;
+	iterator->finished = 0;
+	iterator->busy = 0;
+	iterator->opType = opType;
+	iterator->interrupted = 0;
+	((PMI_Session *)session)->openOperations++;
+	/* Linked into the session so close() can close the operation, CloseInstanceIterator unlinks it */
+	iterator->next = ((PMI_Session *)session)->iterators;
+	if(iterator->next)
+	{
+		iterator->next->previous = &iterator->next;
+	}
+	iterator->previous = &((PMI_Session *)session)->iterators;
+	((PMI_Session *)session)->iterators = iterator;
+	return (PyObject *)iterator;
+}
+
+static PyObject *IterInstances(PyObject *self, PyObject *args)
+{
+	char *nameSpace,*className;
+	if(!PyArg_ParseTuple(args,"ss",&nameSpace,&className))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace and className");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	MI_Operation miOperation = MI_OPERATION_NULL;
+	PMI_ALLOW_THREADS(MI_Session_EnumerateInstances(&session->miSession,0,NULL,nameSpace,className,MI_FALSE,NULL,&miOperation));
+	return NewInstanceIterator(self,&miOperation,PMI_OP_ENUMERATE);
+}
+
+static PyObject *IterQuery(PyObject *self, PyObject *args)
+{
+	char *nameSpace, *queryDialect, *queryExpression;
+	if(!PyArg_ParseTuple(args,"sss",&nameSpace,&queryDialect,&queryExpression))
+	{
+		PyErr_SetString(MIError,"Please input the correct arguments for query operation");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	MI_Operation miOperation = MI_OPERATION_NULL;
+	PMI_ALLOW_THREADS(MI_Session_QueryInstances(&session->miSession,0,NULL,nameSpace,queryDialect,queryExpression,NULL,&miOperation));
+	return NewInstanceIterator(self,&miOperation,PMI_OP_QUERY);
+}
+
+
+
+/* Growable byte buffer, used for the columns of enumerate_columns and by the instance serializer */
+typedef struct{
+    char *data;
+    size_t size;
+    size_t capacity;
+} PMI_Buffer;
+
+static int AppendBuffer(PMI_Buffer *buffer, const void *value, size_t length)
+{
+	if(buffer->size + length > buffer->capacity)
+	{
+		size_t capacity = buffer->capacity ? buffer->capacity * 2 : 1024;
+		while(capacity < buffer->size + length)
+		{
+			capacity *= 2;
+		}
+		char *data = (char *)PyMem_Realloc(buffer->data,capacity);
+		if(data == NULL)
+		{
+			PyErr_NoMemory();
+			return 0;
+		}
+		buffer->data = data;
+		buffer->capacity = capacity;
+	}
+	if(value != NULL)
+	{
+		memcpy(buffer->data + buffer->size,value,length);
+	}
+	else
+	{
+		memset(buffer->data + buffer->size,0,length);
+	}
+	buffer->size += length;
+	return 1;
+}
+
+/* One selected property, values are written in place as the instances arrive */
+typedef struct{
+    const char *name;
+    int typed; /* set once the MI_Type of the property is known */
+    MI_Type type;
+    char typecode; /* array module typecode, 0 stores Python objects in values */
+    size_t itemSize;
+    Py_ssize_t pendingNulls; /* NULLs seen before the type was known */
+    PMI_Buffer data;
+    PMI_Buffer valid;
+    PyObject *values;
+} PMI_Column;
+
+/* Write the value of the property of one instance to its column, miValue is NULL for a NULL or missing value */
+static int AppendColumnValue(PMI_Column *column, const MI_Value *miValue, MI_Type type)
+{
+	unsigned char valid = miValue != NULL && (!column->typed || type == column->type);
+	if(!column->typed)
+	{
+		if(miValue == NULL)
+		{
+			column->pendingNulls++;
+			return 1;
+		}
+		column->typed = 1;
+		column->type = type;
+		column->typecode = ValueTypecode(type,&column->itemSize);
+		for(; column->pendingNulls > 0; column->pendingNulls--)
+		{
+			unsigned char invalid = 0;
+			if(!AppendBuffer(&column->valid,&invalid,1))
+				return 0;
+			if(column->typecode)
+			{
+				if(!AppendBuffer(&column->data,NULL,column->itemSize))
+					return 0;
+			}
+			else if(PyList_Append(column->values,Py_None) < 0)
+			{
+				return 0;
+			}
+		}
+	}
+
+	if(!AppendBuffer(&column->valid,&valid,1))
+	{
+		return 0;
+	}
+	if(column->typecode)
+	{
+		/* MI_Value is a union, the value is at its start with the size of its type */
+		return AppendBuffer(&column->data,valid ? (const void *)miValue : NULL,column->itemSize);
+	}
+	else
+	{
+		int result;
+		PyObject *value = valid ? Get_Element_Value(miValue,type,0) : (Py_INCREF(Py_None), Py_None);
+		if(value == NULL)
+		{
+			return 0;
+		}
+		result = PyList_Append(column->values,value);
+		Py_DECREF(value);
+		return result == 0;
+	}
+}
+
+/* Convert a column to a (type, values, valid) tuple, values and valid are array.array objects when the type allows */
+static PyObject *MakeColumnTuple(PMI_Column *column, Py_ssize_t count)
+{
+	PyObject *values, *valid, *result;
+	if(!column->typed)
+	{
+		/* Every value was NULL, there is no type to build an array for */
+		Py_ssize_t index;
+		values = PyList_New(count);
+		if(values == NULL)
+		{
+			return NULL;
+		}
+		for(index = 0; index < count; index++)
+		{
+			Py_INCREF(Py_None);
+			PyList_SET_ITEM(values,index,Py_None);
+		}
+		column->pendingNulls = count;
+		while(column->pendingNulls-- > 0)
+		{
+			unsigned char invalid = 0;
+			if(!AppendBuffer(&column->valid,&invalid,1))
+			{
+				Py_DECREF(values);
+				return NULL;
+			}
+		}
+	}
+	else if(column->typecode)
+	{
+		values = NewTypedArray(column->typecode,column->data.data,column->data.size);
+	}
+	else
+	{
+		values = column->values;
+		Py_INCREF(values);
+	}
+	if(values == NULL)
+	{
+		return NULL;
+	}
+
+	valid = NewTypedArray('B',column->valid.data,column->valid.size);
+	if(valid == NULL)
+	{
+		Py_DECREF(values);
+		return NULL;
+	}
+
+	result = Py_BuildValue("(iNN)",column->typed ? (int)column->type : -1,values,valid);
+	return result;
+}
+
+/* Enumerate the instances of a class and return the selected properties as columns, a dictionary of
+   propertyName -> (type, values, valid). Numeric values are written straight into array.array buffers that NumPy
+   can wrap without a copy, valid is an array of 0/1 bytes marking the NULL values */
+static PyObject *EnumerateColumns(PyObject *self, PyObject *args)
+{
+	char *nameSpace,*className;
+	PyObject *properties;
+	if(!PyArg_ParseTuple(args,"ssO",&nameSpace,&className,&properties))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace, className and list of properties");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	properties = PySequence_List(properties);
+	if(properties == NULL)
+	{
+		return NULL;
+	}
+
+	Py_ssize_t columnCount = PyList_GET_SIZE(properties);
+	Py_ssize_t count = 0;
+	Py_ssize_t index;
+	PyObject *result = NULL;
+	PMI_Column *columns = (PMI_Column *)PyMem_Malloc(sizeof(PMI_Column) * (columnCount ? columnCount : 1));
+	if(columns == NULL)
+	{
+		Py_DECREF(properties);
+		return PyErr_NoMemory();
+	}
+	memset(columns,0,sizeof(PMI_Column) * columnCount);
+	for(index = 0; index < columnCount; index++)
+	{
+		columns[index].name = PyString_AsString(PyList_GET_ITEM(properties,index));
+		columns[index].values = PyList_New(0);
+		if(columns[index].name == NULL || columns[index].values == NULL)
+		{
+			goto cleanup;
+		}
+	}
+	MI_Operation miOperation = MI_OPERATION_NULL;
+	MI_Boolean moreResults = MI_TRUE;
+	PMI_ALLOW_THREADS(MI_Session_EnumerateInstances(&session->miSession,0,NULL,nameSpace,className,MI_FALSE,NULL,&miOperation));
+	while(moreResults == MI_TRUE)
+	{
+		const MI_Instance *miInstance = NULL;
+		const MI_Char *errorString = NULL;
+		const MI_Instance *errorDetails = NULL;
+		MI_Result miResult;
+		MI_Result _miResult;
+
+		PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation,&miInstance,&moreResults,&miResult,&errorString,&errorDetails));
+		if(_miResult != MI_RESULT_OK)
+		{
+			char error[errorBufferSize];
+			strcpy(error,"MI_Operation_GetInstance failed, error = ");
+			strcat(error,MI_Result_To_String(_miResult));
+			PyErr_SetString(MIError,error);
+			break;
+		}
+		if(moreResults == MI_FALSE && miResult != MI_RESULT_OK)
+		{
+			char error[errorBufferSize];
+			strcpy(error,"Operation failed, error = ");
+			strcat(error,MI_Result_To_String(miResult));
+			if(errorString != NULL)
+			{
+				strcat(error,", errorMessage = ");
+				strncat(error,errorString,errorBufferSize - strlen(error) - 1);
+			}
+			PyErr_SetString(MIError,error);
+			break;
+		}
+		if(miInstance == NULL)
+		{
+			continue;
+		}
+
+		PMI_OpStats *stats = currentOpStats;
+		double started = stats ? PMI_Clock() : 0;
+		for(index = 0; index < columnCount; index++)
+		{
+			MI_Value miValue;
+			MI_Type miType = MI_BOOLEAN;
+			MI_Uint32 miFlags = 0;
+			int present = MI_Instance_GetElement(miInstance,columns[index].name,&miValue,&miType,&miFlags,NULL) == MI_RESULT_OK && !(miFlags & MI_FLAG_NULL);
+			if(!AppendColumnValue(&columns[index],present ? &miValue : NULL,miType))
+			{
+				break;
+			}
+		}
+		if(stats)
+		{
+			stats->conversion += PMI_Clock() - started;
+			stats->instances += index == columnCount;
+		}
+		if(index < columnCount)
+		{
+			/* Stop the enumeration, the conversion error is raised below */
+			PMI_ALLOW_THREADS(MI_Operation_Cancel(&miOperation,MI_REASON_NONE));
+			break;
+		}
+		count++;
+	}
+	/* MI_Operation_Close waits for the results still queued of a cancelled or failed operation */
+	PMI_ALLOW_THREADS(MI_Operation_Close(&miOperation));
+	if(PyErr_Occurred())
+	{
+		goto cleanup;
+	}
+
+	result = PyDict_New();
+	for(index = 0; result != NULL && index < columnCount; index++)
+	{
+		PyObject *column = MakeColumnTuple(&columns[index],count);
+		if(column == NULL || PyDict_SetItem(result,PyList_GET_ITEM(properties,index),column) < 0)
+		{
+			Py_CLEAR(result);
+		}
+		Py_XDECREF(column);
+	}
+
+cleanup:
+	for(index = 0; index < columnCount; index++)
+	{
+		PyMem_Free(columns[index].data.data);
+		PyMem_Free(columns[index].valid.data);
+		Py_XDECREF(columns[index].values);
+	}
+	PyMem_Free(columns);
+	Py_DECREF(properties);
+	return result;
+}
+
+static PyObject* EnumerateInstances(PyObject* self, PyObject* args) 
+{
+    char *nameSpace,*className;
+
+    PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
+    if(!PyArg_ParseTuple(args,"ss",&nameSpace,&className))
+    {
+		PyErr_SetString(MIError,"Please input correct nameSpace and className");
+		return NULL;
+    }
+
+    MI_Session miSession = session->miSession;
+    MI_Operation miOperation = MI_OPERATION_NULL;
+    MI_Result miResult;
+    MI_Boolean moreResults;
+    const MI_Char* errorString = NULL;
+    const MI_Instance *errorDetails = NULL;
+    MI_Result _miResult;
+   
+    PMI_ALLOW_THREADS(MI_Session_EnumerateInstances(&miSession,0, NULL, nameSpace,className, MI_FALSE, NULL, &miOperation));
+    PyObject* instances = PyList_New(0);
+    do
+    {
+		const MI_Instance *miInstance;
+		MI_Result _miResult;
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation,&miInstance,&moreResults,&miResult,&errorString,&errorDetails));
+	
+		if(_miResult != MI_RESULT_OK)
+		{
+			/* Make sure the string buffer is big enough */
+			char error[errorBufferSize];
+			strcpy(error,"MI_Operation_GetInstance failed, error = ");
+			strcat(error,MI_Result_To_String(_miResult));
+	    	PyErr_SetString(MIError,error);
+	    	return NULL;
+		}
+		if(miInstance)
+		{
+			PMI_Instance *pmiInstance = WrapResultInstance(session,miInstance);
+			if(pmiInstance == NULL)
+			{
+				Py_DECREF(instances);
+				return NULL;
+			}
+			PyList_Append(instances,(PyObject *)pmiInstance);
+			Py_DECREF(pmiInstance);
+		}
+    }while (miResult == MI_RESULT_OK && moreResults ==MI_TRUE);
+
+    if(miResult != MI_RESULT_OK)
+    {
+		char error[errorBufferSize];
+		strcpy(error,"Operation failed, error = ");
+		strcat(error,MI_Result_To_String(miResult));
+		if(errorString != NULL)
+		{
+			strcat(error,", errorMessage = ");
+			strcat(error,errorString);
+		}
+		PyErr_SetString(MIError,error); 		
+		return NULL;
+    }
+    
+    _miResult = MI_Operation_Close(&miOperation);
+    
+    if(_miResult != MI_RESULT_OK)
+    {
+		char error[errorBufferSize];
+		strcpy(error,"MI_Operation_Close failed, error = ");
+		strcat(error,MI_Result_To_String(_miResult));
+		PyErr_SetString(MIError,error);
+		return NULL;
+    } 
+    Py_INCREF(instances);
+    return (PyObject *)instances;
+}
+
+
+/* Create a local instance of the class holding the values of propertyDict, or only its keys.
+   Returns NULL with an exception set on failure, the caller deletes the instance */
+static MI_Instance *CreateInboundInstance(PMI_Session *session, const MI_Char *namespaceName, const MI_Char *className, MI_Boolean keysOnly, PyObject *propertyDict)
+{
+    PMI_Class *pmiClass = NULL;
+    const MI_Class *miClass = NULL;
+    MI_Result miResult = 0;
+    MI_Application miApplication = MI_APPLICATION_NULL;
+    MI_Instance *miInstance = NULL;
+    MI_Uint32 numberElements = 0;
+    MI_Uint32 elementIndex;
+
+	/* The class declaration rarely changes, take it from the session cache instead of a GetClass round trip */
+	pmiClass = LookupClass(session, namespaceName, className);
+	if(pmiClass == NULL)
+	{
+		return NULL;
+	}
+	miClass = pmiClass->miClass;
+	
+	miResult = MI_Session_GetApplication(&session->miSession, &miApplication);
+	if(miResult != MI_RESULT_OK)
+	{
+		PyErr_SetString(MIError,"Failed to get the parent application of the session");
+		goto failedGetClass;
+	}
+
+	miResult = MI_Application_NewInstance(&miApplication,className,NULL,&miInstance);
+	if(miResult != MI_RESULT_OK)
+	{
+		PyErr_SetString(MIError,"Failed to create an instance");
+		goto failedGetClass;
+	}
+	
+	miResult = MI_Class_GetElementCount(miClass, &numberElements);
+	if(miResult != MI_RESULT_OK)
+	{
+		PyErr_SetString(MIError,"Failed to get element count from class");
+		goto failedGetClass;
+	}
+	
+	for (elementIndex = 0; elementIndex != numberElements; elementIndex++)
+    {
+        const MI_Char *elementName;
+        MI_Type elementType;
+        MI_Uint32 elementFlags;
+   
+        miResult = MI_Class_GetElementAt(miClass, elementIndex, &elementName, NULL, NULL, &elementType, NULL, NULL, &elementFlags);
+        if (miResult != MI_RESULT_OK)
+        {
+            PyErr_SetString(MIError,"Failed to get element details from class");
+            goto failedGetClass;
+        }
+
+        if (keysOnly && ((elementFlags & MI_FLAG_KEY) == 0))
+        {
+            continue;
+        }
+		//Iterate the dictionary and add property values to the instance
+		PyObject *key, *value;
+		Py_ssize_t pos = 0;
+		while (PyDict_Next(propertyDict, &pos, &key, &value))
+		{
+			MI_Value miValue;
+			char *propertyName;
+			PyObject *propertyValue;
+			//need to check if the value is array of single instance
+			if(!PyArg_Parse(key,"s",&propertyName))
+			{
+				PyErr_SetString(MIError,"property name not correct");
+				miResult = MI_RESULT_INVALID_PARAMETER;
+				goto failedGetClass;
+			}
+			if(!PyArg_Parse(value,"O",&propertyValue))
+			{
+				PyErr_SetString(MIError,"property value not correct");
+				miResult = MI_RESULT_INVALID_PARAMETER;
+				goto failedGetClass;
+			}
+
+			if(strcmp(propertyName,elementName)==0)
+			{
+			    SetPropertyValues(elementType,propertyValue, &miValue);
+			    miResult = MI_Instance_AddElement(miInstance,elementName,&miValue,elementType,elementFlags);
+			    if(miResult != MI_RESULT_OK)
+    			{
+					PyErr_SetString(MIError,"MI_Instance_SetElement failed");
+					goto failedGetClass;
+    			}
+			}
+		}   
+    }
+
+failedGetClass:
+
+	if ((miResult != MI_RESULT_OK) && miInstance)
+    {
+        MI_Instance_Delete(miInstance);
+    }
+    Py_DECREF(pmiClass);
+        
+    if (miResult != MI_RESULT_OK)
+    {
+        if (!PyErr_Occurred())
+        {
+            PyErr_SetString(MIError,"Failed to create the inbound instance");
+        }
+        return NULL;
+    }
+	
+    return miInstance;	
+}
+
+
+
+
+/* Take the pending exception and return its value, NULL if there is none */
+static PyObject *FetchErrorValue(void)
+{
+	PyObject *type, *value, *traceback;
+	PyErr_Fetch(&type,&value,&traceback);
+	if(type == NULL)
+	{
+		return NULL;
+	}
+	PyErr_NormalizeException(&type,&value,&traceback);
+	Py_XDECREF(type);
+	Py_XDECREF(traceback);
+	return value;
+}
+
+/* Create the mi.error instance for a failed operation, passed to callbacks instead of being raised */
+static PyObject *NewOperationError(MI_Result miResult, const MI_Char *errorString)
+{
+	char message[errorBufferSize];
+	PyObject *error;
+	strcpy(message,"Operation failed, error = ");
+	strcat(message,MI_Result_To_String(miResult));
+	if(errorString != NULL)
+	{
+		strcat(message,", errorMessage = ");
+		strncat(message,errorString,errorBufferSize - strlen(message) - 1);
+	}
+	error = PyObject_CallFunction(MIError,"s",message);
+	if(error == NULL)
+	{
+		PyErr_Clear();
+	}
+	return error;
+}
+
+static PyObject *JoinStrings(const char *separator, PyObject *strings)
+{
+	PyObject *joined;
+	PyObject *sep = PyString_FromString(separator);
+	if(sep == NULL)
+	{
+		return NULL;
+	}
+	joined = PyObject_CallMethod(sep,"join","O",strings);
+	Py_DECREF(sep);
+	return joined;
+}
+
+/*Defines a PMI_Operation Type Object for operations running in the MI asynchronous callback mode. The results are
+  handed to a Python callable from the MI client thread as they arrive so no Python thread waits on the server */
+typedef struct{
+    PyObject_HEAD
+    PyObject *session; /* keeps the session alive while the operation is running */
+    PyObject *callback;
+    MI_Operation miOperation;
+    MI_Instance *inboundInstance; /* key instance of a get operation, released once the operation is done */
+    int completed; /* set once the final result has been delivered, guarded by the GIL */
+    int cancelRequested; /* cancel() was called before the MI client set the operation handle */
+    int opType; /* PMI_OP_* the operation is measured as */
+    double started; /* PMI_Clock() when the operation was started with metrics enabled, 0 otherwise */
+} PMI_Operation;
+
+static PyTypeObject PMI_OperationType;
+
+static void PMI_Operation_dealloc(PMI_Operation *self)
+{
+	/* The operation holds a reference to itself until the final result, so it has always been closed here */
+	if(self->inboundInstance)
+	{
+		MI_Instance_Delete(self->inboundInstance);
+	}
+	Py_CLEAR(self->session);
+	Py_CLEAR(self->callback);
+	self->ob_type->tp_free((PyObject*) self);
+}
+
+/* Called by the MI client on its own thread for every result, callback(instance, moreResults, error) gets the
+   cloned instance or None and an mi.error instance or None once the operation failed */
+static void MI_CALL OperationInstanceResult(MI_Operation *miOperation, void *callbackContext, const MI_Instance *miInstance, MI_Boolean moreResults, MI_Result miResult, const MI_Char *errorString, const MI_Instance *errorDetails, MI_Result (MI_CALL *resultAcknowledgement)(MI_Operation *operation))
+{
+	PMI_Operation *operation = (PMI_Operation *)callbackContext;
+	PyGILState_STATE gilState = PyGILState_Ensure();
+	PMI_OpStats stats = {(PMI_Session *)operation->session, operation->opType, 0, 0, 0};
+	/* Set when the MI client delivers the result before the call starting the operation returns */
+	PMI_OpStats *previous = currentOpStats;
+	PyObject *instance = NULL;
+	PyObject *error = NULL;
+	PyObject *result;
+
+	if(miInstance)
+	{
+		currentOpStats = metricsEnabled ? &stats : NULL;
+		instance = (PyObject *)WrapResultInstance((PMI_Session *)operation->session,miInstance);
+		currentOpStats = previous;
+		if(instance == NULL)
+		{
+			PyErr_WriteUnraisable(operation->callback);
+		}
+	}
+	if(instance == NULL)
+	{
+		Py_INCREF(Py_None);
+		instance = Py_None;
+	}
+
+	if(moreResults == MI_FALSE && miResult != MI_RESULT_OK)
+	{
+		error = NewOperationError(miResult,errorString);
+	}
+	if(error == NULL)
+	{
+		Py_INCREF(Py_None);
+		error = Py_None;
+	}
+
+	if(moreResults == MI_FALSE)
+	{
+		operation->completed = 1;
+		/* The whole operation is one call, its network time runs from the start to the final result */
+		if(operation->started > 0)
+		{
+			stats.network = PMI_Clock() - operation->started;
+		}
+		RecordOpStats(&stats,1,error != Py_None ? 1 : 0);
+	}
+	else
+	{
+		RecordOpStats(&stats,0,0);
+	}
+	if(moreResults == MI_FALSE)
+	{
+		/* The MI client finishes with the operation once this callback returns. It is closed before the Python
+		   callback runs, so the callback can close the session */
+		PMI_ALLOW_THREADS(MI_Operation_Close(miOperation));
+		((PMI_Session *)operation->session)->openOperations--;
+	}
+	result = PyObject_CallFunction(operation->callback,"OOO",instance,moreResults ? Py_True : Py_False,error);
+	if(result == NULL)
+	{
+		PyErr_WriteUnraisable(operation->callback);
+	}
+	Py_XDECREF(result);
+	Py_DECREF(instance);
+	Py_DECREF(error);
+
+	if(moreResults == MI_FALSE)
+	{
+		Py_DECREF(operation);
+	}
+	PyGILState_Release(gilState);
+}
+
+static PyObject *CancelOperation(PyObject *self)
+{
+	PMI_Operation *operation = (PMI_Operation *)self;
+	if(!operation->completed && operation->miOperation.ft == NULL)
+	{
+		/* Still being started, StartedOperation cancels it once the call starting it returns */
+		operation->cancelRequested = 1;
+	}
+	else if(!operation->completed)
+	{
+		PMI_ALLOW_THREADS(MI_Operation_Cancel(&operation->miOperation,MI_REASON_NONE));
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *PMI_Operation_getdone(PMI_Operation *self, void *closure)
+{
+	return PyBool_FromLong(self->completed);
+}
+
+static PyMethodDef PMI_Operation_methods [] = {
+    {"cancel",(PyCFunction)CancelOperation,METH_NOARGS,"Cancel the operation, the callback still receives the final result"},
+    {NULL}
+};
+
+static PyGetSetDef PMI_Operation_getset [] = {
+    {"done",(getter)PMI_Operation_getdone,NULL,"True once the final result has been delivered to the callback",NULL},
+    {NULL}
+};
+
+static PyTypeObject PMI_OperationType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "PMI_Session.PMI_Operation",             /* tp_name */
+    sizeof(PMI_Operation), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)PMI_Operation_dealloc,     /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "MI operation running in the asynchronous callback mode",           /* tp_doc */
+    0,			       /* tp_traverse */
+    0,		               /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    PMI_Operation_methods,             /* tp_methods */
+    0,		               /* tp_members */
+    PMI_Operation_getset,    			/* tp_getset */
+};
+
+/* Create the operation object and the callbacks to pass to one of the MI_Session_* functions */
+static PMI_Operation *NewOperation(PyObject *session, PyObject *callback, int opType, MI_OperationCallbacks *callbacks)
+{
+	if(!PyCallable_Check(callback))
+	{
+		PyErr_SetString(MIError,"The callback must be callable");
+		return NULL;
+	}
+	PMI_Operation *operation = PyObject_New(PMI_Operation,&PMI_OperationType);
+	if(operation == NULL)
+	{
+		return NULL;
+	}
+	Py_INCREF(session);
+	operation->session = session;
+	Py_INCREF(callback);
+	operation->callback = callback;
+	operation->miOperation = (MI_Operation)MI_OPERATION_NULL;
+	operation->inboundInstance = NULL;
+	operation->completed = 0;
+	operation->cancelRequested = 0;
+	operation->opType = opType;
+	operation->started = metricsEnabled ? PMI_Clock() : 0;
+	((PMI_Session *)session)->openOperations++;
+
+	MI_OperationCallbacks _callbacks = MI_OPERATIONCALLBACKS_NULL;
+	_callbacks.callbackContext = operation;
+	_callbacks.instanceResult = OperationInstanceResult;
+	*callbacks = _callbacks;
+
+	/* Released by the final result callback */
+	Py_INCREF(operation);
+	return operation;
+}
+
+/* Apply a cancel() made by another thread while the call starting the operation was running without the GIL */
+static PyObject *StartedOperation(PMI_Operation *operation)
+{
+	if(operation->cancelRequested && !operation->completed)
+	{
+		PMI_ALLOW_THREADS(MI_Operation_Cancel(&operation->miOperation,MI_REASON_NONE));
+	}
+	return (PyObject *)operation;
+}
+
+static PyObject *BeginEnumerateInstances(PyObject *self, PyObject *args)
+{
+	char *nameSpace,*className;
+	PyObject *callback;
+	if(!PyArg_ParseTuple(args,"ssO",&nameSpace,&className,&callback))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace, className and callback");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	MI_OperationCallbacks callbacks;
+	PMI_Operation *operation = NewOperation(self,callback,PMI_OP_ENUMERATE,&callbacks);
+	if(operation == NULL)
+	{
+		return NULL;
+	}
+	/* Started with the handle in the operation, the MI client sets it before any callback can run */
+	PMI_ALLOW_THREADS(MI_Session_EnumerateInstances(&session->miSession,0,NULL,nameSpace,className,MI_FALSE,&callbacks,&operation->miOperation));
+	return StartedOperation(operation);
+}
+
+static PyObject *BeginQuery(PyObject *self, PyObject *args)
+{
+	char *nameSpace, *queryDialect, *queryExpression;
+	PyObject *callback;
+	if(!PyArg_ParseTuple(args,"sssO",&nameSpace,&queryDialect,&queryExpression,&callback))
+	{
+		PyErr_SetString(MIError,"Please input the correct arguments for query operation");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	MI_OperationCallbacks callbacks;
+	PMI_Operation *operation = NewOperation(self,callback,PMI_OP_QUERY,&callbacks);
+	if(operation == NULL)
+	{
+		return NULL;
+	}
+	PMI_ALLOW_THREADS(MI_Session_QueryInstances(&session->miSession,0,NULL,nameSpace,queryDialect,queryExpression,&callbacks,&operation->miOperation));
+	return StartedOperation(operation);
+}
+
+static PyObject *BeginGetInstance(PyObject *self, PyObject *args)
+{
+	char *nameSpace,*className;
+	PyObject *propertyDict;
+	PyObject *callback;
+	if(!PyArg_ParseTuple(args,"ssO!O",&nameSpace,&className,&PyDict_Type,&propertyDict,&callback))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace, className, keys and callback");
+		return NULL;
+	}
+
+	PMI_Session *session = (PMI_Session*) self;
+	if(!CheckSessionOpen(session))
+	{
+		return NULL;
+	}
+	MI_Instance *keyInstance = CreateInboundInstance(session, nameSpace, className, MI_TRUE, propertyDict);
+	if(keyInstance == NULL)
+	{
+		return NULL;
+	}
+
+	MI_OperationCallbacks callbacks;
+	PMI_Operation *operation = NewOperation(self,callback,PMI_OP_GET,&callbacks);
+	if(operation == NULL)
+	{
+		MI_Instance_Delete(keyInstance);
+		return NULL;
+	}
+	operation->inboundInstance = keyInstance;
+	PMI_ALLOW_THREADS(MI_Session_GetInstance(&session->miSession,0,NULL,nameSpace,keyInstance,&callbacks,&operation->miOperation));
+	return StartedOperation(operation);
+}
+
+
+/* Operations run by a PMI_BatchIterator */
+#define PMI_BATCH_GET 0
+#define PMI_BATCH_CREATE 1
+#define PMI_BATCH_MODIFY 2
+#define PMI_BATCH_DELETE 3
+
+/*Defines a PMI_BatchIterator Type Object which runs one operation per item in the MI asynchronous callback mode,
+  at most window of them at a time, and yields (item, instance, error) tuples in the order they complete */
+typedef struct{
+    PyObject_HEAD
+    PyObject *session;
+    PyObject *nameSpace;
+    PyObject *className;
+    int operationType; /* PMI_BATCH_* */
+    PyObject *items; /* key dictionaries, property dictionaries or PMI_Instance objects */
+    Py_ssize_t nextIndex;
+    long window;
+    long inFlight; /* operations started and not completed, changed with both the GIL and lock held */
+    PyObject *results; /* completed tuples not yet returned, guarded by the GIL */
+    PyObject *outcomes; /* bulk operations only: the completed tuples in the order of the items */
+    PyObject *keyNames; /* collapsed query only: sorted key property names */
+    PyObject *pendingKeys; /* collapsed query only: key values tuple -> key dictionary with no instance yet */
+    pthread_mutex_t lock;
+    pthread_cond_t completed;
+    long ready; /* results appended or operations completed since the consumer last waited, guarded by lock */
+    int busy; /* set while a thread is waiting for results without the GIL */
+    struct _PMI_BatchOperation *running; /* operations started and not completed, guarded by the GIL */
+} PMI_BatchIterator;
+
+/* Context of one running operation, freed by its final result callback */
+typedef struct _PMI_BatchOperation{
+    MI_Operation miOperation;
+    struct _PMI_BatchOperation *next; /* in the running list of the iterator */
+    struct _PMI_BatchOperation **previous;
+    PMI_BatchIterator *iterator; /* owns a reference to the iterator */
+    PyObject *item; /* NULL for a collapsed query */
+    Py_ssize_t index;
+    MI_Instance *inboundInstance; /* created from a dictionary item, deleted with the operation */
+    PyObject *instance;
+    PyObject *error; /* set when the result could not be converted */
+} PMI_BatchOperation;
+
+static PyTypeObject PMI_BatchIteratorType;
+
+/* PMI_OP_* the operations of a batch are measured as */
+static int BatchOpType(PMI_BatchIterator *iterator)
+{
+	switch(iterator->operationType)
+	{
+	case PMI_BATCH_CREATE:
+		return PMI_OP_CREATE;
+	case PMI_BATCH_MODIFY:
+		return PMI_OP_MODIFY;
+	case PMI_BATCH_DELETE:
+		return PMI_OP_DELETE;
+	default:
+		return PMI_OP_GET;
+	}
+}
+
+static void PMI_BatchIterator_dealloc(PMI_BatchIterator *self)
+{
+	/* Every running operation holds a reference, so there is none left here */
+	Py_CLEAR(self->session);
+	Py_CLEAR(self->nameSpace);
+	Py_CLEAR(self->className);
+	Py_CLEAR(self->items);
+	Py_CLEAR(self->results);
+	Py_CLEAR(self->outcomes);
+	Py_CLEAR(self->keyNames);
+	Py_CLEAR(self->pendingKeys);
+	pthread_mutex_destroy(&self->lock);
+	pthread_cond_destroy(&self->completed);
+	self->ob_type->tp_free((PyObject*) self);
+}
+
+/* Queue an (item, instance, error) tuple for the consumer and wake it up, instance and error may be NULL */
+static void AppendBatchResult(PMI_BatchIterator *iterator, Py_ssize_t index, PyObject *item, PyObject *instance, PyObject *error)
+{
+	PyObject *result = Py_BuildValue("(OOO)",item,instance ? instance : Py_None,error ? error : Py_None);
+	if(result == NULL)
+	{
+		PyErr_WriteUnraisable((PyObject *)iterator);
+	}
+	else if(iterator->outcomes != NULL)
+	{
+		/* Steals the reference */
+		PyList_SetItem(iterator->outcomes,index,result);
+	}
+	else
+	{
+		if(PyList_Append(iterator->results,result) < 0)
+		{
+			PyErr_WriteUnraisable((PyObject *)iterator);
+		}
+		Py_DECREF(result);
+	}
+
+	pthread_mutex_lock(&iterator->lock);
+	iterator->ready++;
+	pthread_cond_signal(&iterator->completed);
+	pthread_mutex_unlock(&iterator->lock);
+}
+
+/* Add an operation to the running list of the iterator so it can be cancelled, or remove it once completed */
+static void LinkBatchOperation(PMI_BatchIterator *iterator, PMI_BatchOperation *operation)
+{
+	operation->next = iterator->running;
+	operation->previous = &iterator->running;
+	if(iterator->running != NULL)
+	{
+		iterator->running->previous = &operation->next;
+	}
+	iterator->running = operation;
+}
+
+static void UnlinkBatchOperation(PMI_BatchOperation *operation)
+{
+	*operation->previous = operation->next;
+	if(operation->next != NULL)
+	{
+		operation->next->previous = operation->previous;
+	}
+}
+
+/* Count an operation as started, or as completed and wake up the consumer so it can see nothing is left to wait for */
+static void CountBatchOperation(PMI_BatchIterator *iterator, long change)
+{
+	pthread_mutex_lock(&iterator->lock);
+	iterator->inFlight += change;
+	if(change < 0)
+	{
+		iterator->ready++;
+		pthread_cond_signal(&iterator->completed);
+	}
+	pthread_mutex_unlock(&iterator->lock);
+}
+
+/* Class and property names are put in the collapsed query as they are, so only plain WQL identifiers are accepted */
+static int IsWqlIdentifier(PyObject *name)
+{
+	const char *c;
+	if(!PyString_Check(name))
+	{
+		return 0;
+	}
+	c = PyString_AS_STRING(name);
+	if(!(isalpha((unsigned char)*c) || *c == '_'))
+	{
+		return 0;
+	}
+	for(c++; *c; c++)
+	{
+		if(!(isalnum((unsigned char)*c) || *c == '_'))
+		{
+			return 0;
+		}
+	}
+	return 1;
+}
+
+/* Convert a requested key value to the type the class declares for the key, so that it compares equal to the
+   value the returned instance has, NULL if the value cannot be converted */
+static PyObject *ConvertKeyValue(PyObject *value, MI_Type type)
+{
+	switch(type)
+	{
+	case MI_BOOLEAN:
+		if(PyString_Check(value))
+		{
+			PyObject *folded = PyObject_CallMethod(value,"lower",NULL);
+			PyObject *converted = NULL;
+			if(folded == NULL)
+			{
+				return NULL;
+			}
+			if(strcmp(PyString_AsString(folded),"true") == 0 || strcmp(PyString_AsString(folded),"1") == 0)
+			{
+				converted = PyBool_FromLong(1);
+			}
+			else if(strcmp(PyString_AsString(folded),"false") == 0 || strcmp(PyString_AsString(folded),"0") == 0)
+			{
+				converted = PyBool_FromLong(0);
+			}
+			Py_DECREF(folded);
+			if(converted != NULL)
+			{
+				return converted;
+			}
+		}
+		else if(PyInt_Check(value) || PyLong_Check(value))
+		{
+			return PyBool_FromLong(PyObject_IsTrue(value));
+		}
+		break;
+	case MI_UINT8:
+	case MI_SINT8:
+	case MI_UINT16:
+	case MI_SINT16:
+	case MI_UINT32:
+	case MI_SINT32:
+	case MI_UINT64:
+	case MI_SINT64:
+		if(PyInt_Check(value) || PyLong_Check(value) || PyString_Check(value) || PyUnicode_Check(value))
+		{
+			return PyNumber_Long(value);
+		}
+		break;
+	case MI_STRING:
+		if(PyString_Check(value) || PyUnicode_Check(value))
+		{
+			Py_INCREF(value);
+			return value;
+		}
+		if(!PyBool_Check(value) && (PyInt_Check(value) || PyLong_Check(value)))
+		{
+			return PyObject_Str(value);
+		}
+		break;
+	default:
+		Py_INCREF(value);
+		return value;
+	}
+	PyErr_SetString(PyExc_TypeError,"The key value does not match the type of the key property");
+	return NULL;
+}
+
+/* Build the key values tuple used to match instances of a collapsed query from the converted requested values
+   or from a returned instance, NULL if a key is missing.
+   String values are compared in lower case like the server compares them in the WHERE clause */
+static PyObject *BatchKeyValues(PMI_BatchIterator *iterator, PyObject *keys, const MI_Instance *miInstance)
+{
+	Py_ssize_t count = PyList_GET_SIZE(iterator->keyNames);
+	Py_ssize_t index;
+	PyObject *values = PyTuple_New(count);
+	if(values == NULL)
+	{
+		return NULL;
+	}
+	for(index = 0; index < count; index++)
+	{
+		PyObject *name = PyList_GET_ITEM(iterator->keyNames,index);
+		PyObject *value = NULL;
+		if(keys != NULL)
+		{
+			value = PyTuple_GET_ITEM(keys,index);
+			Py_INCREF(value);
+		}
+		else
+		{
+			MI_Value miValue;
+			MI_Type miType;
+			MI_Uint32 miFlags;
+			if(MI_Instance_GetElement(miInstance,PyString_AsString(name),&miValue,&miType,&miFlags,NULL) == MI_RESULT_OK)
+			{
+				if(miFlags & MI_FLAG_NULL)
+				{
+					Py_INCREF(Py_None);
+					value = Py_None;
+				}
+				else
+				{
+					value = Get_Element_Value(&miValue,miType,0);
+				}
+			}
+		}
+		if(value != NULL && (PyString_Check(value) || PyUnicode_Check(value)))
+		{
+			PyObject *folded = PyObject_CallMethod(value,"lower",NULL);
+			Py_DECREF(value);
+			value = folded;
+		}
+		if(value == NULL)
+		{
+			PyErr_Clear();
+			Py_DECREF(values);
+			return NULL;
+		}
+		PyTuple_SET_ITEM(values,index,value);
+	}
+	return values;
+}
+
+/* Hand an instance of a collapsed query to the key dictionary it was requested with */
+static void MatchCollapsedInstance(PMI_BatchIterator *iterator, const MI_Instance *miInstance)
+{
+	PyObject *values = BatchKeyValues(iterator,NULL,miInstance);
+	PyObject *keys;
+	if(values == NULL)
+	{
+		return;
+	}
+	keys = PyDict_GetItem(iterator->pendingKeys,values);
+	if(keys != NULL)
+	{
+		PyObject *instance = (PyObject *)WrapResultInstance((PMI_Session *)iterator->session,miInstance);
+		PyObject *error = NULL;
+		if(instance == NULL)
+		{
+			error = FetchErrorValue();
+		}
+		Py_INCREF(keys);
+		PyDict_DelItem(iterator->pendingKeys,values);
+		AppendBatchResult(iterator,-1,keys,instance,error);
+		Py_DECREF(keys);
+		Py_XDECREF(instance);
+		Py_XDECREF(error);
+	}
+	PyErr_Clear();
+	Py_DECREF(values);
+}
+
+static void MI_CALL BatchInstanceResult(MI_Operation *miOperation, void *callbackContext, const MI_Instance *miInstance, MI_Boolean moreResults, MI_Result miResult, const MI_Char *errorString, const MI_Instance *errorDetails, MI_Result (MI_CALL *resultAcknowledgement)(MI_Operation *operation))
+{
+	PMI_BatchOperation *operation = (PMI_BatchOperation *)callbackContext;
+	PMI_BatchIterator *iterator = operation->iterator;
+	PyGILState_STATE gilState = PyGILState_Ensure();
+	PMI_OpStats stats = {(PMI_Session *)iterator->session, BatchOpType(iterator), 0, 0, 0};
+	/* Set when the MI client delivers the result before the call starting the operation returns */
+	PMI_OpStats *previous = currentOpStats;
+	PyObject *error;
+
+	currentOpStats = metricsEnabled ? &stats : NULL;
+	if(miInstance)
+	{
+		if(operation->item == NULL)
+		{
+			MatchCollapsedInstance(iterator,miInstance);
+		}
+		else if(operation->instance == NULL && operation->error == NULL)
+		{
+			operation->instance = (PyObject *)WrapResultInstance((PMI_Session *)iterator->session,miInstance);
+			if(operation->instance == NULL)
+			{
+				operation->error = FetchErrorValue();
+			}
+		}
+	}
+	currentOpStats = previous;
+	if(moreResults == MI_TRUE)
+	{
+		RecordOpStats(&stats,0,0);
+		PyGILState_Release(gilState);
+		return;
+	}
+
+	error = operation->error;
+	operation->error = NULL;
+	if(error == NULL && miResult != MI_RESULT_OK)
+	{
+		error = NewOperationError(miResult,errorString);
+	}
+	RecordOpStats(&stats,0,error != NULL ? 1 : 0);
+	if(operation->item != NULL)
+	{
+		AppendBatchResult(iterator,operation->index,operation->item,operation->instance,error);
+	}
+	else
+	{
+		/* Keys without an instance in the query result don't exist, or the query failed */
+		PyObject *values, *keys;
+		Py_ssize_t pos = 0;
+		if(error == NULL)
+		{
+			error = NewOperationError(MI_RESULT_NOT_FOUND,NULL);
+		}
+		while(PyDict_Next(iterator->pendingKeys,&pos,&values,&keys))
+		{
+			AppendBatchResult(iterator,-1,keys,NULL,error);
+		}
+		PyDict_Clear(iterator->pendingKeys);
+	}
+	Py_XDECREF(error);
+
+	UnlinkBatchOperation(operation);
+	PMI_ALLOW_THREADS(MI_Operation_Close(miOperation));
+	((PMI_Session *)iterator->session)->openOperations--;
+	if(operation->inboundInstance)
+	{
+		MI_Instance_Delete(operation->inboundInstance);
+	}
+	Py_XDECREF(operation->item);
+	Py_XDECREF(operation->instance);
+	PyMem_Free(operation);
+	CountBatchOperation(iterator,-1);
+	Py_DECREF(iterator);
+	PyGILState_Release(gilState);
+}
+
+/* Start the operation for the next item, an item that cannot be sent is reported as its result */
+static void StartBatchOperation(PMI_BatchIterator *iterator)
+{
+	PMI_Session *session = (PMI_Session *)iterator->session;
+	Py_ssize_t index = iterator->nextIndex++;
+	PyObject *item = PyList_GET_ITEM(iterator->items,index);
+	const MI_Instance *miInstance = NULL;
+	MI_Instance *inboundInstance = NULL;
+	const char *nameSpace = PyString_AsString(iterator->nameSpace);
+
+	if(!CheckSessionOpen(session))
+	{
+		/* The error is reported below */
+	}
+	else if(PyObject_TypeCheck(item,&PMI_InstanceType) && ((PMI_Instance *)item)->miInstance != NULL)
+	{
+		miInstance = ((PMI_Instance *)item)->miInstance;
+	}
+	else if(!PyDict_Check(item))
+	{
+		PyErr_SetString(MIError,"Each item must be a dictionary or an MI instance");
+	}
+	else if(iterator->className == Py_None)
+	{
+		PyErr_SetString(MIError,"The className is required for dictionary items");
+	}
+	else
+	{
+		/* Get and delete only send the keys, create and modify send every property */
+		MI_Boolean keysOnly = (iterator->operationType == PMI_BATCH_GET || iterator->operationType == PMI_BATCH_DELETE) ? MI_TRUE : MI_FALSE;
+		inboundInstance = CreateInboundInstance(session,nameSpace,PyString_AsString(iterator->className),keysOnly,item);
+		miInstance = inboundInstance;
+		/* The class lookup can give up the GIL, so the session may have been closed meanwhile */
+		if(miInstance != NULL && !CheckSessionOpen(session))
+		{
+			miInstance = NULL;
+		}
+	}
+
+	PMI_BatchOperation *operation = NULL;
+	if(miInstance != NULL)
+	{
+		operation = (PMI_BatchOperation *)PyMem_Malloc(sizeof(PMI_BatchOperation));
+		if(operation == NULL)
+		{
+			PyErr_NoMemory();
+		}
+	}
+	if(operation == NULL)
+	{
+		PyObject *error = FetchErrorValue();
+		if(inboundInstance)
+		{
+			MI_Instance_Delete(inboundInstance);
+		}
+		AppendBatchResult(iterator,index,item,NULL,error);
+		Py_XDECREF(error);
+		return;
+	}
+	Py_INCREF(iterator);
+	operation->iterator = iterator;
+	Py_INCREF(item);
+	operation->item = item;
+	operation->index = index;
+	operation->inboundInstance = inboundInstance;
+	operation->instance = NULL;
+	operation->error = NULL;
+
+	MI_OperationCallbacks callbacks = MI_OPERATIONCALLBACKS_NULL;
+	callbacks.callbackContext = operation;
+	callbacks.instanceResult = BatchInstanceResult;
+	/* The MI client sets the handle before any callback can run, the final result callback frees the operation */
+	MI_Operation *miOperation = &operation->miOperation;
+	memset(miOperation,0,sizeof(MI_Operation));
+	LinkBatchOperation(iterator,operation);
+	CountBatchOperation(iterator,1);
+	session->openOperations++;
+	switch(iterator->operationType)
+	{
+	case PMI_BATCH_CREATE:
+		PMI_ALLOW_THREADS(MI_Session_CreateInstance(&session->miSession,0,NULL,nameSpace,miInstance,&callbacks,miOperation));
+		break;
+	case PMI_BATCH_MODIFY:
+		PMI_ALLOW_THREADS(MI_Session_ModifyInstance(&session->miSession,0,NULL,nameSpace,miInstance,&callbacks,miOperation));
+		break;
+	case PMI_BATCH_DELETE:
+		PMI_ALLOW_THREADS(MI_Session_DeleteInstance(&session->miSession,0,NULL,nameSpace,miInstance,&callbacks,miOperation));
+		break;
+	default:
+		PMI_ALLOW_THREADS(MI_Session_GetInstance(&session->miSession,0,NULL,nameSpace,miInstance,&callbacks,miOperation));
+		break;
+	}
+}
+
+/* Start one query returning the instances of all the keys, returns 0 if the keys cannot be expressed in WQL */
+static int StartCollapsedQuery(PMI_BatchIterator *iterator)
+{
+	PMI_Session *session = (PMI_Session *)iterator->session;
+	Py_ssize_t count = PyList_GET_SIZE(iterator->items);
+	Py_ssize_t index, nameIndex;
+	PyObject *clauses = NULL, *conditions = NULL, *query = NULL, *converted = NULL;
+	PyObject *keyNames, *pendingKeys;
+	PMI_Class *pmiClass = NULL;
+	MI_Type *keyTypes = NULL;
+	int collapsed = 0;
+
+	if(count == 0 || !PyDict_Check(PyList_GET_ITEM(iterator->items,0)) || !IsWqlIdentifier(iterator->className))
+	{
+		return 0;
+	}
+	keyNames = PyDict_Keys(PyList_GET_ITEM(iterator->items,0));
+	pendingKeys = PyDict_New();
+	clauses = PyList_New(0);
+	if(keyNames == NULL || pendingKeys == NULL || clauses == NULL || PyList_GET_SIZE(keyNames) == 0 || PyList_Sort(keyNames) < 0)
+	{
+		goto done;
+	}
+	for(nameIndex = 0; nameIndex < PyList_GET_SIZE(keyNames); nameIndex++)
+	{
+		if(!IsWqlIdentifier(PyList_GET_ITEM(keyNames,nameIndex)))
+		{
+			goto done;
+		}
+	}
+	iterator->keyNames = keyNames;
+
+	/* The key values are converted to the declared key types, so that "5" and 5 ask for the same instance */
+	pmiClass = LookupClass(session,PyString_AsString(iterator->nameSpace),PyString_AsString(iterator->className));
+	keyTypes = (MI_Type *)PyMem_Malloc(PyList_GET_SIZE(keyNames) * sizeof(MI_Type));
+	/* The class lookup can give up the GIL, so the session may have been closed meanwhile */
+	if(pmiClass == NULL || keyTypes == NULL || !CheckSessionOpen(session))
+	{
+		goto done;
+	}
+	for(nameIndex = 0; nameIndex < PyList_GET_SIZE(keyNames); nameIndex++)
+	{
+		if(MI_Class_GetElement(pmiClass->miClass,PyString_AsString(PyList_GET_ITEM(keyNames,nameIndex)),NULL,NULL,&keyTypes[nameIndex],NULL,NULL,NULL,NULL) != MI_RESULT_OK)
+		{
+			goto done;
+		}
+	}
+
+	for(index = 0; index < count; index++)
+	{
+		PyObject *keys = PyList_GET_ITEM(iterator->items,index);
+		PyObject *values, *clause;
+		/* Every dictionary needs the same key properties with a simple value, and each key set can only be asked once */
+		if(!PyDict_Check(keys) || PyDict_Size(keys) != PyList_GET_SIZE(keyNames))
+		{
+			goto done;
+		}
+		converted = PyTuple_New(PyList_GET_SIZE(keyNames));
+		if(converted == NULL)
+		{
+			goto done;
+		}
+		for(nameIndex = 0; nameIndex < PyList_GET_SIZE(keyNames); nameIndex++)
+		{
+			PyObject *value = PyDict_GetItem(keys,PyList_GET_ITEM(keyNames,nameIndex));
+			if(value == NULL || (value = ConvertKeyValue(value,keyTypes[nameIndex])) == NULL)
+			{
+				goto done;
+			}
+			PyTuple_SET_ITEM(converted,nameIndex,value);
+		}
+		values = BatchKeyValues(iterator,converted,NULL);
+		if(values == NULL || PyDict_GetItem(pendingKeys,values) != NULL || PyDict_SetItem(pendingKeys,values,keys) < 0)
+		{
+			Py_XDECREF(values);
+			goto done;
+		}
+		Py_DECREF(values);
+
+		conditions = PyList_New(0);
+		if(conditions == NULL)
+		{
+			goto done;
+		}
+		for(nameIndex = 0; nameIndex < PyList_GET_SIZE(keyNames); nameIndex++)
+		{
+			PyObject *name = PyList_GET_ITEM(keyNames,nameIndex);
+			PyObject *value = PyTuple_GET_ITEM(converted,nameIndex);
+			PyObject *literal, *condition;
+			if(PyBool_Check(value))
+			{
+				literal = PyString_FromString(value == Py_True ? "TRUE" : "FALSE");
+			}
+			else if(PyInt_Check(value) || PyLong_Check(value))
+			{
+				literal = PyObject_Str(value);
+			}
+			else if(PyString_Check(value))
+			{
+				literal = PyObject_CallMethod(value,"replace","ss","\\","\\\\");
+				if(literal != NULL)
+				{
+					PyObject *escaped = PyObject_CallMethod(literal,"replace","ss","'","\\'");
+					Py_DECREF(literal);
+					literal = escaped;
+				}
+				if(literal != NULL)
+				{
+					PyObject *quoted = PyString_FromFormat("'%s'",PyString_AsString(literal));
+					Py_DECREF(literal);
+					literal = quoted;
+				}
+			}
+			else
+			{
+				goto done;
+			}
+			if(literal == NULL)
+			{
+				goto done;
+			}
+			condition = PyString_FromFormat("%s = %s",PyString_AsString(name),PyString_AsString(literal));
+			Py_DECREF(literal);
+			if(condition == NULL || PyList_Append(conditions,condition) < 0)
+			{
+				Py_XDECREF(condition);
+				goto done;
+			}
+			Py_DECREF(condition);
+		}
+		clause = JoinStrings(" AND ",conditions);
+		Py_CLEAR(conditions);
+		Py_CLEAR(converted);
+		if(clause == NULL || PyList_Append(clauses,clause) < 0)
+		{
+			Py_XDECREF(clause);
+			goto done;
+		}
+		Py_DECREF(clause);
+	}
+
+	{
+		PyObject *filter = JoinStrings(") OR (",clauses);
+		if(filter == NULL)
+		{
+			goto done;
+		}
+		query = PyString_FromFormat("SELECT * FROM %s WHERE (%s)",PyString_AsString(iterator->className),PyString_AsString(filter));
+		Py_DECREF(filter);
+		if(query == NULL)
+		{
+			goto done;
+		}
+	}
+
+	PMI_BatchOperation *operation = (PMI_BatchOperation *)PyMem_Malloc(sizeof(PMI_BatchOperation));
+	if(operation == NULL)
+	{
+		goto done;
+	}
+	Py_INCREF(iterator);
+	operation->iterator = iterator;
+	operation->item = NULL;
+	operation->index = -1;
+	operation->inboundInstance = NULL;
+	operation->instance = NULL;
+	operation->error = NULL;
+	iterator->pendingKeys = pendingKeys;
+	pendingKeys = NULL;
+	iterator->nextIndex = count;
+	collapsed = 1;
+
+	MI_OperationCallbacks callbacks = MI_OPERATIONCALLBACKS_NULL;
+	callbacks.callbackContext = operation;
+	callbacks.instanceResult = BatchInstanceResult;
+	memset(&operation->miOperation,0,sizeof(MI_Operation));
+	LinkBatchOperation(iterator,operation);
+	CountBatchOperation(iterator,1);
+	session->openOperations++;
+	PMI_ALLOW_THREADS(MI_Session_QueryInstances(&session->miSession,0,NULL,PyString_AsString(iterator->nameSpace),"WQL",PyString_AsString(query),&callbacks,&operation->miOperation));
+
+done:
+	PyErr_Clear();
+	if(!collapsed)
+	{
+		iterator->keyNames = NULL;
+		Py_XDECREF(keyNames);
+	}
+	Py_XDECREF(pendingKeys);
+	Py_XDECREF(clauses);
+	Py_XDECREF(conditions);
+	Py_XDECREF(converted);
+	Py_XDECREF(query);
+	Py_XDECREF(pmiClass);
+	PyMem_Free(keyTypes);
+	return collapsed;
+}
+
+static PyObject *NextBatchResult(PMI_BatchIterator *self)
+{
+	for(;;)
+	{
+		while(self->inFlight < self->window && self->nextIndex < PyList_GET_SIZE(self->items))
+		{
+			StartBatchOperation(self);
+		}
+		if(PyList_GET_SIZE(self->results) > 0)
+		{
+			PyObject *result = PyList_GET_ITEM(self->results,0);
+			Py_INCREF(result);
+			PyList_SetSlice(self->results,0,1,NULL);
+			return result;
+		}
+		if(self->inFlight == 0)
+		{
+			/* Returning NULL without an exception set raises StopIteration */
+			return NULL;
+		}
+		/* Wait for a callback to queue a result or complete an operation, the callbacks need the GIL to do so.
+		   inFlight is tested under the lock too, the last operation can complete before this thread gets to wait */
+		PMI_ALLOW_THREADS(
+			pthread_mutex_lock(&self->lock);
+			while(self->ready == 0 && self->inFlight > 0)
+			{
+				pthread_cond_wait(&self->completed,&self->lock);
+			}
+			self->ready = 0;
+			pthread_mutex_unlock(&self->lock));
+	}
+}
+
+static PyObject *PMI_BatchIterator_next(PMI_BatchIterator *self)
+{
+	PyObject *result;
+	if(self->busy)
+	{
+		PyErr_SetString(MIError,"The iterator is already being read by another thread");
+		return NULL;
+	}
+	self->busy = 1;
+	if(metricsEnabled)
+	{
+		PMI_OpStats stats = {(PMI_Session *)self->session, BatchOpType(self), 0, 0, 0};
+		PMI_OpStats *previous = currentOpStats;
+		currentOpStats = &stats;
+		result = NextBatchResult(self);
+		currentOpStats = previous;
+		RecordOpStats(&stats,0,0);
+	}
+	else
+	{
+		result = NextBatchResult(self);
+	}
+	self->busy = 0;
+	return result;
+}
+
+/* Start no more operations and cancel the running ones, their results are still returned */
+static PyObject *CancelBatch(PMI_BatchIterator *self)
+{
+	PMI_BatchOperation *operation;
+	MI_Operation *runningOperations = NULL;
+	Py_ssize_t runningCount = 0, index = 0;
+	for(operation = self->running; operation != NULL; operation = operation->next)
+	{
+		runningCount++;
+	}
+	if(runningCount > 0)
+	{
+		runningOperations = (MI_Operation *)PyMem_Malloc(runningCount * sizeof(MI_Operation));
+		if(runningOperations == NULL)
+		{
+			return PyErr_NoMemory();
+		}
+	}
+	self->nextIndex = PyList_GET_SIZE(self->items);
+	/* The callbacks of the operations wait for the GIL, so it is released while cancelling. They free the operations
+	   meanwhile, so the handles are copied first, a handle closed by then is a stale thunk handle the MI client rejects */
+	for(operation = self->running; operation != NULL; operation = operation->next)
+	{
+		runningOperations[index++] = operation->miOperation;
+	}
+	if(runningCount > 0)
+	{
+		PMI_ALLOW_THREADS(
+			for(index = 0; index < runningCount; index++)
+			{
+				MI_Operation_Cancel(&runningOperations[index],MI_REASON_NONE);
+			});
+		PyMem_Free(runningOperations);
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *CloseBatch(PMI_BatchIterator *self)
+{
+	PyObject *cancelled;
+	if(self->busy)
+	{
+		PyErr_SetString(MIError,"The iterator is already being read by another thread");
+		return NULL;
+	}
+	cancelled = CancelBatch(self);
+	if(cancelled == NULL)
+	{
+		return NULL;
+	}
+	Py_DECREF(cancelled);
+	/* Wait for the final result of every running operation so none is left once the session is closed */
+	self->busy = 1;
+	PMI_ALLOW_THREADS(
+		pthread_mutex_lock(&self->lock);
+		while(self->inFlight > 0)
+		{
+			pthread_cond_wait(&self->completed,&self->lock);
+		}
+		self->ready = 0;
+		pthread_mutex_unlock(&self->lock));
+	self->busy = 0;
+	if(PyList_SetSlice(self->results,0,PyList_GET_SIZE(self->results),NULL) < 0)
+	{
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyMethodDef PMI_BatchIterator_methods [] = {
+    {"cancel",(PyCFunction)CancelBatch,METH_NOARGS,"Start no more operations and cancel the running ones, the results of the operations already started are still returned"},
+    {"close",(PyCFunction)CloseBatch,METH_NOARGS,"Cancel the operations, wait for them to complete and discard any results that have not been read"},
+    {NULL}
+};
+
+static PyTypeObject PMI_BatchIteratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "PMI_Session.PMI_BatchIterator",             /* tp_name */
+    sizeof(PMI_BatchIterator), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)PMI_BatchIterator_dealloc,     /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Iterator over the results of get_instances in completion order",           /* tp_doc */
+    0,			       /* tp_traverse */
+    0,		               /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    PyObject_SelfIter,         /* tp_iter */
+    (iternextfunc)PMI_BatchIterator_next,   /* tp_iternext */
+    PMI_BatchIterator_methods,             /* tp_methods */
+};
+
+static PMI_BatchIterator *NewBatchIterator(PyObject *session, const char *nameSpace, const char *className, int operationType, PyObject *items, long window)
+{
+	if(window < 1)
+	{
+		PyErr_SetString(MIError,"The window must be at least 1");
+		return NULL;
+	}
+	if(!CheckSessionOpen((PMI_Session *)session))
+	{
+		return NULL;
+	}
+	items = PySequence_List(items);
+	if(items == NULL)
+	{
+		return NULL;
+	}
+
+	PMI_BatchIterator *iterator = PyObject_New(PMI_BatchIterator,&PMI_BatchIteratorType);
+	if(iterator == NULL)
+	{
+		Py_DECREF(items);
+		return NULL;
+	}
+	Py_INCREF(session);
+	iterator->session = session;
+	iterator->nameSpace = PyString_FromString(nameSpace);
+	if(className != NULL)
+	{
+		iterator->className = PyString_FromString(className);
+	}
+	else
+	{
+		Py_INCREF(Py_None);
+		iterator->className = Py_None;
+	}
+	iterator->operationType = operationType;
+	iterator->items = items;
+	iterator->nextIndex = 0;
+	iterator->window = window;
+	iterator->inFlight = 0;
+	iterator->results = PyList_New(0);
+	iterator->outcomes = NULL;
+	iterator->keyNames = NULL;
+	iterator->pendingKeys = NULL;
+	iterator->ready = 0;
+	iterator->busy = 0;
+	iterator->running = NULL;
+	pthread_mutex_init(&iterator->lock,NULL);
+	pthread_cond_init(&iterator->completed,NULL);
+	if(iterator->nameSpace == NULL || iterator->className == NULL || iterator->results == NULL)
+	{
+		Py_DECREF(iterator);
+		return NULL;
+	}
+	return iterator;
+}
+
+static PyObject *GetInstances(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	char *nameSpace,*className;
+	PyObject *keysList;
+	long window = 16;
+	PyObject *collapse = Py_False;
+	static char *kwlist[] = {"nameSpace","className","keysList","window","collapse",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"ssO|lO",kwlist,&nameSpace,&className,&keysList,&window,&collapse))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace, className and list of keys");
+		return NULL;
+	}
 
-			if(strcmp(propertyName,elementName)==0)
-			{
-			    SetPropertyValues(elementType,propertyValue, &miValue);
-			    miResult = MI_Instance_AddElement(miInstance,elementName,&miValue,elementType,elementFlags);
-			    if(miResult != MI_RESULT_OK)
-    			{
-					PyErr_SetString(MIError,"MI_Instance_SetElement failed");
-					return NULL;
-    			}
-			}
-		}   
-    }
+	PMI_BatchIterator *iterator = NewBatchIterator(self,nameSpace,className,PMI_BATCH_GET,keysList,window);
+	if(iterator == NULL)
+	{
+		return NULL;
+	}
+	/* Keys that cannot be collapsed into one query fall back to one get operation per key */
+	if(PyObject_IsTrue(collapse))
+	{
+		StartCollapsedQuery(iterator);
+	}
+	return (PyObject *)iterator;
+}
 
-failedGetClass:
+/* Run one operation per item with at most window in flight and return the list of (item, instance, error)
+   tuples in the order of the items, a failed item doesn't stop the others */
+static PyObject *RunBulkOperation(PyObject *self, PyObject *args, PyObject *kwds, int operationType)
+{
+	char *nameSpace;
+	char *className = NULL;
+	PyObject *items;
+	long window = 16;
+	static char *kwlist[] = {"nameSpace","items","className","window",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"sO|zl",kwlist,&nameSpace,&items,&className,&window))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace and list of items");
+		return NULL;
+	}
 
-	if ((miResult != MI_RESULT_OK) && miInstance)
-    {
-        MI_Result _tmpResult = MI_Instance_Delete(miInstance);
-        if (_tmpResult != MI_RESULT_OK)
-        {
-            PyErr_SetString(MIError,"Failed to delete key instance");
-			return NULL;
-        }
-    }
+	PMI_BatchIterator *iterator = NewBatchIterator(self,nameSpace,className,operationType,items,window);
+	if(iterator == NULL)
+	{
+		return NULL;
+	}
+	iterator->outcomes = PyList_New(PyList_GET_SIZE(iterator->items));
+	if(iterator->outcomes == NULL)
+	{
+		Py_DECREF(iterator);
+		return NULL;
+	}
 
-    {
-        MI_Result _tmpResult = MI_Operation_Close(&miOperation);
-        if (_tmpResult != MI_RESULT_OK)
-        {
-			char error[errorBufferSize];
-			strcpy(error,"MI_Operation_Close failed, error =");
-			strcat(error,MI_Result_To_String(_tmpResult));
-            PyErr_SetString(MIError,error);
-			return NULL;
-        }
-    }
-        
-    if (miResult == MI_RESULT_OK)
-    {
-        *inboundInstance = miInstance;
-    }
-	
-    return NULL;	
+	/* Results go to outcomes, so this only returns once every operation has completed */
+	NextBatchResult(iterator);
+	if(PyErr_Occurred())
+	{
+		Py_DECREF(iterator);
+		return NULL;
+	}
+	PyObject *outcomes = iterator->outcomes;
+	Py_ssize_t index;
+	for(index = 0; index < PyList_GET_SIZE(outcomes); index++)
+	{
+		/* Only left empty when the outcome tuple could not be allocated */
+		if(PyList_GET_ITEM(outcomes,index) == NULL)
+		{
+			Py_INCREF(Py_None);
+			PyList_SET_ITEM(outcomes,index,Py_None);
+		}
+	}
+	Py_INCREF(outcomes);
+	Py_DECREF(iterator);
+	return outcomes;
 }
 
+static PyObject *CreateInstances(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	return RunBulkOperation(self,args,kwds,PMI_BATCH_CREATE);
+}
 
+static PyObject *ModifyInstancesBulk(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	return RunBulkOperation(self,args,kwds,PMI_BATCH_MODIFY);
+}
 
+static PyObject *DeleteInstances(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	return RunBulkOperation(self,args,kwds,PMI_BATCH_DELETE);
+}
 
 static PyObject *GetInstance(PyObject *self, PyObject *args)
 {
     char *nameSpace,*className;
     PyObject *propertyDict;
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     if(!PyArg_ParseTuple(args,"ssO!",&nameSpace,&className,&PyDict_Type, &propertyDict))
     {
 		PyErr_SetString(MIError,"Please input correct nameSpace and className");
@@ -325,21 +3009,32 @@ static PyObject *GetInstance(PyObject *self, PyObject *args)
     const MI_Char *errorMessage = NULL;
     const MI_Instance *completionDetails = NULL;
     const MI_Instance *miInstance = NULL;
-    const MI_Instance *keyInstance = NULL;
+    MI_Instance *keyInstance = NULL;
+    PyObject *result = NULL;
 
-    CreateInboundInstance(&miSession, nameSpace, className, MI_TRUE, &keyInstance, propertyDict);
-    MI_Session_GetInstance(&miSession,0,NULL,nameSpace,keyInstance,NULL,&miOperation);
+    keyInstance = CreateInboundInstance(session, nameSpace, className, MI_TRUE, propertyDict);
+    if(keyInstance == NULL)
+    {
+    	return NULL;
+    }
+    /* The class lookup can give up the GIL, so the session may have been closed meanwhile */
+    if(!CheckSessionOpen(session))
+    {
+    	MI_Instance_Delete(keyInstance);
+    	return NULL;
+    }
+    PMI_ALLOW_THREADS(MI_Session_GetInstance(&miSession,0,NULL,nameSpace,keyInstance,NULL,&miOperation));
    
     do
     {
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
         if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
 			strcpy(error,"MI_Operation_GetInstance failed, errorString =");
 			strcat(error,MI_Result_To_String(_miResult));
 			PyErr_SetString(MIError,error);
-			return NULL;
+			break;
         }
         else
         {
@@ -354,37 +3049,45 @@ static PyObject *GetInstance(PyObject *self, PyObject *args)
 					strcat(error,errorMessage);
 				}
             	PyErr_SetString(MIError,error);
-				return NULL;
+				break;
             }
             else if (miInstance)
             {
-                PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-				MI_Instance *cloneInstance;
-				MI_Instance_Clone(miInstance,&cloneInstance);				
-	    		pmiInstance-> miInstance = cloneInstance;
-				MakePropertyDict(pmiInstance);
-				return (PyObject *)pmiInstance;	
+                /* The instance is copied, the one returned by the operation is only valid until the operation is closed */
+                result = (PyObject *)WrapResultInstance(session,miInstance);
+                break;
             }
             else if (moreResults == MI_TRUE)
             {
                 PyErr_SetString(MIError,"More results are due and we have no instance, we will keep trying!\n");
-				return NULL;
+				break;
             }
         }
     } while (moreResults == MI_TRUE);
 	
-	_miResult = MI_Operation_Close(&miOperation);
+	/* Closing an operation that still has results to deliver cancels it */
+	PMI_ALLOW_THREADS(_miResult = MI_Operation_Close(&miOperation));
+	MI_Instance_Delete(keyInstance);
+	if(result == NULL && PyErr_Occurred())
+	{
+		return NULL;
+	}
 	if(_miResult != MI_RESULT_OK)
 	{
 		char error[errorBufferSize];
 		strcpy(error,"MI_Operation_Close failed, error = ");
 		strcat(error,MI_Result_To_String(_miResult));
 		PyErr_SetString(MIError,error);
+		Py_XDECREF(result);
 		return NULL;
 	}	
 
-	Py_INCREF(Py_None);
-	return Py_None;
+	if(result == NULL)
+	{
+		Py_INCREF(Py_None);
+		result = Py_None;
+	}
+	return result;
 }
 
 static PyObject *ModifyInstances(PyObject *self, PyObject *args)
@@ -392,6 +3095,10 @@ static PyObject *ModifyInstances(PyObject *self, PyObject *args)
     MI_Char *nameSpace;
     PyObject *instance;
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     if(!PyArg_ParseTuple(args,"sO",&nameSpace,&instance))
     {
 		PyErr_SetString(MIError,"Please input correct nameSpace and instance");
@@ -412,10 +3119,10 @@ static PyObject *ModifyInstances(PyObject *self, PyObject *args)
     const MI_Instance *completionDetails = NULL;
 	const MI_Instance *miInstance = NULL;
 
-	MI_Session_ModifyInstance(&miSession, 0, NULL, nameSpace, modifyInstance, NULL, &miOperation);
+	PMI_ALLOW_THREADS(MI_Session_ModifyInstance(&miSession, 0, NULL, nameSpace, modifyInstance, NULL, &miOperation));
 	do
     {
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
         if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
@@ -441,12 +3148,7 @@ static PyObject *ModifyInstances(PyObject *self, PyObject *args)
             }
             else if (miInstance)
             {
-            	PMI_Instance* pmiInstance = (PMI_Instance*) initPMI();
-				MI_Instance *cloneInstance;
-				MI_Instance_Clone(miInstance,&cloneInstance);
-				pmiInstance->miInstance = cloneInstance;
-		    	MakePropertyDict(pmiInstance);
-	        	return (PyObject *)pmiInstance;
+            	return (PyObject *)WrapResultInstance(session,miInstance);
             }
             else if (moreResults == MI_TRUE)
             {
@@ -476,6 +3178,10 @@ static PyObject *CreateInstance(PyObject *self, PyObject *args)
 	char *nameSpace;
     PyObject *instance;
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     if(!PyArg_ParseTuple(args,"sO",&nameSpace,&instance))
     {
 		PyErr_SetString(MIError,"Please input correct nameSpace and instance");
@@ -495,10 +3201,10 @@ static PyObject *CreateInstance(PyObject *self, PyObject *args)
     const MI_Instance *completionDetails = NULL;
 	const MI_Instance *miInstance = NULL;
 
-	MI_Session_CreateInstance(&miSession, 0, NULL, nameSpace, createInstance, NULL, &miOperation);
+	PMI_ALLOW_THREADS(MI_Session_CreateInstance(&miSession, 0, NULL, nameSpace, createInstance, NULL, &miOperation));
 	do
     {
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
         if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
@@ -524,12 +3230,7 @@ static PyObject *CreateInstance(PyObject *self, PyObject *args)
             }
             else if (miInstance)
             {
-	            PMI_Instance* pmiInstance = (PMI_Instance*) initPMI();
-				MI_Instance *cloneInstance;
-				MI_Instance_Clone(miInstance,&cloneInstance);
-				pmiInstance->miInstance = cloneInstance;				
-				MakePropertyDict(pmiInstance);
-	        	return (PyObject *)pmiInstance;
+	            return (PyObject *)WrapResultInstance(session,miInstance);
             }
             else if (moreResults == MI_TRUE)
             {
@@ -556,11 +3257,15 @@ static PyObject *CreateInstance(PyObject *self, PyObject *args)
 
 static PyObject *DeleteInstance(PyObject *self, PyObject *args)
 {
-    const MI_Instance *deleteInstance;
+    MI_Instance *deleteInstance;
     
     char *nameSpace,*className;
     PyObject *propertyDict;
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     if(!PyArg_ParseTuple(args,"ssO!",&nameSpace,&className,&PyDict_Type, &propertyDict))
     {
 		PyErr_SetString(MIError, "namespace and classname are not provided");
@@ -570,8 +3275,18 @@ static PyObject *DeleteInstance(PyObject *self, PyObject *args)
     MI_Session miSession = session->miSession;
     MI_Operation miOperation = MI_OPERATION_NULL;
 	
-    CreateInboundInstance(&miSession, nameSpace, className, MI_TRUE, &deleteInstance, propertyDict);
-    MI_Session_DeleteInstance(&miSession, 0, NULL, nameSpace, deleteInstance, NULL, &miOperation);
+    deleteInstance = CreateInboundInstance(session, nameSpace, className, MI_TRUE, propertyDict);
+    if(deleteInstance == NULL)
+    {
+    	return NULL;
+    }
+    /* The class lookup can give up the GIL, so the session may have been closed meanwhile */
+    if(!CheckSessionOpen(session))
+    {
+    	MI_Instance_Delete(deleteInstance);
+    	return NULL;
+    }
+    PMI_ALLOW_THREADS(MI_Session_DeleteInstance(&miSession, 0, NULL, nameSpace, deleteInstance, NULL, &miOperation));
    	MI_Result miResult;
     MI_Result _miResult;
     MI_Boolean moreResults;
@@ -580,7 +3295,7 @@ static PyObject *DeleteInstance(PyObject *self, PyObject *args)
 	
 	do
     {
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
 		if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
@@ -606,12 +3321,7 @@ static PyObject *DeleteInstance(PyObject *self, PyObject *args)
             }
             else if (miInstance)
             {
-                PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-				MI_Instance *cloneInstance;
-				MI_Instance_Clone(miInstance,&cloneInstance);	    		
-				pmiInstance-> miInstance = cloneInstance;
-				MakePropertyDict(pmiInstance);
-				return (PyObject *)pmiInstance;	
+                return (PyObject *)WrapResultInstance(session,miInstance);
             }
             else if (moreResults == MI_TRUE)
             {
@@ -669,6 +3379,10 @@ static PyObject *Invoke(PyObject *self, PyObject *args, PyObject *kwds)
 	}
 
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     MI_Session miSession = session->miSession;
     MI_Application miApplication = MI_APPLICATION_NULL;   
     MI_Operation miOperation = MI_OPERATION_NULL; 
@@ -682,29 +3396,40 @@ static PyObject *Invoke(PyObject *self, PyObject *args, PyObject *kwds)
 	}
 
     /*Create the instance of arguments */
-    const MI_Instance *inboundMethodParameters = NULL;
+    MI_Instance *inboundMethodParameters = NULL;
 	if(argList!=NULL)
 	{
-		CreateInboundInstance(&miSession,nameSpace,className,MI_FALSE,&inboundMethodParameters,argList);
+		inboundMethodParameters = CreateInboundInstance(session,nameSpace,className,MI_FALSE,argList);
+		if(inboundMethodParameters == NULL)
+		{
+			return NULL;
+		}
+		/* The class lookup can give up the GIL, so the session may have been closed meanwhile */
+		if(!CheckSessionOpen(session))
+		{
+			MI_Instance_Delete(inboundMethodParameters);
+			return NULL;
+		}
 	}
 
-    MI_Session_Invoke(&miSession, 0, NULL, nameSpace, className, methodName, methodInstance,inboundMethodParameters, NULL, &miOperation);
+    PMI_ALLOW_THREADS(MI_Session_Invoke(&miSession, 0, NULL, nameSpace, className, methodName, methodInstance,inboundMethodParameters, NULL, &miOperation));
 
     MI_Result _miResult;
     const MI_Char *errorMessage;
     MI_Boolean moreResults;
     const MI_Instance *completionDetails;
+    PyObject *result = NULL;
     do
     {
     	const MI_Instance *miInstance;
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &completionDetails));
 		if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
 			strcpy(error,"MI_Operation_GetInstance failed, errorString =");
 			strcat(error,MI_Result_To_String(_miResult));
 			PyErr_SetString(MIError,error);
-			return NULL;
+			break;
         }
         else
         {
@@ -719,32 +3444,42 @@ static PyObject *Invoke(PyObject *self, PyObject *args, PyObject *kwds)
 					strcat(error,errorMessage);
 				}
             	PyErr_SetString(MIError,error);
-				return NULL;
+				break;
             }
             else if (miInstance)
             {
-                PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-				MI_Instance *cloneInstance;
-				MI_Instance_Clone(miInstance,&cloneInstance);
-	    		pmiInstance-> miInstance = cloneInstance;				
-				MakePropertyDict(pmiInstance);
-				return (PyObject *)pmiInstance;
+                /* The instance is copied, the one returned by the operation is only valid until the operation is closed */
+                result = (PyObject *)WrapResultInstance(session,miInstance);
+                break;
             }
         }
     } while (moreResults == MI_TRUE);
     
-     _miResult = MI_Operation_Close(&miOperation);
-  
+    /* Closing an operation that still has results to deliver cancels it */
+    PMI_ALLOW_THREADS(_miResult = MI_Operation_Close(&miOperation));
+    if(inboundMethodParameters != NULL)
+    {
+    	MI_Instance_Delete(inboundMethodParameters);
+    }
+    if(result == NULL && PyErr_Occurred())
+    {
+    	return NULL;
+    }
     if (_miResult != MI_RESULT_OK)
 	{
 		char error[errorBufferSize];
 		strcpy(error,"MI_Operation_Close failed, error = ");
 		strcat(error,MI_Result_To_String(_miResult));
 		PyErr_SetString(MIError,error);
+		Py_XDECREF(result);
 		return NULL;
 	} 
-	Py_INCREF(Py_None);
-	return NULL;
+	if(result == NULL)
+	{
+		Py_INCREF(Py_None);
+		result = Py_None;
+	}
+	return result;
 }
 
 static PyObject *Associate(PyObject *self, PyObject *args, PyObject *kwds)
@@ -764,6 +3499,10 @@ static PyObject *Associate(PyObject *self, PyObject *args, PyObject *kwds)
     }
 	
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     MI_Session miSession = session->miSession;   
 
     const MI_Instance *assocInstance = instance->miInstance;
@@ -774,12 +3513,12 @@ static PyObject *Associate(PyObject *self, PyObject *args, PyObject *kwds)
     const MI_Char *errorMessage = NULL;
     const MI_Instance *errorDetails = NULL;
    
-	MI_Session_AssociatorInstances(&miSession, 0, NULL, nameSpace, assocInstance, assocClass, resultClass, role, resultRole, MI_FALSE, NULL, &miOperation);
+	PMI_ALLOW_THREADS(MI_Session_AssociatorInstances(&miSession, 0, NULL, nameSpace, assocInstance, assocClass, resultClass, role, resultRole, MI_FALSE, NULL, &miOperation));
 	PyObject *instances = PyList_New(0);	 
 	do
     {
     	const MI_Instance *miInstance;
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &errorDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &errorDetails));
 		if (_miResult != MI_RESULT_OK)
         {	
 			char error[errorBufferSize];
@@ -791,12 +3530,14 @@ static PyObject *Associate(PyObject *self, PyObject *args, PyObject *kwds)
 
         if (miInstance)
         {
-            PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-			MI_Instance *cloneInstance;
-			MI_Instance_Clone(miInstance,&cloneInstance);
-	    	pmiInstance-> miInstance = cloneInstance;
-			MakePropertyDict(pmiInstance);
-			PyList_Append(instances,(PyObject *)pmiInstance);
+            PMI_Instance *pmiInstance = WrapResultInstance(session,miInstance);
+            if(pmiInstance == NULL)
+            {
+            	Py_DECREF(instances);
+            	return NULL;
+            }
+            PyList_Append(instances,(PyObject *)pmiInstance);
+            Py_DECREF(pmiInstance);
         }
 
     } while (miResult == MI_RESULT_OK && moreResults == MI_TRUE);
@@ -841,6 +3582,10 @@ static PyObject *Reference(PyObject *self, PyObject *args, PyObject *kwds)
 		return NULL;
     }
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     MI_Session miSession = session->miSession;   
 
     MI_Instance *refInstance =instance->miInstance;
@@ -852,13 +3597,13 @@ static PyObject *Reference(PyObject *self, PyObject *args, PyObject *kwds)
     const MI_Char *errorString = NULL;
     const MI_Instance *errorDetails = NULL;
     
-    MI_Session_ReferenceInstances(&miSession, 0, NULL, nameSpace, refInstance, resultClass, role, MI_FALSE, NULL, &miOperation);
+    PMI_ALLOW_THREADS(MI_Session_ReferenceInstances(&miSession, 0, NULL, nameSpace, refInstance, resultClass, role, MI_FALSE, NULL, &miOperation));
 	PyObject *instances = PyList_New(0);
     do
     {
         const MI_Instance *miInstance;
 
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorString, &errorDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorString, &errorDetails));
         if (_miResult != MI_RESULT_OK)
         {
 			char error[errorBufferSize];
@@ -869,12 +3614,14 @@ static PyObject *Reference(PyObject *self, PyObject *args, PyObject *kwds)
         }
         if (miInstance)
         {
-            PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-			MI_Instance *cloneInstance;
-			MI_Instance_Clone(miInstance,&cloneInstance);
-			pmiInstance-> miInstance = cloneInstance;
-			MakePropertyDict(pmiInstance);
-			PyList_Append(instances,(PyObject *)pmiInstance);
+            PMI_Instance *pmiInstance = WrapResultInstance(session,miInstance);
+            if(pmiInstance == NULL)
+            {
+            	Py_DECREF(instances);
+            	return NULL;
+            }
+            PyList_Append(instances,(PyObject *)pmiInstance);
+            Py_DECREF(pmiInstance);
         }
     } while (miResult == MI_RESULT_OK && moreResults == MI_TRUE);
 
@@ -913,6 +3660,10 @@ static PyObject *Query(PyObject *self, PyObject *args)
 		return NULL;
     }
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     MI_Session miSession = session->miSession;   
     MI_Operation miOperation = MI_OPERATION_NULL;
     MI_Result miResult;
@@ -921,13 +3672,13 @@ static PyObject *Query(PyObject *self, PyObject *args)
     MI_Boolean moreResults;
     MI_Result _miResult;
 
-    MI_Session_QueryInstances(&miSession,0,NULL,nameSpace,queryDialect,queryExpression,NULL,&miOperation);
+    PMI_ALLOW_THREADS(MI_Session_QueryInstances(&miSession,0,NULL,nameSpace,queryDialect,queryExpression,NULL,&miOperation));
 	PyObject *instances = PyList_New(0);
     do
     {
         const MI_Instance *miInstance;
 
-        _miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &errorDetails);
+        PMI_ALLOW_THREADS(_miResult = MI_Operation_GetInstance(&miOperation, &miInstance, &moreResults, &miResult, &errorMessage, &errorDetails));
         if (_miResult != MI_RESULT_OK)
         {
         	char error[errorBufferSize];
@@ -939,12 +3690,14 @@ static PyObject *Query(PyObject *self, PyObject *args)
         }
         if (miInstance)
         {
-            PMI_Instance *pmiInstance = (PMI_Instance*) initPMI();
-			MI_Instance *cloneInstance;
-			MI_Instance_Clone(miInstance,&cloneInstance);
-	    	pmiInstance-> miInstance = cloneInstance;
-			MakePropertyDict(pmiInstance);
-			PyList_Append(instances,(PyObject *)pmiInstance);
+            PMI_Instance *pmiInstance = WrapResultInstance(session,miInstance);
+            if(pmiInstance == NULL)
+            {
+            	Py_DECREF(instances);
+            	return NULL;
+            }
+            PyList_Append(instances,(PyObject *)pmiInstance);
+            Py_DECREF(pmiInstance);
         }
 
     } while (miResult == MI_RESULT_OK && moreResults == MI_TRUE);
@@ -981,86 +3734,176 @@ static PyObject *GetClass(PyObject *self, PyObject *args)
 {
     char *nameSpace,*className;
     PMI_Session *session = (PMI_Session*) self;
+    if(!CheckSessionOpen(session))
+    {
+    	return NULL;
+    }
     if(!PyArg_ParseTuple(args,"ss",&nameSpace,&className))
     {
 		PyErr_SetString(MIError,"Please provide correct nameSpace and className");
 		return NULL;
     }
 
-    MI_Session miSession = session->miSession;
-    MI_Operation miOperation = MI_OPERATION_NULL;
-    MI_Result miResult;
-    MI_Result _miResult;
-    MI_Boolean moreResults;
-    const MI_Char *errorMessage = NULL;
-    const MI_Instance *completionDetails = NULL;
-	const MI_Class *miClass;	
+    return (PyObject *)LookupClass(session,nameSpace,className);
+}
 
-    MI_Session_GetClass(&miSession,0,NULL,nameSpace,className,NULL,&miOperation);
-   
-    do
-    {
-        _miResult = MI_Operation_GetClass(&miOperation, &miClass, &moreResults, &miResult, &errorMessage, &completionDetails);
-        if (_miResult != MI_RESULT_OK)
-        {
-            char error[errorBufferSize];
-			strcpy(error,"MI_Operation_GetInstance failed, errorString =");
-			strcat(error,MI_Result_To_String(_miResult));
-			PyErr_SetString(MIError,error);
-			return NULL;  
-        }
-        else
-        {
-            if (miResult != MI_RESULT_OK)
-            {
-            	char error[errorBufferSize];
-				strcpy(error,"Get operation failed to retrieve the class,error ");
-				strcat(error,MI_Result_To_String(miResult));
-				if(errorMessage != NULL)
-				{
-					strcat(error,", errorMessage = ");
-					strcat(error,errorMessage);
-				}
-        		PyErr_SetString(MIError,error);
-				return NULL;
-            }
-            else if (miClass)
-            {
-	            PMI_Class *pmiClass = (PMI_Class*) init_PMI_Class();
-		    	pmiClass-> miClass = miClass;
-				MakeMethodsDict(pmiClass);
-				MakePropertyValueAndTypeDict(pmiClass);
-		    	return (PyObject *)pmiClass;	
-            }
-            else if (moreResults == MI_TRUE)
-            {
-                PyErr_SetString(MIError,"More results are due and we have no class, we will keep trying!\n");
-				return NULL;
-            }
-            
-        }
-    } while (moreResults == MI_TRUE);
-	
-	_miResult = MI_Operation_Close(&miOperation);
-	if(_miResult != MI_RESULT_OK)
+static PyObject *ConfigureClassCache(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PMI_Session *session = (PMI_Session*) self;
+	long maxSize = session->classCacheMaxSize;
+	double ttl = session->classCacheTtl;
+	static char *kwlist[] = {"maxSize","ttl",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|ld",kwlist,&maxSize,&ttl))
 	{
-		char error[errorBufferSize];
-		strcpy(error,"MI_Operation_Close failed, error = ");
-		strcat(error,MI_Result_To_String(_miResult));
-		PyErr_SetString(MIError,error);
+		PyErr_SetString(MIError,"Please input correct maxSize and ttl");
 		return NULL;
 	}
-	
+	if(maxSize < 0 || ttl < 0)
+	{
+		PyErr_SetString(MIError,"maxSize and ttl cannot be negative");
+		return NULL;
+	}
+	session->classCacheTtl = ttl;
+	if(maxSize == 0)
+	{
+		PyDict_Clear(session->classCache);
+	}
+	else
+	{
+		/* EvictCachedClasses makes room for one more entry, evict down to the new size */
+		session->classCacheMaxSize = maxSize + 1;
+		EvictCachedClasses(session);
+	}
+	session->classCacheMaxSize = maxSize;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+/* Drop every cached class, the classes of one namespace, or a single class */
+static PyObject *InvalidateClassCache(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PMI_Session *session = (PMI_Session*) self;
+	char *nameSpace = NULL, *className = NULL;
+	static char *kwlist[] = {"nameSpace","className",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|zz",kwlist,&nameSpace,&className))
+	{
+		PyErr_SetString(MIError,"Please input correct nameSpace and className");
+		return NULL;
+	}
+	if(nameSpace == NULL)
+	{
+		PyDict_Clear(session->classCache);
+	}
+	else
+	{
+		PyObject *keys = PyDict_Keys(session->classCache);
+		Py_ssize_t index;
+		if(keys == NULL)
+		{
+			return NULL;
+		}
+		for(index = 0; index < PyList_GET_SIZE(keys); index++)
+		{
+			PyObject *key = PyList_GET_ITEM(keys,index);
+			if(strcmp(PyString_AsString(PyTuple_GET_ITEM(key,0)),nameSpace) == 0 &&
+				(className == NULL || strcmp(PyString_AsString(PyTuple_GET_ITEM(key,1)),className) == 0))
+			{
+				PyDict_DelItem(session->classCache,key);
+			}
+		}
+		Py_DECREF(keys);
+	}
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
+static PyObject *ClassCacheStats(PyObject *self)
+{
+	PMI_Session *session = (PMI_Session*) self;
+	return Py_BuildValue("{s:k,s:k,s:n,s:l,s:d}",
+		"hits",session->classCacheHits,
+		"misses",session->classCacheMisses,
+		"size",PyDict_Size(session->classCache),
+		"maxSize",session->classCacheMaxSize,
+		"ttl",session->classCacheTtl);
+}
+
 static PyObject *Close(PyObject *self)
 {
     MI_Result miResult = MI_RESULT_OK;
     PMI_Session *session = (PMI_Session *)self;
     MI_Session miSession = session->miSession;
-    miResult = MI_Session_Close(&miSession,NULL,NULL);
+    PMI_InstanceIterator *iterator;
+    MI_Operation *busyOperations = NULL;
+    Py_ssize_t busyCount = 0, index;
+    if(session->closed)
+    {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    for(iterator = session->iterators; iterator != NULL; iterator = iterator->next)
+    {
+        busyCount += iterator->busy ? 1 : 0;
+    }
+    if(busyCount > 0)
+    {
+        busyOperations = (MI_Operation *)PyMem_Malloc(busyCount * sizeof(MI_Operation));
+        if(busyOperations == NULL)
+        {
+            return PyErr_NoMemory();
+        }
+    }
+    /* Mark the session as closed before giving up the GIL so no other thread can start a new operation,
+       MI_Session_Close waits for the operations already in progress */
+    session->closed = 1;
+    /* MI_Session_Close also waits for the operations of the iterators, which are only closed by the iterators.
+       An iterator being read by another thread is cancelled, that thread closes it once the final result arrives.
+       The handles are copied so they can be cancelled without the GIL, the MI callbacks of other operations may be
+       waiting for it. A handle closed by its consumer meanwhile is a stale thunk handle the MI client rejects */
+    index = 0;
+    for(iterator = session->iterators; iterator != NULL; iterator = iterator->next)
+    {
+        if(iterator->busy)
+        {
+            busyOperations[index++] = iterator->miOperation;
+        }
+    }
+    if(busyCount > 0)
+    {
+        PMI_ALLOW_THREADS(
+            for(index = 0; index < busyCount; index++)
+            {
+                MI_Operation_Cancel(&busyOperations[index],MI_REASON_NONE);
+            });
+        PyMem_Free(busyOperations);
+    }
+    iterator = session->iterators;
+    while(iterator != NULL)
+    {
+        if(iterator->busy)
+        {
+            iterator = iterator->next;
+            continue;
+        }
+        /* The GIL is released while the iterator is drained, it is kept alive and the list is walked again after */
+        Py_INCREF(iterator);
+        iterator->interrupted = !iterator->finished;
+        CloseInstanceIterator(iterator);
+        Py_DECREF(iterator);
+        iterator = session->iterators;
+    }
+    /* A session with operations still running, like begin_* operations or get_instances iterators, is not
+       handed to another caller */
+    if(session->poolKey != NULL && session->openOperations == 0 && ReleasePooledSession(session->poolKey,session))
+    {
+        Py_CLEAR(session->poolKey);
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    /* The iterators still open here are being read by other threads. Without a completion callback
+       MI_Session_Close only returns once every child operation of the session has been closed, so it waits for
+       those threads to get the final result and close their operation. It is called without the GIL so they can */
+    PMI_ALLOW_THREADS(miResult = MI_Session_Close(&miSession,NULL,NULL));
     if(miResult != MI_RESULT_OK)
     {
 		char error[errorBufferSize];
@@ -1073,18 +3916,102 @@ static PyObject *Close(PyObject *self)
     return Py_None;
 }
 
+static PyObject *SessionStats(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PMI_Session *session = (PMI_Session*) self;
+	PyObject *reset = Py_False;
+	static char *kwlist[] = {"reset",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|O",kwlist,&reset))
+	{
+		return NULL;
+	}
+	PyObject *result = MakeStatsDict(session->metrics);
+	if(result != NULL && PyObject_IsTrue(reset))
+	{
+		ResetMetrics(session->metrics);
+	}
+	return result;
+}
+
+static PyObject *ResetSessionStats(PyObject *self)
+{
+	ResetMetrics(((PMI_Session*) self)->metrics);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+/* Session methods with their operations measured while metrics are enabled */
+PMI_MEASURED(MeasuredEnumerateInstances,"enumerate_instances",PMI_OP_ENUMERATE,EnumerateInstances)
+PMI_MEASURED(MeasuredIterInstances,"iter_instances",PMI_OP_ENUMERATE,IterInstances)
+PMI_MEASURED(MeasuredEnumerateColumns,"enumerate_columns",PMI_OP_ENUMERATE,EnumerateColumns)
+PMI_MEASURED(MeasuredGetInstance,"get_instance",PMI_OP_GET,GetInstance)
+PMI_MEASURED(MeasuredGetClass,"get_class",PMI_OP_GET_CLASS,GetClass)
+PMI_MEASURED(MeasuredModifyInstance,"modify_instance",PMI_OP_MODIFY,ModifyInstances)
+PMI_MEASURED(MeasuredCreateInstance,"create_instance",PMI_OP_CREATE,CreateInstance)
+PMI_MEASURED(MeasuredDeleteInstance,"delete_instance",PMI_OP_DELETE,DeleteInstance)
+PMI_MEASURED_KEYWORDS(MeasuredAssociate,"associate",PMI_OP_ASSOCIATE,Associate)
+PMI_MEASURED_KEYWORDS(MeasuredReference,"reference",PMI_OP_REFERENCE,Reference)
+PMI_MEASURED(MeasuredQuery,"query",PMI_OP_QUERY,Query)
+PMI_MEASURED(MeasuredIterQuery,"iter_query",PMI_OP_QUERY,IterQuery)
+PMI_MEASURED_KEYWORDS(MeasuredInvoke,"invoke",PMI_OP_INVOKE,Invoke)
+PMI_MEASURED_KEYWORDS(MeasuredGetInstances,"get_instances",PMI_OP_GET,GetInstances)
+PMI_MEASURED_KEYWORDS(MeasuredCreateInstances,"create_instances",PMI_OP_CREATE,CreateInstances)
+PMI_MEASURED_KEYWORDS(MeasuredModifyInstances,"modify_instances",PMI_OP_MODIFY,ModifyInstancesBulk)
+PMI_MEASURED_KEYWORDS(MeasuredDeleteInstances,"delete_instances",PMI_OP_DELETE,DeleteInstances)
+
 static PyMethodDef PMI_Session_methods [] = {
-    {"enumerate_instances",(PyCFunction)EnumerateInstances,METH_VARARGS,NULL},
-    {"get_instance",(PyCFunction)GetInstance,METH_VARARGS,NULL},
-    {"get_class",(PyCFunction)GetClass,METH_VARARGS,NULL},
-    {"modify_instance",(PyCFunction)ModifyInstances,METH_VARARGS,NULL},
-    {"create_instance",(PyCFunction)CreateInstance,METH_VARARGS,NULL},
-    {"delete_instance",(PyCFunction)DeleteInstance,METH_VARARGS,NULL},
-    {"associate",(PyCFunction)Associate, METH_VARARGS|METH_KEYWORDS,NULL},
-    {"reference",(PyCFunction)Reference,METH_VARARGS|METH_KEYWORDS,NULL},
-    {"query",(PyCFunction)Query,METH_VARARGS,NULL},
+    {"enumerate_instances",(PyCFunction)MeasuredEnumerateInstances,METH_VARARGS,NULL},
+    {"iter_instances",(PyCFunction)MeasuredIterInstances,METH_VARARGS,NULL},
+    {"enumerate_columns",(PyCFunction)MeasuredEnumerateColumns,METH_VARARGS,NULL},
+    {"get_instance",(PyCFunction)MeasuredGetInstance,METH_VARARGS,NULL},
+    {"get_class",(PyCFunction)MeasuredGetClass,METH_VARARGS,NULL},
+    {"configure_class_cache",(PyCFunction)ConfigureClassCache,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"invalidate_class_cache",(PyCFunction)InvalidateClassCache,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"class_cache_stats",(PyCFunction)ClassCacheStats,METH_NOARGS,NULL},
+    {"stats",(PyCFunction)SessionStats,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"reset_stats",(PyCFunction)ResetSessionStats,METH_NOARGS,NULL},
+    {"modify_instance",(PyCFunction)MeasuredModifyInstance,METH_VARARGS,NULL},
+    {"create_instance",(PyCFunction)MeasuredCreateInstance,METH_VARARGS,NULL},
+    {"delete_instance",(PyCFunction)MeasuredDeleteInstance,METH_VARARGS,NULL},
+    {"associate",(PyCFunction)MeasuredAssociate, METH_VARARGS|METH_KEYWORDS,NULL},
+    {"reference",(PyCFunction)MeasuredReference,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"query",(PyCFunction)MeasuredQuery,METH_VARARGS,NULL},
+    {"iter_query",(PyCFunction)MeasuredIterQuery,METH_VARARGS,NULL},
     {"close",(PyCFunction)Close,METH_NOARGS,NULL},
-    {"invoke",(PyCFunction)Invoke,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"invoke",(PyCFunction)MeasuredInvoke,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"begin_enumerate_instances",(PyCFunction)BeginEnumerateInstances,METH_VARARGS,NULL},
+    {"begin_get_instance",(PyCFunction)BeginGetInstance,METH_VARARGS,NULL},
+    {"begin_query",(PyCFunction)BeginQuery,METH_VARARGS,NULL},
+    {"get_instances",(PyCFunction)MeasuredGetInstances,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"create_instances",(PyCFunction)MeasuredCreateInstances,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"modify_instances",(PyCFunction)MeasuredModifyInstances,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"delete_instances",(PyCFunction)MeasuredDeleteInstances,METH_VARARGS|METH_KEYWORDS,NULL},
+    {NULL}
+};
+
+/* Getter and setter of the boolean session attributes mapped to a PMI_DECODE_* flag passed as closure */
+static PyObject *PMI_Session_getflag(PMI_Session *self, void *closure)
+{
+	return PyBool_FromLong(self->decodeFlags & (long)closure);
+}
+
+static int PMI_Session_setflag(PMI_Session *self, PyObject *value, void *closure)
+{
+	if(value == NULL)
+	{
+		PyErr_SetString(MIError,"Cannot delete the attribute");
+		return -1;
+	}
+	if(PyObject_IsTrue(value))
+		self->decodeFlags |= (long)closure;
+	else
+		self->decodeFlags &= ~(long)closure;
+	return 0;
+}
+
+static PyGetSetDef PMI_Session_getset [] = {
+    {"lazy",(getter)PMI_Session_getflag,(setter)PMI_Session_setflag,"Decode the properties of returned instances on first access",(void *)PMI_DECODE_LAZY},
+    {"arrayBuffers",(getter)PMI_Session_getflag,(setter)PMI_Session_setflag,"Return numeric array properties as bytearray/array.array objects instead of tuples",(void *)PMI_DECODE_ARRAYBUFFERS},
     {NULL}
 };
 
@@ -1118,7 +4045,7 @@ static PyTypeObject PMI_SessionType = {
     0,                         /* tp_iternext */
     PMI_Session_methods,             /* tp_methods */
     0,		               /* tp_members */
-    0,    			/* tp_getset */
+    PMI_Session_getset,    			/* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
@@ -1129,33 +4056,22 @@ static PyTypeObject PMI_SessionType = {
     (newfunc)PMI_Session_new,                 /* tp_new */
 };	    
 
-
-static PyObject *InitSession()
-{
-	PyObject *session = PyObject_CallObject((PyObject*) &PMI_SessionType, NULL);
-	Py_INCREF(session);
-	return session;
-}
-
-#define PyMODINIT_FUNC void
-#ifndef PyMODINIT_FUNC
-#endif
-PyMODINIT_FUNC
-initPMI_Session(void)
+/* Ready the session types and export the session into the mi module, called once from initmi */
+static int AddSessionTypes(PyObject *m)
 { 
-    PyObject *m;
     /*Make sure the new type object is initialized properly*/
     if (PyType_Ready(&PMI_SessionType) <0)
-		return;
-    m = Py_InitModule3("mi",PMI_Session_methods, "MI_Session object");
-    //Py_INCREF(&PMI_SessionType);
-
-    /*Add the exception type to the module */
-    MIError = PyErr_NewException("mi.error",NULL,NULL);
-    Py_INCREF(MIError);
-    PyModule_AddObject(m,"MIError",MIError);
+		return -1;
+    if (PyType_Ready(&PMI_InstanceIteratorType) <0)
+		return -1;
+    if (PyType_Ready(&PMI_OperationType) <0)
+		return -1;
+    if (PyType_Ready(&PMI_BatchIteratorType) <0)
+		return -1;
+    if (AddInstanceTypes(m) < 0 || AddClassTypes(m) < 0)
+		return -1;
 
     /*New type objects are all exported into mi module*/
-    PyModule_AddObject(m, "PMI_Session", (PyObject *)&PMI_SessionType);
-    PyDateTime_IMPORT; 
+    Py_INCREF(&PMI_SessionType);
+    return PyModule_AddObject(m, "PMI_Session", (PyObject *)&PMI_SessionType);
 }
@@ -7,22 +7,43 @@
 **==============================================================================
 */
 
-#include "/usr/include/python2.6/Python.h"
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
 #include "MI.h"
 #include <string.h>
+#include <stdarg.h>
+#include <math.h>
 #include "structmember.h"
 #include "PMI_Session.c"
 
 /*Define a static MI Exception type*/
 static PyObject *MIError;
 
-PyObject* CleanupApplication(MI_DestinationOptions miDestinationOptions,
-	MI_Application miApplication, MI_Result miResult) {
+/* All sessions and local instances are created from one application for the lifetime of the process */
+static MI_Application sharedApplication = MI_APPLICATION_NULL;
+
+static MI_Application *GetSharedApplication(void)
+{
+	if(sharedApplication.ft == NULL)
+	{
+		/* Initialized with the GIL held so two threads cannot both create it */
+		MI_Result miResult = MI_Application_Initialize(0, NULL, NULL, &sharedApplication);
+		if (miResult != MI_RESULT_OK)
+		{
+			MI_Application miApplication = MI_APPLICATION_NULL;
+			sharedApplication = miApplication;
+			PyErr_SetString(MIError,"MI_Application_Initialize failed");
+			return NULL;
+		}
+	}
+	return &sharedApplication;
+}
+
+PyObject* CleanupApplication(MI_DestinationOptions miDestinationOptions, MI_Result miResult) {
     if (miDestinationOptions.ft) {
         MI_DestinationOptions_Delete(&miDestinationOptions);
 	}
 
-    MI_Application_Close(&miApplication);
 	char str[80];
 	strcpy(str,"MI_Application_NewSession failed, error = ");
 	strcat(str,MI_Result_To_String(miResult));
@@ -30,72 +51,211 @@ PyObject* CleanupApplication(MI_DestinationOptions miDestinationOptions,
 	return NULL;
 }
 
-PyObject* CleanupSession(MI_DestinationOptions miDestinationOptions,
-	MI_Application miApplication, MI_Result miResult, MI_Session miSession) {
-    MI_Session_Close(&miSession, NULL, NULL);
-    return CleanupApplication(miDestinationOptions, miApplication, miResult);
+PyObject* CleanupSession(MI_DestinationOptions miDestinationOptions, MI_Result miResult, MI_Session miSession) {
+    PMI_ALLOW_THREADS(MI_Session_Close(&miSession, NULL, NULL));
+    return CleanupApplication(miDestinationOptions, miResult);
+}
+
+/* Wrap a connected MI_Session, the session goes back to the pool on close() when poolKey is set. A session taken from the pool keeps the class cache, with its configuration, that it
+   had when it was put back */
+static PyObject *NewConnectedSession(MI_Session miSession, PyObject *poolKey, PMI_PooledSession *pooled)
+{
+	PMI_Session* session = (PMI_Session*) PyObject_CallObject((PyObject*) &PMI_SessionType, NULL);
+	if(session == NULL)
+	{
+		if(pooled != NULL)
+		{
+			ClosePooledSession(pooled);
+		}
+		else
+		{
+			PMI_ALLOW_THREADS(MI_Session_Close(&miSession, NULL, NULL));
+		}
+		Py_XDECREF(poolKey);
+		return NULL;
+	}
+	session->miSession = miSession;
+	session->poolKey = poolKey;
+	if(pooled != NULL)
+	{
+		if(pooled->classCache != NULL)
+		{
+			Py_DECREF(session->classCache);
+			session->classCache = pooled->classCache;
+		}
+		session->classCacheMaxSize = pooled->classCacheMaxSize;
+		session->classCacheTtl = pooled->classCacheTtl;
+		session->classCacheHits = pooled->classCacheHits;
+		session->classCacheMisses = pooled->classCacheMisses;
+		Py_DECREF(pooled->key);
+		PyMem_Free(pooled);
+	}
+	return (PyObject *)session;
 }
 
-static PyObject* Connect(PyObject* self, PyObject* args){
-	//initiazlie the python module first
-	Py_Initialize();
-	initPMI_Session();
-	initPMI_Instance();
-	initPMI_Class();
-	PMI_Session* session = (PMI_Session*) InitSession();
-	MI_Application miApplication = MI_APPLICATION_NULL;
+/* Pool key of a destination and its credentials. It is a digest salted per process so the pool doesn't keep the
+   password for the lifetime of the process */
+static PyObject *MakePoolKey(const char *destination, const char *domain, const char *username, const char *password)
+{
+	static PyObject *salt = NULL;
+	PyObject *hashlib, *credentials, *data, *digest, *key;
+	if(salt == NULL)
+	{
+		PyObject *os = PyImport_ImportModule("os");
+		if(os == NULL)
+		{
+			return NULL;
+		}
+		salt = PyObject_CallMethod(os,"urandom","i",32);
+		Py_DECREF(os);
+		if(salt == NULL)
+		{
+			return NULL;
+		}
+	}
+	hashlib = PyImport_ImportModule("hashlib");
+	if(hashlib == NULL)
+	{
+		return NULL;
+	}
+	/* The repr of the tuple keeps the fields apart, so different credentials never hash the same data */
+	credentials = Py_BuildValue("(zsss)",destination,domain,username,password);
+	data = credentials ? PyObject_Repr(credentials) : NULL;
+	Py_XDECREF(credentials);
+	if(data != NULL)
+	{
+		PyString_Concat(&data,salt);
+	}
+	digest = data ? PyObject_CallMethod(hashlib,"sha256","O",data) : NULL;
+	Py_XDECREF(data);
+	Py_DECREF(hashlib);
+	key = digest ? PyObject_CallMethod(digest,"digest",NULL) : NULL;
+	Py_XDECREF(digest);
+	return key;
+}
+
+static PyObject* Connect(PyObject* self, PyObject* args, PyObject *kwds){
+	MI_Application *miApplication;
 	MI_Session miSession = MI_SESSION_NULL;	
 	MI_Result miResult;
 	MI_DestinationOptions miDestinationOptions = MI_DESTINATIONOPTIONS_NULL;
 	MI_UserCredentials miUserCreds = {0};
+	PyObject *poolKey = NULL;
 
 	char* domain, *username, *password;
-	if(!PyArg_ParseTuple(args,"sss",&domain,&username,&password))
+	char *destination = NULL;
+	PyObject *pooled = Py_False;
+	static char *kwlist[] = {"domain","username","password","destination","pooled",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"sss|zO",kwlist,&domain,&username,&password,&destination,&pooled))
 	{
 	     PyErr_SetString(MIError,"Connection failed: please input the correct domian, username and password");
 	     return NULL;
 	}
+
+	/* Reuse a warm session to the same destination with the same credentials, only with pooled=True as close()
+	   then hands the session to the next caller instead of closing it */
+	if(PyObject_IsTrue(pooled) && poolMaxSize > 0)
+	{
+		PMI_PooledSession *entry;
+		poolKey = MakePoolKey(destination,domain,username,password);
+		if(poolKey == NULL)
+		{
+			return NULL;
+		}
+		while((entry = TakePooledSession(poolKey)) != NULL)
+		{
+			if(poolHealthCheckInterval < 0 || PMI_Clock() - entry->idleSince <= poolHealthCheckInterval || TestConnection(&entry->miSession) == MI_RESULT_OK)
+			{
+				return NewConnectedSession(entry->miSession,poolKey,entry);
+			}
+			ClosePooledSession(entry);
+		}
+	}
 	
     miUserCreds.authenticationType = MI_AUTH_TYPE_BASIC;
     miUserCreds.credentials.usernamePassword.domain = MI_T(domain);
     miUserCreds.credentials.usernamePassword.username = username;
     miUserCreds.credentials.usernamePassword.password = password;
 	
-	miResult = MI_Application_Initialize(0, NULL, NULL, &miApplication);
-	if (miResult != MI_RESULT_OK)
+	miApplication = GetSharedApplication();
+	if (miApplication == NULL)
 	{
-		PyErr_SetString(MIError,"MI_Application_Initialize failed");
+		Py_XDECREF(poolKey);
 		return NULL;
 	}		
 
-	miResult = MI_Application_NewDestinationOptions(&miApplication, &miDestinationOptions);
+	miResult = MI_Application_NewDestinationOptions(miApplication, &miDestinationOptions);
     if (miResult != MI_RESULT_OK) 
 	{
-        return CleanupApplication(miDestinationOptions, miApplication, miResult);
+		Py_XDECREF(poolKey);
+        return CleanupApplication(miDestinationOptions, miResult);
 	}
 
 	miResult = MI_DestinationOptions_AddDestinationCredentials(&miDestinationOptions, &miUserCreds);
     if (miResult != MI_RESULT_OK)
     {
-	   return CleanupApplication(miDestinationOptions, miApplication, miResult);
+		Py_XDECREF(poolKey);
+	   return CleanupApplication(miDestinationOptions, miResult);
 	}
 
-	miResult = MI_Application_NewSession(&miApplication, NULL, NULL, &miDestinationOptions, NULL, NULL, &miSession);
+	PMI_ALLOW_THREADS(miResult = MI_Application_NewSession(miApplication, NULL, destination, &miDestinationOptions, NULL, NULL, &miSession));
     if (miResult != MI_RESULT_OK)
 	{
-        return CleanupApplication(miDestinationOptions, miApplication, miResult);
+		Py_XDECREF(poolKey);
+        return CleanupApplication(miDestinationOptions, miResult);
 	}
 	/*Make sure the connection is successful */
 	miResult = TestConnection(&miSession);
 	if(miResult != MI_RESULT_OK)
 	{
+		Py_XDECREF(poolKey);
+		CleanupSession(miDestinationOptions, miResult, miSession);
 		PyErr_SetString(MIError,"Connection failed.Check the server status and credentials");
 		return NULL;
 	}
+	MI_DestinationOptions_Delete(&miDestinationOptions);
 
-	session->miSession = miSession;
-	Py_INCREF(session);
-	return (PyObject *)session;
+	return NewConnectedSession(miSession,poolKey,NULL);
+}
+
+static PyObject *ConfigurePool(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	long maxSize = poolMaxSize;
+	double idleTimeout = poolIdleTimeout;
+	double healthCheckInterval = poolHealthCheckInterval;
+	static char *kwlist[] = {"maxSize","idleTimeout","healthCheckInterval",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|ldd",kwlist,&maxSize,&idleTimeout,&healthCheckInterval))
+	{
+		PyErr_SetString(MIError,"Please input correct maxSize, idleTimeout and healthCheckInterval");
+		return NULL;
+	}
+	if(maxSize < 0 || idleTimeout < 0)
+	{
+		PyErr_SetString(MIError,"maxSize and idleTimeout cannot be negative");
+		return NULL;
+	}
+	poolMaxSize = maxSize;
+	poolIdleTimeout = idleTimeout;
+	poolHealthCheckInterval = healthCheckInterval;
+	/* Sessions over the new limits are closed as they come back or time out */
+	EvictPooledSessions(poolMaxSize == 0);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+/* Idle sessions past the idle timeout are only closed when a session is connected or put back, so a process that
+   stops connecting calls clear_pool(expiredOnly=True) to close them, or clear_pool() to close every idle session.
+   Returns how many sessions were closed */
+static PyObject *ClearPool(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *expiredOnly = Py_False;
+	static char *kwlist[] = {"expiredOnly",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|O",kwlist,&expiredOnly))
+	{
+		PyErr_SetString(MIError,"Please input correct expiredOnly");
+		return NULL;
+	}
+	return PyInt_FromLong(EvictPooledSessions(!PyObject_IsTrue(expiredOnly)));
 }
 
 
@@ -113,17 +273,16 @@ static PyObject *CreateLocalInstance(PyObject *self, PyObject *args, PyObject *k
     }
 
     MI_Result miResult;
-    MI_Application miApplication = MI_APPLICATION_NULL;
+    MI_Application *miApplication;
     MI_Instance *miInstance = NULL;
 
-	miResult = MI_Application_Initialize(0, NULL, NULL, &miApplication);
-	if (miResult != MI_RESULT_OK)
+	miApplication = GetSharedApplication();
+	if (miApplication == NULL)
 	{
-		PyErr_SetString(MIError,"MI_Application Initialize failed");
 		return NULL;
 	}		
 
-	miResult = MI_Application_NewInstance(&miApplication,className,NULL,&miInstance);
+	miResult = MI_Application_NewInstance(miApplication,className,NULL,&miInstance);
 	if(miResult != MI_RESULT_OK)
 	{
 		char error[200];
@@ -209,6 +368,27 @@ static PyObject *CreateLocalInstance(PyObject *self, PyObject *args, PyObject *k
    	return (PyObject *)pmiInstance;
 }
 
+/* Return a copy of an instance with its properties decoded from the MI instance, the way a session decodes the
+   instances it returns */
+static PyObject *DecodeInstance(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *instance;
+	PyObject *lazy = Py_False;
+	PyObject *arrayBuffers = Py_False;
+	static char *kwlist[] = {"instance","lazy","arrayBuffers",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"O!|OO",kwlist,&PMI_InstanceType,&instance,&lazy,&arrayBuffers))
+	{
+		return NULL;
+	}
+	if(((PMI_Instance *)instance)->miInstance == NULL)
+	{
+		PyErr_SetString(MIError,"MI_Instance cannot be null!");
+		return NULL;
+	}
+	return WrapEmbeddedInstance(((PMI_Instance *)instance)->miInstance,
+		(PyObject_IsTrue(lazy) ? PMI_DECODE_LAZY : 0) | (PyObject_IsTrue(arrayBuffers) ? PMI_DECODE_ARRAYBUFFERS : 0));
+}
+
 void DatetimeToStr(const MI_Datetime* x, _Out_writes_z_(26) MI_Char buf[26])
 {
     if (x->isTimestamp)
@@ -375,487 +555,422 @@ static char* MI_Type_To_String(MI_Type miType)
 	return "";
 }
 
-//forward declaration
-void Print_Element_Value( const MI_Value *elementValue, MI_Type elementType, size_t level);
+/* Output formats of the instance serializer */
+#define PMI_FORMAT_TEXT 0
+#define PMI_FORMAT_JSON 1
+#define PMI_FORMAT_JSONL 2
+
+static int AppendFormat(PMI_Buffer *buffer, const char *format, ...)
+{
+	va_list args;
+	int length;
+	va_start(args,format);
+	length = vsnprintf(NULL,0,format,args);
+	va_end(args);
+	/* Reserve room for the terminating NUL written by vsnprintf, it isn't kept */
+	if(length < 0 || !AppendBuffer(buffer,NULL,length + 1))
+	{
+		return 0;
+	}
+	buffer->size -= length + 1;
+	va_start(args,format);
+	vsnprintf(buffer->data + buffer->size,length + 1,format,args);
+	va_end(args);
+	buffer->size += length;
+	return 1;
+}
+
+static int AppendString(PMI_Buffer *buffer, const char *value)
+{
+	return AppendBuffer(buffer,value,strlen(value));
+}
 
-void Indent(size_t level)
+static int Indent(PMI_Buffer *buffer, size_t level)
 {
 	size_t n = level *4;
 	while(n--)
-		PySys_WriteStdout(" ");
+	{
+		if(!AppendBuffer(buffer," ",1))
+			return 0;
+	}
+	return 1;
 }
 
-/* Print an element */
-void Print_Element(
-    const MI_Char *elementName, 
-    const MI_Value *elementValue, 
-    MI_Type elementType, 
-    MI_Uint32 elementFlags, 
-    size_t level)
+/* Start a new line in the indented JSON format, nothing for JSON Lines */
+static int JsonNewline(PMI_Buffer *buffer, int format, size_t level)
 {
-    Indent(level);
-    PySys_WriteStdout("%s [%s", elementName, MI_Type_To_String(elementType));
-
-    if (elementFlags & MI_FLAG_KEY)
-    {
-        PySys_WriteStdout(", MI_FLAG_KEY");
-    }
+	if(format != PMI_FORMAT_JSON)
+	{
+		return 1;
+	}
+	return AppendBuffer(buffer,"\n",1) && Indent(buffer,level);
+}
 
-    if ((elementFlags & MI_FLAG_NULL) || (elementValue == NULL))
-    {
-        PySys_WriteStdout(", NULL]");
-        return;
-    }
-    else 
-    {
-        PySys_WriteStdout("] ");
+static int AppendJsonString(PMI_Buffer *buffer, const char *value)
+{
+	const unsigned char *p;
+	if(!AppendBuffer(buffer,"\"",1))
+	{
+		return 0;
+	}
+	for(p = (const unsigned char *)value; *p; p++)
+	{
+		int ok;
+		if(*p == '"' || *p == '\\')
+		{
+			char escaped[2] = {'\\', (char)*p};
+			ok = AppendBuffer(buffer,escaped,2);
+		}
+		else if(*p < 0x20)
+		{
+			ok = AppendFormat(buffer,"\\u%04x",*p);
+		}
+		else
+		{
+			ok = AppendBuffer(buffer,p,1);
+		}
+		if(!ok)
+		{
+			return 0;
+		}
+	}
+	return AppendBuffer(buffer,"\"",1);
+}
 
-        Print_Element_Value(elementValue, elementType, level);
-    }
+/* Size of one element of an MI_*A array of the type, 0 for a non-array type */
+static size_t ArrayElementSize(MI_Type elementType)
+{
+	switch(elementType)
+	{
+	case MI_BOOLEANA: return sizeof(MI_Boolean);
+	case MI_UINT8A: return sizeof(MI_Uint8);
+	case MI_SINT8A: return sizeof(MI_Sint8);
+	case MI_UINT16A: return sizeof(MI_Uint16);
+	case MI_SINT16A: return sizeof(MI_Sint16);
+	case MI_UINT32A: return sizeof(MI_Uint32);
+	case MI_SINT32A: return sizeof(MI_Sint32);
+	case MI_UINT64A: return sizeof(MI_Uint64);
+	case MI_SINT64A: return sizeof(MI_Sint64);
+	case MI_REAL32A: return sizeof(MI_Real32);
+	case MI_REAL64A: return sizeof(MI_Real64);
+	case MI_CHAR16A: return sizeof(MI_Char16);
+	case MI_DATETIMEA: return sizeof(MI_Datetime);
+	case MI_STRINGA: return sizeof(MI_Char *);
+	case MI_REFERENCEA:
+	case MI_INSTANCEA: return sizeof(MI_Instance *);
+	default: return 0;
+	}
 }
 
+static int Serialize_MI_Instance(PMI_Buffer *buffer, const MI_Instance *miInstance, MI_Boolean keysOnly, size_t level, int format);
 
+static int Serialize_Element_Value(PMI_Buffer *buffer, const MI_Value *elementValue, MI_Type elementType, size_t level, int format)
+{
+	int json = format != PMI_FORMAT_TEXT;
+	size_t elementSize = ArrayElementSize(elementType);
+	if(elementSize != 0 && elementType != MI_INSTANCEA && elementType != MI_REFERENCEA)
+	{
+		/* All the MI_*A structures start with the data pointer followed by the size */
+		const MI_Uint8A *array = &elementValue->uint8a;
+		MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
+		MI_Uint32 i;
+		if(!AppendString(buffer,json ? "[" : "{"))
+		{
+			return 0;
+		}
+		for(i = 0; i < array->size; i++)
+		{
+			MI_Value value;
+			memcpy(&value,array->data + i * elementSize,elementSize);
+			if(i != 0 && !AppendString(buffer,", "))
+			{
+				return 0;
+			}
+			if(!json && elementType == MI_STRINGA)
+			{
+				if(!AppendString(buffer,value.string))
+					return 0;
+			}
+			else if(!Serialize_Element_Value(buffer,&value,nonArrayType,level,format))
+			{
+				return 0;
+			}
+		}
+		return AppendString(buffer,json ? "]" : "}");
+	}
 
-void Dump_MI_Instance(MI_Instance *miInstance, MI_Boolean keysOnly, size_t level)
+	switch (elementType)
+	{
+		case MI_BOOLEAN:
+			if(json)
+				return AppendString(buffer,elementValue->boolean ? "true" : "false");
+			return AppendString(buffer,elementValue->boolean ? "True" : "False");
+		case MI_SINT8:
+			return AppendFormat(buffer,"%hd",elementValue->sint8);
+		case MI_UINT8:
+			return AppendFormat(buffer,"%hu",elementValue->uint8);
+		case MI_SINT16:
+			return AppendFormat(buffer,"%d",elementValue->sint16);
+		case MI_UINT16:
+			return AppendFormat(buffer,"%u",elementValue->uint16);
+		case MI_SINT32:
+			return AppendFormat(buffer,"%i",elementValue->sint32);
+		case MI_UINT32:
+			return AppendFormat(buffer,"%u",elementValue->uint32);
+		case MI_SINT64:
+			return AppendFormat(buffer,"%lld",elementValue->sint64);
+		case MI_UINT64:
+			return AppendFormat(buffer,"%llu",elementValue->uint64);
+		case MI_REAL32:
+			if(json && !isfinite(elementValue->real32))
+				return AppendString(buffer,"null");
+			return AppendFormat(buffer,json ? "%.9g" : "%g",elementValue->real32);
+		case MI_REAL64:
+			if(json && !isfinite(elementValue->real64))
+				return AppendString(buffer,"null");
+			return AppendFormat(buffer,json ? "%.17g" : "%lg",elementValue->real64);
+		case MI_CHAR16:
+			return AppendFormat(buffer,"%u",elementValue->char16);
+		case MI_DATETIME:
+		{
+			MI_Char buf[26];
+			DatetimeToStr(&elementValue->datetime, buf);
+			return json ? AppendJsonString(buffer,buf) : AppendString(buffer,buf);
+		}
+		case MI_STRING:
+			return json ? AppendJsonString(buffer,elementValue->string) : AppendString(buffer,elementValue->string);
+		case MI_INSTANCE:
+			return Serialize_MI_Instance(buffer,elementValue->instance,MI_FALSE,level,format);
+		case MI_REFERENCE:
+			if(!json && !AppendString(buffer," REF "))
+				return 0;
+			return Serialize_MI_Instance(buffer,elementValue->reference,MI_TRUE,level,format);
+		case MI_INSTANCEA:
+		case MI_REFERENCEA:
+		{
+			const MI_InstanceA* inst = &elementValue->instancea;
+			MI_Boolean keysOnly = elementType == MI_REFERENCEA ? MI_TRUE : MI_FALSE;
+			MI_Uint32 i;
+			if(json)
+			{
+				if(!AppendString(buffer,"["))
+					return 0;
+				for(i = 0; i < inst->size; i++)
+				{
+					if((i != 0 && !AppendString(buffer,", ")) || !JsonNewline(buffer,format,level + 1) ||
+						!Serialize_MI_Instance(buffer,inst->data[i],keysOnly,level + 1,format))
+						return 0;
+				}
+				return (inst->size == 0 || JsonNewline(buffer,format,level)) && AppendString(buffer,"]");
+			}
+			if(keysOnly && !AppendString(buffer," REF "))
+				return 0;
+			if(!AppendString(buffer,"\n") || !Indent(buffer,level) || !AppendString(buffer,"{\n"))
+				return 0;
+			for(i = 0; i < inst->size; i++)
+			{
+				if(!Serialize_MI_Instance(buffer,inst->data[i],keysOnly,level + 1,format))
+					return 0;
+			}
+			return Indent(buffer,level) && AppendString(buffer,"}");
+		}
+		default:
+			return json ? AppendString(buffer,"null") : 1;
+	}
+}
+
+/* Render an instance, or only its keys, in the text format of print_instance or as a JSON object
+   {"className": ..., "properties": {...}} */
+static int Serialize_MI_Instance(PMI_Buffer *buffer, const MI_Instance *miInstance, MI_Boolean keysOnly, size_t level, int format)
 {
+	MI_Uint32 elementCount;
+	MI_Uint32 elementIndex;
+	MI_Result miResult;
+	const MI_Char *className = NULL;
+	int json = format != PMI_FORMAT_TEXT;
+	int first = 1;
+
 	if(miInstance == NULL)
 	{
-		PyErr_SetString(MIError,"MI_Instance is null");
-		return;
+		return json ? AppendString(buffer,"null") : 1;
+	}
+	miResult = MI_Instance_GetElementCount(miInstance, &elementCount);
+	if (miResult != MI_RESULT_OK)
+	{
+		PyErr_SetString(MIError,"MI_Instance_GetElementCount failed");
+		return 0;
+	}
+	MI_Instance_GetClassName(miInstance, &className);
+	if(className == NULL)
+	{
+		className = "";
 	}
 
-	MI_Uint32 elementCount;
-    MI_Result miResult;
-    MI_Uint32 elementIndex;
+	if(json)
+	{
+		if(!AppendString(buffer,"{") || !JsonNewline(buffer,format,level + 1) ||
+			!AppendString(buffer,"\"className\": ") || !AppendJsonString(buffer,className) || !AppendString(buffer,",") ||
+			!JsonNewline(buffer,format,level + 1) || !AppendString(buffer,"\"properties\": {"))
+			return 0;
+	}
+	else
+	{
+		if(!Indent(buffer,level) || !AppendFormat(buffer,"Class %s\n",className) || !Indent(buffer,level) || !AppendString(buffer,"{\n"))
+			return 0;
+	}
 
-    miResult = MI_Instance_GetElementCount(miInstance, &elementCount);
-    if (miResult != MI_RESULT_OK)
-    {
-        PyErr_SetString(MIError,"MI_Instance_GetElementCount failed");
-    }
-    Indent(level);
-    PySys_WriteStdout("Class %s\n", miInstance->classDecl->name);
-    Indent(level);     
-	PySys_WriteStdout("{\n");
-    Indent(level);
+	for (elementIndex = 0; elementIndex != elementCount; elementIndex++)
+	{
+		const MI_Char *elementName;
+		MI_Value elementValue;
+		MI_Type elementType;
+		MI_Uint32 elementFlags;
+		int isNull;
+
+		miResult = MI_Instance_GetElementAt(miInstance, elementIndex, &elementName, &elementValue, &elementType, &elementFlags);
+		if (miResult != MI_RESULT_OK)
+		{
+			PyErr_SetString(MIError,"MI_Instance_GetElementAt failed");
+			return 0;
+		}
+		if (keysOnly && !(elementFlags & MI_FLAG_KEY))
+		{
+			continue;
+		}
+		isNull = (elementFlags & MI_FLAG_NULL) != 0;
 
-    for (elementIndex = 0; elementIndex != elementCount; elementIndex++)
-    {
-        const MI_Char *elementName;
-        MI_Value elementValue;
-        MI_Type elementType;
-        MI_Uint32 elementFlags;
+		if(json)
+		{
+			if((!first && !AppendString(buffer,",")) || !JsonNewline(buffer,format,level + 2) ||
+				!AppendJsonString(buffer,elementName) || !AppendString(buffer,": "))
+				return 0;
+			if(isNull ? !AppendString(buffer,"null") : !Serialize_Element_Value(buffer,&elementValue,elementType,level + 2,format))
+				return 0;
+		}
+		else
+		{
+			if(!Indent(buffer,level + 1) || !AppendFormat(buffer,"%s [%s",elementName,MI_Type_To_String(elementType)))
+				return 0;
+			if((elementFlags & MI_FLAG_KEY) && !AppendString(buffer,", MI_FLAG_KEY"))
+				return 0;
+			if(isNull ? !AppendString(buffer,", NULL]") :
+				(!AppendString(buffer,"] ") || !Serialize_Element_Value(buffer,&elementValue,elementType,level + 1,format)))
+				return 0;
+			if(!AppendString(buffer,"\n"))
+				return 0;
+		}
+		first = 0;
+	}
 
-        miResult = MI_Instance_GetElementAt(miInstance, elementIndex, &elementName, &elementValue, &elementType, &elementFlags);
-        if (miResult != MI_RESULT_OK)
-        {
-            PyErr_SetString(MIError,"MI_Instance_GetElementCount failed");
-        }
-        if ((keysOnly && (elementFlags & MI_FLAG_KEY)) || 
-            !keysOnly)
-        {
-            Print_Element(elementName, &elementValue, elementType, elementFlags, level+1);
-            PySys_WriteStdout("\n");
-        }
-    }
-    Indent(level);
-    PySys_WriteStdout("}\n");
+	if(json)
+	{
+		return (first || JsonNewline(buffer,format,level + 1)) && AppendString(buffer,"}") &&
+			JsonNewline(buffer,format,level) && AppendString(buffer,"}");
+	}
+	return Indent(buffer,level) && AppendString(buffer,"}\n");
 }
 
-void Print_Element_Value(
-    const MI_Value *elementValue, 
-    MI_Type elementType, 
-    size_t level)
+static int ParseSerializeFormat(const char *formatName)
 {
-        switch (elementType)
-        {
-            case MI_BOOLEAN:
-            {
-                PySys_WriteStdout("%s", elementValue->boolean ? "True" : "False");
-                break;
-            }
-            case MI_SINT8:
-            {
-                PySys_WriteStdout("%hd", elementValue->sint8);
-                break;
-            }
-            case MI_UINT8:
-            {
-                PySys_WriteStdout("%hu", elementValue->uint8);
-                break;
-            }
-            case MI_SINT16:
-            {
-                PySys_WriteStdout("%d", elementValue->sint16);
-                break;
-            }
-            case MI_UINT16:
-            {
-                PySys_WriteStdout("%u", elementValue->uint16);
-                break;
-            }
-            case MI_SINT32:
-            {
-                PySys_WriteStdout("%i", elementValue->sint32);
-                break;
-            }
-            case MI_UINT32:
-            {
-                PySys_WriteStdout("%u", elementValue->uint32);
-                break;
-            }
-            case MI_SINT64:
-            {
-                PySys_WriteStdout("%lld", elementValue->sint64);
-                break;
-            }
-            case MI_UINT64:
-            {
-                PySys_WriteStdout("%llu", elementValue->uint64);
-                break;
-            }
-            case MI_REAL32:
-            {
-                PySys_WriteStdout("%g", elementValue->real32);
-                break;
-            }
-            case MI_REAL64:
-            {
-                PySys_WriteStdout("%lg", elementValue->real64);
-                break;
-            }
-            case MI_CHAR16:
-            {
-                PySys_WriteStdout("%u", elementValue->char16);
-                break;
-            }
-            case MI_DATETIME:
-            {
-                MI_Char buf[26];
-                DatetimeToStr(&elementValue->datetime, buf);
-                PySys_WriteStdout("%s", buf);
-                break;
-            }
-            case MI_STRING:
-            {
-                PySys_WriteStdout("%s", elementValue->string);
-                break;
-            }
-            case MI_BOOLEANA:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->booleana.size; i++)
-                {
-                    MI_Value value;
-                    value.boolean = elementValue->booleana.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_SINT8A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->sint8a.size; i++)
-                {
-                    MI_Value value;
-                    value.sint8 = elementValue->sint8a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_UINT8A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->uint8a.size; i++)
-                {
-                    MI_Value value;
-                    value.uint8 = elementValue->uint8a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_SINT16A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->sint16a.size; i++)
-                {
-                    MI_Value value;
-                    value.sint16 = elementValue->sint16a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_UINT16A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->uint16a.size; i++)
-                {
-                    MI_Value value;
-                    value.uint16 = elementValue->uint16a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_SINT32A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->sint32a.size; i++)
-                {
-                    MI_Value value;
-                    value.sint32 = elementValue->sint32a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_UINT32A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->uint32a.size; i++)
-                {
-                    MI_Value value;
-                    value.uint32 = elementValue->uint32a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_SINT64A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->sint64a.size; i++)
-                {
-                    MI_Value value;
-                    value.sint64 = elementValue->sint64a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-               PySys_WriteStdout("}");
-                break;
-            }
-            case MI_UINT64A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->uint64a.size; i++)
-                {
-                    MI_Value value;
-                    value.uint64 = elementValue->uint64a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_REAL32A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->real32a.size; i++)
-                {
-                    MI_Value value;
-                    value.real32 = elementValue->real32a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_REAL64A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->real64a.size; i++)
-                {
-                    MI_Value value;
-                    value.real64 = elementValue->real64a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_CHAR16A:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->char16a.size; i++)
-                {
-                    MI_Value value;
-                    value.char16 = elementValue->char16a.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_DATETIMEA:
-            {
-                MI_Uint32 i;
-                MI_Type nonArrayType = (MI_Type) (elementType & (~MI_ARRAY));
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->datetimea.size; i++)
-                {
-                    MI_Value value;
-                    value.datetime = elementValue->datetimea.data[i];
-                    Print_Element_Value(&value, nonArrayType, level);
-                    if (i + 1 != elementValue->datetimea.size)
-                        PySys_WriteStdout(", ");
-                }
-                PySys_WriteStdout("}");
-                break;
-            }
-            case MI_STRINGA:
-            {
-                MI_Uint32 i;
-
-                PySys_WriteStdout("{");
-
-                for (i = 0; i < elementValue->stringa.size; i++)
-                {
-                    MI_Char *value;
-                    value = elementValue->stringa.data[i];
-                    PySys_WriteStdout(value);
-                    if (i + 1 != elementValue->stringa.size)
-                        PySys_WriteStdout(", ");
-                }
-               PySys_WriteStdout("}");
-                break;
-            }
-            case MI_INSTANCE:
-            {
-                MI_Instance* inst = elementValue->instance;
-
-                Dump_MI_Instance(inst, MI_FALSE, level);
-                break;
-            }
-            case MI_REFERENCE:
-            {
-                MI_Instance* inst = elementValue->reference;
-
-                PySys_WriteStdout(" REF ");
-
-                Dump_MI_Instance(inst, MI_TRUE, level);
-                break;
-            }
-            case MI_INSTANCEA:
-            {
-                const MI_InstanceA* inst = &elementValue->instancea;
-                MI_Uint32 i;
-
-                PySys_WriteStdout("\n");
-
-                Indent(level);
-                PySys_WriteStdout("{\n");
-
-                for (i = 0; i < inst->size; i++)
-                {
-                    Dump_MI_Instance(inst->data[i], MI_TRUE, level + 1);
-                }
-
-                Indent(level);
-                PySys_WriteStdout("}");
-
-                break;
-            }
-            case MI_REFERENCEA:
-            {
-                const MI_InstanceA* inst = &elementValue->instancea;
-                MI_Uint32 i;
-
-                PySys_WriteStdout(" REF ");
-
-                PySys_WriteStdout("\n");
-
-                Indent(level);
-                PySys_WriteStdout("{\n");
-
-                for (i = 0; i < inst->size; i++)
-                {
-                    Dump_MI_Instance(inst->data[i], MI_FALSE, level + 1);
-                }
-
-                Indent(level);
-                PySys_WriteStdout("}");
-
-                break;
-            }
-            default:
-                break;
-        }
+	if(formatName == NULL || strcmp(formatName,"text") == 0)
+		return PMI_FORMAT_TEXT;
+	if(strcmp(formatName,"json") == 0)
+		return PMI_FORMAT_JSON;
+	if(strcmp(formatName,"jsonl") == 0)
+		return PMI_FORMAT_JSONL;
+	PyErr_SetString(MIError,"The format must be text, json or jsonl");
+	return -1;
 }
 
+/* Render one PMI_Instance into a new Python string, JSON Lines output ends with a newline */
+static PyObject *SerializeInstance(PyObject *instance, int format)
+{
+	PMI_Buffer buffer = {NULL, 0, 0};
+	PyObject *result = NULL;
+	if(!PyObject_TypeCheck(instance,&PMI_InstanceType) || ((PMI_Instance *)instance)->miInstance == NULL)
+	{
+		PyErr_SetString(MIError,"MI_Instance cannot be null!");
+		return NULL;
+	}
+	if(Serialize_MI_Instance(&buffer,((PMI_Instance *)instance)->miInstance,MI_FALSE,0,format) &&
+		(format != PMI_FORMAT_JSONL || AppendString(&buffer,"\n")))
+	{
+		result = PyString_FromStringAndSize(buffer.data,buffer.size);
+	}
+	PyMem_Free(buffer.data);
+	return result;
+}
 
+/* Write one instance, or each instance of an iterable, to fileobj with a single write call per instance */
+static int WriteInstances(PyObject *instances, PyObject *fileobj, int format)
+{
+	PyObject *iterator;
+	PyObject *instance;
+	if(PyObject_TypeCheck(instances,&PMI_InstanceType))
+	{
+		PyObject *text = SerializeInstance(instances,format);
+		PyObject *ignored = text ? PyObject_CallMethod(fileobj,"write","O",text) : NULL;
+		Py_XDECREF(text);
+		Py_XDECREF(ignored);
+		return ignored != NULL;
+	}
+
+	iterator = PyObject_GetIter(instances);
+	if(iterator == NULL)
+	{
+		return 0;
+	}
+	while((instance = PyIter_Next(iterator)) != NULL)
+	{
+		int ok = WriteInstances(instance,fileobj,format);
+		Py_DECREF(instance);
+		if(!ok)
+		{
+			break;
+		}
+	}
+	Py_DECREF(iterator);
+	return !PyErr_Occurred();
+}
+
+static PyObject *Dumps(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *instance;
+	char *formatName = NULL;
+	int format;
+	static char *kwlist[] = {"instance","format",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"O|z",kwlist,&instance,&formatName))
+	{
+		PyErr_SetString(MIError,"Please input correct MI_Instance and format");
+		return NULL;
+	}
+	format = ParseSerializeFormat(formatName);
+	if(format < 0)
+	{
+		return NULL;
+	}
+	return SerializeInstance(instance,format);
+}
+
+static PyObject *Dump(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *instances, *fileobj;
+	char *formatName = NULL;
+	int format;
+	static char *kwlist[] = {"instance","fileobj","format",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"OO|z",kwlist,&instances,&fileobj,&formatName))
+	{
+		PyErr_SetString(MIError,"Please input correct MI_Instance, file object and format");
+		return NULL;
+	}
+	format = ParseSerializeFormat(formatName);
+	if(format < 0 || !WriteInstances(instances,fileobj,format))
+	{
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
 
 static PyObject *Print(PyObject *self,PyObject *args)
 {
@@ -865,31 +980,109 @@ static PyObject *Print(PyObject *self,PyObject *args)
 		PyErr_SetString(MIError,"Please input correct MI_Instance");
 		return NULL;
     }
-	PMI_Instance *pmiInstance = (PMI_Instance *)instance;
-	MI_Instance *miInstance;
-	if(pmiInstance != NULL && (PyObject_Compare((PyObject *)pmiInstance,Py_None)))
-	{	
-		miInstance = pmiInstance->miInstance;
+	PyObject *fileobj = PySys_GetObject("stdout");
+	if(fileobj == NULL)
+	{
+		PyErr_SetString(MIError,"sys.stdout is not available");
+		return NULL;
 	}
-	else
+	if(!WriteInstances(instance,fileobj,PMI_FORMAT_TEXT))
+	{
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *EnableStats(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *enabled = Py_True;
+	int wasEnabled = metricsEnabled;
+	static char *kwlist[] = {"enabled",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|O",kwlist,&enabled))
+	{
+		return NULL;
+	}
+	metricsEnabled = PyObject_IsTrue(enabled);
+	return PyBool_FromLong(wasEnabled);
+}
+
+static PyObject *Stats(PyObject *self, PyObject *args, PyObject *kwds)
+{
+	PyObject *reset = Py_False;
+	static char *kwlist[] = {"reset",NULL};
+	if(!PyArg_ParseTupleAndKeywords(args,kwds,"|O",kwlist,&reset))
 	{
-		PyErr_SetString(MIError,"MI_Instance cannot be null!");
 		return NULL;
 	}
+	PyObject *operations = MakeStatsDict(globalMetrics);
+	if(operations == NULL)
+	{
+		return NULL;
+	}
+	if(PyObject_IsTrue(reset))
+	{
+		ResetMetrics(globalMetrics);
+	}
+	return Py_BuildValue("{s:O,s:N}","enabled",metricsEnabled ? Py_True : Py_False,"operations",operations);
+}
 
-	Dump_MI_Instance(miInstance,MI_FALSE,0);
+static PyObject *ResetStats(PyObject *self)
+{
+	ResetMetrics(globalMetrics);
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
+static PyObject *SetTraceHook(PyObject *self, PyObject *args)
+{
+	PyObject *hook;
+	PyObject *previous = traceHook;
+	if(!PyArg_ParseTuple(args,"O",&hook))
+	{
+		return NULL;
+	}
+	if(hook != Py_None && !PyCallable_Check(hook))
+	{
+		PyErr_SetString(MIError,"The trace hook must be callable or None");
+		return NULL;
+	}
+	if(hook == Py_None)
+	{
+		traceHook = NULL;
+	}
+	else
+	{
+		Py_INCREF(hook);
+		traceHook = hook;
+	}
+	/* Return the hook replaced so a caller can chain to it */
+	if(previous == NULL)
+	{
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	return previous;
+}
+
 static PyMethodDef mi_funcs[] = {
-	{"connect",(PyCFunction)Connect,METH_VARARGS,NULL},
+	{"connect",(PyCFunction)Connect,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"configure_pool",(PyCFunction)ConfigurePool,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"clear_pool",(PyCFunction)ClearPool,METH_VARARGS|METH_KEYWORDS,NULL},
 	{"create_local_instance",(PyCFunction)CreateLocalInstance,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"decode_instance",(PyCFunction)DecodeInstance,METH_VARARGS|METH_KEYWORDS,NULL},
 	{"print_instance",(PyCFunction)Print,METH_VARARGS,NULL},
+	{"dumps",(PyCFunction)Dumps,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"dump",(PyCFunction)Dump,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"enable_stats",(PyCFunction)EnableStats,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"stats",(PyCFunction)Stats,METH_VARARGS|METH_KEYWORDS,NULL},
+	{"reset_stats",(PyCFunction)ResetStats,METH_NOARGS,NULL},
+	{"set_trace_hook",(PyCFunction)SetTraceHook,METH_VARARGS,NULL},
 	{NULL}
 };
 
-void initmi(void) {
+PyMODINIT_FUNC
+initmi(void) {
 	PyObject *m;
 	m = Py_InitModule3("mi", mi_funcs, "MI module that wraps up the MI operation from client API");
 	/*Add the exception type to the module */
@@ -897,6 +1090,13 @@ void initmi(void) {
 	Py_INCREF(MIError);
 	PyModule_AddObject(m,"MIError",MIError);
 
+	/* The types are readied once here, sessions and instances reuse them for the life of the process */
+	if (AddSessionTypes(m) < 0)
+		return;
+	PyDateTime_IMPORT;
+	/* Results of the begin_* operations are delivered on MI client threads */
+	PyEval_InitThreads();
+
 	/*enum types */
 	PyModule_AddIntConstant(m, "BOOLEAN",0);
 	PyModule_AddIntConstant(m,"UINT8",1);
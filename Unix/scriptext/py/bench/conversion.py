@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+"""Microbenchmarks of the mi binding conversion paths, no server needed.
+
+Synthetic instances are built with mi.create_local_instance and each case is
+timed at every width (number of properties) for --count operations, keeping
+the best of --repeat rounds:
+
+  create       create_local_instance, SetPropertyValues for every property
+  decode       decode_instance, MakePropertyDict and Get_Element_Value
+  decode_lazy  decode_instance(lazy=True) and read one property
+  get          read every property of a decoded instance
+  set          set every scalar property, SetProperty and SetPropertyValues
+  print        print_instance into a null stdout
+  dumps_json   dumps(format="json")
+
+    python bench/conversion.py --widths 8,64,256 --count 2000
+"""
+
+from __future__ import print_function
+
+import datetime
+import gc
+import json
+import sys
+import time
+from optparse import OptionParser
+
+import mi
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def embedded_instance():
+    values = {'Name': 'embedded', 'Value': 42}
+    types = {'Name': mi.STRING, 'Value': mi.UINT32}
+    return mi.create_local_instance('Bench_Embedded', values, types, dict.fromkeys(values, 0))
+
+
+# (type, value factory) cycled through to fill an instance of the requested width
+PROPERTY_KINDS = [
+    (mi.UINT8, lambda i: i % 256),
+    (mi.SINT32, lambda i: -i),
+    (mi.UINT64, lambda i: i * 1000003),
+    (mi.REAL64, lambda i: i / 3.0),
+    (mi.BOOLEAN, lambda i: i % 2 == 0),
+    (mi.STRING, lambda i: 'value-%d' % i),
+    (mi.DATETIME, lambda i: datetime.datetime(2020, 1, 1 + i % 28, 12, 30, 15)),
+    (mi.UINT32A, lambda i: list(range(16))),
+    (mi.STRINGA, lambda i: ['item-%d' % n for n in range(8)]),
+    (mi.INSTANCE, lambda i: embedded_instance()),
+]
+
+SCALAR_TYPES = (mi.UINT8, mi.SINT32, mi.UINT64, mi.REAL64, mi.BOOLEAN, mi.STRING)
+
+
+def make_properties(width):
+    values, types = {}, {}
+    for i in range(width):
+        kind, factory = PROPERTY_KINDS[i % len(PROPERTY_KINDS)]
+        name = 'Property%d' % i
+        values[name] = factory(i)
+        types[name] = kind
+    return values, types
+
+
+def make_instance(values, types):
+    return mi.create_local_instance('Bench_Instance', dict(values), types, dict.fromkeys(values, 0))
+
+
+class NullWriter(object):
+
+    def write(self, data):
+        pass
+
+
+def allocated_blocks():
+    # Python 2 has no allocation counter, only the gc tracked objects can be counted there
+    if hasattr(sys, 'getallocatedblocks'):
+        return sys.getallocatedblocks()
+    return len(gc.get_objects())
+
+
+def make_cases(width):
+    values, types = make_properties(width)
+    local = make_instance(values, types)
+    decoded = mi.decode_instance(local)
+    names = sorted(values)
+    scalars = [(name, values[name]) for name in names if types[name] in SCALAR_TYPES]
+
+    def create():
+        make_instance(values, types)
+
+    def decode():
+        mi.decode_instance(local)
+
+    def decode_lazy():
+        getattr(mi.decode_instance(local, lazy=True), names[0])
+
+    def get():
+        for name in names:
+            getattr(decoded, name)
+
+    def set_():
+        for name, value in scalars:
+            setattr(local, name, value)
+
+    def print_():
+        stdout = sys.stdout
+        sys.stdout = NullWriter()
+        try:
+            mi.print_instance(local)
+        finally:
+            sys.stdout = stdout
+
+    def dumps_json():
+        mi.dumps(local, format='json')
+
+    return [
+        ('create', create),
+        ('decode', decode),
+        ('decode_lazy', decode_lazy),
+        ('get', get),
+        ('set', set_),
+        ('print', print_),
+        ('dumps_json', dumps_json),
+    ]
+
+
+def measure(function, count, repeat):
+    """Best seconds per operation over repeat rounds and the blocks left allocated per operation."""
+    function()
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        for _ in range(count):
+            function()
+        elapsed = (time.time() - started) / count
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = allocated_blocks()
+        for _ in range(count):
+            function()
+        retained = (allocated_blocks() - before) / float(count)
+    finally:
+        gc.enable()
+    return best, retained
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-w", "--widths", action="store", type="string", dest="widths", default="8,64,256",
+                      help="Comma separated numbers of properties per instance")
+    parser.add_option("-c", "--count", action="store", type="int", dest="count", default=1000,
+                      help="Operations per round")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", default=3,
+                      help="Rounds per case, the fastest is reported")
+    parser.add_option("-k", "--cases", action="store", type="string", dest="cases",
+                      help="Comma separated cases to run, all by default")
+    parser.add_option("-j", "--json", action="store_true", dest="json", default=False,
+                      help="Print the results as JSON for comparing runs")
+    (options, args) = parser.parse_args()
+
+    widths = [int(width) for width in options.widths.split(',')]
+    selected = options.cases.split(',') if options.cases else None
+    results = []
+    if not options.json:
+        print("%-12s %6s %12s %12s %12s" % ("case", "width", "ops/sec", "usec/op", "blocks/op"))
+
+    for width in widths:
+        for name, function in make_cases(width):
+            if selected and name not in selected:
+                continue
+            seconds, retained = measure(function, options.count, options.repeat)
+            result = {
+                'case': name,
+                'width': width,
+                'ops_per_sec': 1.0 / seconds if seconds else 0.0,
+                'usec_per_op': seconds * 1e6,
+                'blocks_per_op': retained,
+            }
+            results.append(result)
+            if not options.json:
+                print("%-12s %6d %12.0f %12.2f %12.2f" % (name, width, result['ops_per_sec'],
+                                                       result['usec_per_op'], retained))
+
+    summary = {
+        'python': sys.version.split()[0],
+        'count': options.count,
+        'repeat': options.repeat,
+        'results': results,
+    }
+    if resource is not None:
+        summary['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if options.json:
+        print(json.dumps(summary, indent=4, sort_keys=True))
+    elif 'max_rss_kb' in summary:
+        print("max rss: %d KiB" % summary['max_rss_kb'])
+
+
+if __name__ == '__main__':
+    main()
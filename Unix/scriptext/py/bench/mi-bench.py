@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""mi-bench: load generator for omiserver and the mi binding on one box.
+
+Starts omiserver from the build output with the OMI_Perf sample provider
+(Unix/samples/Providers/Perf) serving --instances synthetic instances with
+--width string properties each. Then --concurrency threads, each with its
+own session, run a weighted mix of enumerate/get/invoke/query operations
+for --duration seconds. Reports throughput and latency percentiles per
+operation.
+
+    python bench/mi-bench.py --instances 1000 --width 20 --concurrency 8 \\
+        --mix enumerate=1,get=20,invoke=5,query=2 --duration 30
+
+--build compiles and registers the provider first, --no-server drives an
+omiserver that is already running with the provider registered.
+"""
+
+from __future__ import division, print_function
+
+import getpass
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import mi
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UNIX_DIR = os.path.abspath(os.path.join(HERE, '..', '..', '..'))
+PROVIDER_DIR = os.path.join(UNIX_DIR, 'samples', 'Providers', 'Perf')
+NAMESPACE = 'root/omi'
+CLASS_NAME = 'OMI_Perf'
+OPERATIONS = ('enumerate', 'get', 'invoke', 'query')
+
+
+def parse_mix(value):
+    mix = []
+    for entry in value.split(','):
+        name, _, weight = entry.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation '%s', expecting one of %s" % (name, ', '.join(OPERATIONS)))
+        weight = float(weight or 1)
+        if weight > 0:
+            mix.append((name, weight))
+    if not mix:
+        raise ValueError("The operation mix is empty")
+    return mix
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(math.ceil(fraction * len(values))) - 1))
+    return values[index]
+
+
+def build_provider():
+    """Compile the OMI_Perf provider against the configured tree and register it in root/omi."""
+    subprocess.check_call(['make', '-C', PROVIDER_DIR])
+    subprocess.check_call(['make', '-C', PROVIDER_DIR, 'reg'])
+
+
+class LocalServer(object):
+    """omiserver from the build output, started with authentication disabled on the default socket."""
+
+    def __init__(self, output_dir, instances, width, livetime):
+        self.program = os.path.join(output_dir, 'bin', 'omiserver')
+        self.instances = instances
+        self.width = width
+        self.livetime = livetime
+        self.process = None
+
+    def __enter__(self):
+        if not os.path.exists(self.program):
+            raise RuntimeError("omiserver not found at '%s', build OMI first or set OMI_OUTPUT_DIR" % self.program)
+
+        env = dict(os.environ)
+        env['OMI_PERF_INSTANCES'] = str(self.instances)
+        env['OMI_PERF_WIDTH'] = str(self.width)
+        args = [self.program, '--ignoreAuthentication', '--livetime', str(self.livetime)]
+        if os.geteuid() != 0:
+            args.append('--nonroot')
+        self.process = subprocess.Popen(args, env=env)
+        return self
+
+    def __exit__(self, *args):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def connect(options, timeout=30):
+    """Connect to the local server, waiting for it to accept connections."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return mi.connect(options.domain, options.username, options.password, pooled=False)
+        except mi.MIError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+class StartGate(object):
+    """Holds the workers until all of them are done connecting, so the clock starts with every session open."""
+
+    def __init__(self, count):
+        self.condition = threading.Condition()
+        self.connecting = count
+        self.opened = False
+
+    def connected(self):
+        """Called by each worker once its connect succeeded or failed."""
+        with self.condition:
+            self.connecting -= 1
+            self.condition.notify_all()
+
+    def wait_connected(self):
+        with self.condition:
+            while self.connecting > 0:
+                self.condition.wait()
+
+    def open(self):
+        with self.condition:
+            self.opened = True
+            self.condition.notify_all()
+
+    def wait_open(self):
+        with self.condition:
+            while not self.opened:
+                self.condition.wait()
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, options, mix, deadline, gate):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.options = options
+        self.mix = mix
+        self.deadline = deadline
+        self.gate = gate
+        self.random = random.Random()
+        self.latencies = dict((name, []) for name in OPERATIONS)
+        self.errors = dict.fromkeys(OPERATIONS, 0)
+        self.instances = dict.fromkeys(OPERATIONS, 0)
+        self.error = None
+
+    def choose(self):
+        point = self.random.uniform(0, sum(weight for _, weight in self.mix))
+        for name, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return name
+        return self.mix[-1][0]
+
+    def run_operation(self, session, name):
+        options = self.options
+        if name == 'enumerate':
+            return len(session.enumerate_instances(NAMESPACE, CLASS_NAME))
+        elif name == 'get':
+            key = self.random.randint(0, max(0, options.instances - 1))
+            session.get_instance(NAMESPACE, CLASS_NAME, {'Key': key})
+            return 1
+        elif name == 'invoke':
+            session.invoke(NAMESPACE, 'Ping', className=CLASS_NAME)
+            return 1
+        else:
+            query = 'SELECT * FROM %s WHERE Key < %d' % (CLASS_NAME, options.query_size)
+            return len(session.query(NAMESPACE, 'WQL', query))
+
+    def run(self):
+        try:
+            session = connect(self.options)
+        except mi.MIError as error:
+            self.error = error
+            return
+        finally:
+            self.gate.connected()
+
+        self.gate.wait_open()
+        try:
+            while time.time() < self.deadline[0]:
+                name = self.choose()
+                begin = time.time()
+                try:
+                    count = self.run_operation(session, name)
+                except mi.MIError:
+                    self.errors[name] += 1
+                    continue
+                self.latencies[name].append(time.time() - begin)
+                self.instances[name] += count
+        finally:
+            session.close()
+
+
+def run_load(options, mix):
+    deadline = [0]
+    gate = StartGate(options.concurrency)
+    workers = [Worker(options, mix, deadline, gate) for _ in range(options.concurrency)]
+    for worker in workers:
+        worker.start()
+
+    # Every worker connects, or gives up, before the clock starts
+    gate.wait_connected()
+    begin = time.time()
+    deadline[0] = begin + options.duration
+    gate.open()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - begin
+
+    failed = [worker.error for worker in workers if worker.error is not None]
+    if failed:
+        raise RuntimeError("%d workers could not connect: %s" % (len(failed), failed[0]))
+
+    results = {}
+    for name in OPERATIONS:
+        latencies = sorted(latency for worker in workers for latency in worker.latencies[name])
+        errors = sum(worker.errors[name] for worker in workers)
+        instances = sum(worker.instances[name] for worker in workers)
+        if not latencies and not errors:
+            continue
+        results[name] = {
+            'count': len(latencies),
+            'errors': errors,
+            'ops_per_sec': len(latencies) / elapsed,
+            'instances_per_sec': instances / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        }
+    return elapsed, results
+
+
+def print_results(elapsed, results):
+    print("%-10s %8s %7s %10s %12s %9s %9s %9s %9s" % ("operation", "count", "errors", "ops/sec", "inst/sec",
+                                                       "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name in OPERATIONS:
+        if name not in results:
+            continue
+        result = results[name]
+        print("%-10s %8d %7d %10.1f %12.1f %9.2f %9.2f %9.2f %9.2f" % (
+            name, result['count'], result['errors'], result['ops_per_sec'], result['instances_per_sec'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms']))
+    total = sum(result['count'] for result in results.values())
+    print("total: %d operations in %.1fs, %.1f ops/sec" % (total, elapsed, total / elapsed if elapsed else 0))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--instances", action="store", type="int", dest="instances", default=1000,
+                      help="Instances served by the provider")
+    parser.add_option("-w", "--width", action="store", type="int", dest="width", default=20,
+                      help="String properties set on each instance, at most 20")
+    parser.add_option("-c", "--concurrency", action="store", type="int", dest="concurrency", default=4,
+                      help="Concurrent sessions, one thread each")
+    parser.add_option("-m", "--mix", action="store", type="string", dest="mix",
+                      default="enumerate=1,get=10,invoke=5,query=2",
+                      help="Weighted operation mix, name=weight pairs of %s" % ", ".join(OPERATIONS))
+    parser.add_option("-t", "--duration", action="store", type="float", dest="duration", default=10,
+                      help="Seconds to run the load for")
+    parser.add_option("-q", "--query-size", action="store", type="int", dest="query_size", default=100,
+                      help="Instances matched by the query operation")
+    parser.add_option("-o", "--output-dir", action="store", type="string", dest="output_dir",
+                      default=os.environ.get('OMI_OUTPUT_DIR', os.path.join(UNIX_DIR, 'output')),
+                      help="OMI build output directory holding bin/omiserver")
+    parser.add_option("-b", "--build", action="store_true", dest="build", default=False,
+                      help="Build and register the OMI_Perf provider before starting the server")
+    parser.add_option("--no-server", action="store_false", dest="start_server", default=True,
+                      help="Use the omiserver already running instead of starting one")
+    parser.add_option("-d", "--domain", action="store", type="string", dest="domain", default="",
+                      help="Domain used to connect to the server")
+    parser.add_option("-u", "--username", action="store", type="string", dest="username",
+                      default=getpass.getuser(), help="Username used to connect to the server")
+    parser.add_option("-p", "--password", action="store", type="string", dest="password", default="",
+                      help="Password used to connect to the server")
+    parser.add_option("-j", "--json", action="store_true", dest="json", default=False,
+                      help="Print the results as JSON")
+    (options, args) = parser.parse_args()
+
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as error:
+        parser.error(str(error))
+    if options.concurrency < 1:
+        parser.error("The concurrency must be at least 1")
+
+    if options.build:
+        build_provider()
+
+    if options.start_server:
+        livetime = int(options.duration) + 120
+        with LocalServer(options.output_dir, options.instances, options.width, livetime):
+            elapsed, results = run_load(options, mix)
+    else:
+        elapsed, results = run_load(options, mix)
+
+    if options.json:
+        print(json.dumps({
+            'instances': options.instances,
+            'width': options.width,
+            'concurrency': options.concurrency,
+            'mix': dict(mix),
+            'elapsed': elapsed,
+            'operations': results,
+        }, indent=4, sort_keys=True))
+    else:
+        print_results(elapsed, results)
+
+
+if __name__ == '__main__':
+    main()
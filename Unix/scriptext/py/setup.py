@@ -1,34 +1,46 @@
 import os
+import sys
 from distutils.core import setup, Extension
-#hardcoded directory, need to be updated
-dirs = "/tmp/omi-latest" 
 
-setup(name='PMI_Instance',version = '1.0', ext_modules = [Extension('mi.PMI_Instance',sources=['PMI_Instance.c'],extra_compile_args=['-O0'],runtime_library_dirs=[dirs+'/output/lib/'],
-		library_dirs=[dirs+'/output/lib/'],
-		libraries=['mi'],
-		include_dirs=[dirs+'/output/include'])])
+here = os.path.dirname(os.path.abspath(__file__))
 
-setup(name='PMI_Class',version = '1.0', ext_modules = [Extension('mi.PMI_Class',sources=['PMI_Class.c'],extra_compile_args=['-O0'],runtime_library_dirs=[dirs+'/output/lib/'],
-		library_dirs=[dirs+'/output/lib/'],
-		libraries=['mi'],
-		include_dirs=[dirs+'/output/include'])])
 
+def find_output_dir():
+    """Locate the OMI build output containing lib/libmi, OMI_OUTPUT_DIR takes precedence."""
+    candidates = [
+        os.environ.get('OMI_OUTPUT_DIR'),
+        os.path.join(here, '..', '..', 'output'),
+        '/tmp/omi-latest/output',
+    ]
+    for candidate in candidates:
+        if not candidate:
+            continue
+        lib_dir = os.path.join(candidate, 'lib')
+        for name in ('libmi.so', 'libmi.dylib'):
+            if os.path.exists(os.path.join(lib_dir, name)):
+                return os.path.abspath(candidate)
 
-setup(name='PMI_Session',version = '1.0', ext_modules = [Extension('mi.PMI_Session',sources=['PMI_Session.c'],extra_compile_args=['-O0'],runtime_library_dirs=[dirs+'/output/lib/'],
-		library_dirs=[dirs+'/output/lib/'],
-		libraries=['mi'],
-		include_dirs=[dirs+'/output/include'])])
+    sys.stderr.write("Could not find libmi, build OMI first or set OMI_OUTPUT_DIR to its output directory\n")
+    sys.exit(1)
 
 
-setup(name='mi', version='1.0',
-	ext_modules=[Extension('mi', 
-		sources=['PythonBinding.c'],
-		extra_compile_args=['-O0'],
-	 	runtime_library_dirs=[dirs+'/output/lib/'],
-		library_dirs=[dirs+'/output/lib/'],
-		libraries=['mi'],
-		include_dirs=[dirs+'/output/include']
-		)])
-
+output_dir = find_output_dir()
+lib_dir = os.path.join(output_dir, 'lib')
 
+# PythonBinding.c includes the other PMI_*.c files so everything is compiled as one translation unit
+compile_args = ['-O2']
+link_args = []
+if os.environ.get('MI_LTO', '0') not in ('', '0'):
+    compile_args.append('-flto')
+    link_args.append('-flto')
 
+setup(name='mi', version='1.0',
+      ext_modules=[Extension('mi',
+                             sources=['PythonBinding.c'],
+                             depends=['PMI_Session.c', 'PMI_Instance.c', 'PMI_Class.c'],
+                             extra_compile_args=compile_args,
+                             extra_link_args=link_args,
+                             runtime_library_dirs=[lib_dir],
+                             library_dirs=[lib_dir],
+                             libraries=['mi'],
+                             include_dirs=[os.path.join(output_dir, 'include'), os.path.join(here, '..', '..', 'common')])])
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""Regression tests for the bulk operations of the mi binding.
+
+Needs the mi module built from Unix/scriptext/py and an OMI build output
+with the OMI_Perf sample provider registered (make -C
+Unix/samples/Providers/Perf all reg). omiserver is started from
+OMI_OUTPUT_DIR, or Unix/output, the tests are skipped when any of these is
+missing.
+
+    python tests/test_bulk.py
+"""
+
+from __future__ import print_function
+
+import getpass
+import os
+import subprocess
+import threading
+import time
+import unittest
+
+try:
+    import mi
+except ImportError:
+    mi = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UNIX_DIR = os.path.abspath(os.path.join(HERE, '..', '..', '..'))
+OUTPUT_DIR = os.environ.get('OMI_OUTPUT_DIR', os.path.join(UNIX_DIR, 'output'))
+NAMESPACE = 'root/omi'
+CLASS_NAME = 'OMI_Perf'
+INSTANCES = 8
+# A bulk call that has not returned by then is taken as hung
+TIMEOUT = 60
+
+server = None
+skip_reason = None
+
+
+def setUpModule():
+    global server, skip_reason
+    program = os.path.join(OUTPUT_DIR, 'bin', 'omiserver')
+    if mi is None:
+        skip_reason = "the mi module is not built"
+        return
+    if not os.path.exists(program):
+        skip_reason = "omiserver not found at '%s'" % program
+        return
+
+    env = dict(os.environ)
+    env['OMI_PERF_INSTANCES'] = str(INSTANCES)
+    env['OMI_PERF_WIDTH'] = '4'
+    args = [program, '--ignoreAuthentication', '--livetime', str(TIMEOUT * 5)]
+    if os.geteuid() != 0:
+        args.append('--nonroot')
+    server = subprocess.Popen(args, env=env)
+
+    session = connect()
+    try:
+        session.get_instance(NAMESPACE, CLASS_NAME, {'Key': 0})
+    except mi.MIError as error:
+        skip_reason = "the %s provider is not registered: %s" % (CLASS_NAME, error)
+    finally:
+        session.close()
+
+
+def tearDownModule():
+    if server is not None and server.poll() is None:
+        server.terminate()
+        server.wait()
+
+
+def connect(timeout=30):
+    """Connect to the local server, waiting for it to accept connections."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return mi.connect('', getpass.getuser(), '', pooled=False)
+        except mi.MIError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+class BulkOperationTests(unittest.TestCase):
+
+    def setUp(self):
+        if skip_reason is not None:
+            self.skipTest(skip_reason)
+        self.session = connect()
+        self.keys = [{'Key': key} for key in range(INSTANCES)]
+
+    def tearDown(self):
+        self.session.close()
+
+    def run_to_completion(self, call, *args, **kwargs):
+        """Run call in another thread and fail instead of hanging when it does not return."""
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = call(*args, **kwargs)
+            except Exception as error:
+                outcome['error'] = error
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive(), "%s did not complete within %d seconds" % (call.__name__, TIMEOUT))
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def assert_outcomes(self, outcomes, items, failed):
+        self.assertEqual(len(outcomes), len(items))
+        for item, (outcome_item, instance, error) in zip(items, outcomes):
+            self.assertEqual(outcome_item, item)
+            if failed:
+                # OMI_Perf does not support create, modify or delete
+                self.assertIsNone(instance)
+                self.assertIsNotNone(error)
+            else:
+                self.assertIsNotNone(instance)
+                self.assertIsNone(error)
+
+    def test_get_instances(self):
+        for window in (1, 3, INSTANCES):
+            results = self.run_to_completion(lambda: list(self.session.get_instances(NAMESPACE, CLASS_NAME, self.keys, window=window)))
+            results.sort(key=lambda result: result[0]['Key'])
+            self.assert_outcomes(results, self.keys, False)
+
+    def test_get_instances_collapsed(self):
+        results = self.run_to_completion(lambda: list(self.session.get_instances(NAMESPACE, CLASS_NAME, self.keys, collapse=True)))
+        results.sort(key=lambda result: result[0]['Key'])
+        self.assert_outcomes(results, self.keys, False)
+
+    def test_get_instances_collapsed_string_keys(self):
+        # Key is declared as an integer, the string values must still match the returned instances
+        keys = [{'Key': str(key['Key'])} for key in self.keys]
+        results = self.run_to_completion(lambda: list(self.session.get_instances(NAMESPACE, CLASS_NAME, keys, collapse=True)))
+        results.sort(key=lambda result: int(result[0]['Key']))
+        self.assert_outcomes(results, keys, False)
+
+    def test_create_instances(self):
+        items = [{'Key': key + INSTANCES} for key in range(INSTANCES)]
+        for window in (1, 3, INSTANCES):
+            outcomes = self.run_to_completion(self.session.create_instances, NAMESPACE, items, className=CLASS_NAME, window=window)
+            self.assert_outcomes(outcomes, items, True)
+
+    def test_modify_instances(self):
+        for window in (1, 3, INSTANCES):
+            outcomes = self.run_to_completion(self.session.modify_instances, NAMESPACE, self.keys, className=CLASS_NAME, window=window)
+            self.assert_outcomes(outcomes, self.keys, True)
+
+    def test_delete_instances(self):
+        for window in (1, 3, INSTANCES):
+            outcomes = self.run_to_completion(self.session.delete_instances, NAMESPACE, self.keys, className=CLASS_NAME, window=window)
+            self.assert_outcomes(outcomes, self.keys, True)
+
+    def test_close_get_instances(self):
+        iterator = self.session.get_instances(NAMESPACE, CLASS_NAME, self.keys, window=2)
+        next(iterator)
+        self.run_to_completion(iterator.close)
+        self.assertEqual(list(iterator), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
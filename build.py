@@ -8,18 +8,28 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 import os.path
+import platform
 import re
+import shutil
 import subprocess
+import sys
 import tempfile
+import time
 import warnings
 
 from utils import (
     argcomplete,
     build_bash_script,
+    build_builder_image,
+    build_dag_script,
     build_multiline_command,
     build_package_command,
+    BuildStep,
     complete_distribution,
     docker_run,
     get_version,
@@ -28,125 +38,93 @@ from utils import (
     select_distribution,
 )
 
+# The CPUs and memory a single distribution build is expected to need when deciding how many to run at once.
+BUILD_CPUS = 2
+BUILD_MEMORY = 2 * 1024 * 1024 * 1024
 
-def compile_openssl(openssl_version, script_steps, configure_args, distribution):
-    build_path = '/tmp/openssl-%s-build' % openssl_version
-
-    if distribution.startswith('macOS'):
-        compile_arg = 'MACOSX_DEPLOYMENT_TARGET=10.15 ./Configure darwin64-x86_64-cc shared'
-    else:
-        compile_arg = 'CFLAGS=-fPIC ./config shared'
-
-    jobs = ''
-    if openssl_version.startswith('1.0'):
-        # OpenSSL 1.0.x is problematic with concurrently builds so set the max to just 1.
-        jobs = '1'
-
-    compile_openssl = '''wget \
-    -q -O '/tmp/openssl-{0}.tar.gz' \
-    'https://www.openssl.org/source/openssl-{0}.tar.gz'
-
-tar -xf '/tmp/openssl-{0}.tar.gz' -C /tmp
-cd '/tmp/openssl-{0}'
-
-{1} \
-    '--prefix={2}'
-make -j{3}
-make install_sw'''.format(openssl_version, compile_arg, build_path, jobs)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                         'omi-build')
 
-    script_steps.append(('Compiling OpenSSL %s' % openssl_version, compile_openssl))
-
-    # TODO: Enable this once AZP opens up the Big Sur agents so we can actually run this in CI.
-    if distribution.startswith('macOS') and False:
-        # We want to create a fat (x64 and arm) library so we can compile mi for arm.
-        compile_openssl = '''
-MACOSX_DEPLOYMENT_TARGET=10.15 ./Configure \
-    darwin64-arm64-cc shared \
-    '--prefix={0}-arm64'
-make clean
-make -j
-make install_sw
-
-echo "Combining x86_64 and arm64 binaries"
-
-LIB_DIR='{0}'
-
-# Loops through all the .a and .dylibs in lib (that aren't symlinks) and combines them
-for file in "${{LIB_DIR}}"/lib/lib*; do
-    if [ -f "${{file}}" ] && [ ! -L "${{file}}" ]; then
-        FILENAME="$( basename "${{file}}" )"
-        echo "Combining OpenSSL lib ${{file}}"
-        lipo -create "${{file}}" "${{LIB_DIR}}-arm64/lib/${{FILENAME}}" -output "${{file}}"
-    fi
-done
-
-lipo -create \
-    '{0}/bin/openssl' \
-    '{0}-arm64/bin/openssl' \
-    -output '{0}/bin/openssl'
-'''.format(build_path)
-        script_steps.append(('Compiling OpenSSL for arm64', compile_openssl))
-
-    script_steps.append(('Finalise OpenSSL install', '''export OPENSSL_ROOT_DIR="{0}"
-cd "${{OMI_REPO}}/Unix"
-'''.format(build_path)))
-
-    configure_args.extend([
-        '--openssl="{0}/bin/openssl"'.format(build_path),
-        '--opensslcflags="-I{0}/include"'.format(build_path),
-        '--openssllibs="-L{0}/lib -lssl -lcrypto -lz"'.format(build_path),
-        '--openssllibdir="{0}/lib"'.format(build_path),
-    ])
-
-
-def main():
-    """Main program body."""
-    args = parse_args()
-    distribution = select_distribution(args)
-    if not distribution:
-        return
+LOG_DIR = os.path.join(OMI_REPO, 'build-logs')
 
+def build_distribution(distribution, args):  # type: (str, argparse.Namespace) -> None
+    """ Builds libmi and libpsrpclient for a single distribution. """
     distro_details = load_distribution_config(distribution)
     if args.docker and not distro_details['container_image']:
         raise ValueError("Cannot run --docker on %s as no container_image has been specified" % distribution)
 
-    script_steps = [('Getting current directory path', '''OMI_REPO="$( pwd )"
-echo "Current Directory: $OMI_REPO"
-cd Unix''')]
+    # Each step declares the steps it requires and the directory, relative to the repo root, it runs in so the
+    # steps can run concurrently. Variables needed by later steps are set with step_export.
+    script_steps = []
     output_dirname = 'build-%s' % distribution
     library_extension = 'dylib' if distribution.startswith('macOS') else 'so'
 
-    if not args.skip_deps:
+    # The builder image already has the build dependencies installed.
+    use_builder_image = args.docker and not (args.skip_deps or args.no_builder_image)
+
+    if not (args.skip_deps or use_builder_image):
         dep_script = build_package_command(distro_details['package_manager'], distro_details['build_deps'])
-        script_steps.append(('Installing build pre-requisite packages', dep_script))
+        script_steps.append(BuildStep('install_deps', 'Installing build pre-requisite packages', dep_script, [],
+                                      'Unix'))
 
     # Do this in the container as selinux could have these folders be under root
-    if not args.skip_clear:
+    if not (args.skip_clear or args.incremental):
         rm_script = '''if [ -d "{0}" ]; then
     echo "Found existing build folder '{0}', clearing"
     rm -rf "{0}"
 else
     echo "No build folder found, no action required"
 fi'''.format(output_dirname)
-        script_steps.append(('Entering OMI source folder and cleaning any existing build', rm_script))
+        script_steps.append(BuildStep('clean', 'Cleaning any existing build', rm_script, [], 'Unix'))
 
+    # The GNUmakefile configure generates is shared by every distribution, skip it and call build.mak directly so
+    # multiple distributions can be built from the same source tree at the same time.
     configure_args = [
         '--outputdirname="%s"' % output_dirname,
         '--prefix="%s"' % args.prefix,
+        '--disable-makefile-gen',
     ]
     if args.debug:
         configure_args.append('--enable-debug')
 
+    # Compiled OpenSSL builds, the psl-omi-provider mirror, and the ccache for each distribution are kept in the
+    # cache dir, with Docker they are mounted into the container.
+    openssl_cache = None
+    ccache_dir = None
+    psl_cache = None
+    volumes = {}
+    if not (args.no_cache or args.output_script):
+        openssl_cache = os.path.join(args.cache_dir, 'openssl')
+        ccache_dir = os.path.join(args.cache_dir, 'ccache', distribution)
+        psl_cache = os.path.join(args.cache_dir, 'psl-omi-provider')
+        for path in [openssl_cache, ccache_dir, psl_cache]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        if args.docker:
+            volumes[openssl_cache] = '/tmp/openssl-cache'
+            openssl_cache = '/tmp/openssl-cache'
+            volumes[ccache_dir] = '/tmp/ccache'
+            ccache_dir = '/tmp/ccache'
+            volumes[psl_cache] = '/tmp/psl-omi-provider-cache'
+            psl_cache = '/tmp/psl-omi-provider-cache'
+
+        openssl_cache += '/%s-%s' % (re.sub(r'[^\w.\-]', '_', distro_details['container_image'] if args.docker
+                                            else distribution), platform.machine())
+
     # macOS on Azure Pipelines has OpenSSL 1.0.2 installed but we want to compile against the OpenSSL version in our
     # dep list which is openssl@1.1. Because the deps are installed at runtime we need our build script to find that
     # value and add to our configure args.
     if distribution.startswith('macOS'):
         if distro_details['openssl_version']:
-            compile_openssl(distro_details['openssl_version'], script_steps, configure_args, distribution)
+            compile_openssl(distro_details['openssl_version'], script_steps, configure_args, distribution,
+                            openssl_cache)
 
         else:
-            script_steps.append(('Getting OpenSSL locations for macOS',
-                'OPENSSL_PREFIX="$(brew --prefix openssl@1.1)"\necho "Using OpenSSL at \'${OPENSSL_PREFIX}\'"'))
+            script_steps.append(BuildStep('openssl_env', 'Getting OpenSSL locations for macOS',
+                'step_export OPENSSL_PREFIX "$(brew --prefix openssl@1.1)"\n'
+                'echo "Using OpenSSL at \'${OPENSSL_PREFIX}\'"',
+                ['install_deps'], ''))
 
             configure_args.extend([
                 '--openssl="${OPENSSL_PREFIX}/bin/openssl"',
@@ -156,14 +134,56 @@ fi'''.format(output_dirname)
             ])
 
     elif distro_details['openssl_version']:
-        compile_openssl(distro_details['openssl_version'], script_steps, configure_args, distribution)
+        compile_openssl(distro_details['openssl_version'], script_steps, configure_args, distribution,
+                        openssl_cache)
+
+    # Compile through ccache when it is available, configure needs the full path to the compiler it should use.
+    cmake_env = ''
+    if ccache_dir:
+        script_steps.append(BuildStep('ccache', 'Setting up ccache', '''OMI_CC="$( command -v "$( ./buildtool cc )" )"
+OMI_CXX="$( command -v "$( ./buildtool cxx )" )"
+
+if command -v ccache > /dev/null; then
+    mkdir -p /tmp/omi-ccache-bin
+    printf '#!/bin/sh\\nexec ccache "%s" "$@"\\n' "${OMI_CC}" > /tmp/omi-ccache-bin/cc
+    printf '#!/bin/sh\\nexec ccache "%s" "$@"\\n' "${OMI_CXX}" > /tmp/omi-ccache-bin/c++
+    chmod +x /tmp/omi-ccache-bin/cc /tmp/omi-ccache-bin/c++
+
+    OMI_CC=/tmp/omi-ccache-bin/cc
+    OMI_CXX=/tmp/omi-ccache-bin/c++
+    ccache --zero-stats > /dev/null
+    echo "Using ccache at '${CCACHE_DIR}'"
+else
+    echo "ccache is not installed, compiling without a compiler cache"
+fi
+
+step_export OMI_CC "${OMI_CC}"
+step_export OMI_CXX "${OMI_CXX}"''', ['install_deps'], 'Unix'))
+
+        configure_args.extend(['--with-cc="${OMI_CC}"', '--with-cxx="${OMI_CXX}"'])
+        cmake_env = 'CC="${OMI_CC}" CXX="${OMI_CXX}" '
 
     configure_script = '''echo -e "Running configure with:\\n\\t{0}"
 {1}'''.format('\\n\\t'.join(configure_args), build_multiline_command('./configure', configure_args))
 
-    script_steps.append(('Running configure', configure_script))
-    script_steps.append(('Running make', 'make -j'))
-    script_steps.append(('Copying libmi to pwsh build dir',
+    # An incremental build only runs configure and cmake again when their inputs have changed as regenerating the
+    # configuration causes make to rebuild everything.
+    with open(os.path.join(OMI_REPO, 'distribution_meta', '%s.json' % distribution), mode='rb') as fd:
+        distro_hash = hashlib.sha256(fd.read()).hexdigest()
+    version_stamp = '\n'.join('{0}=${{{0}:-}}'.format(v) for v in ['OMI_BUILDVERSION_MAJOR', 'OMI_BUILDVERSION_MINOR',
+                                                               'OMI_BUILDVERSION_PATCH', 'OMI_BUILDVERSION_BUILDNR'])
+
+    if args.incremental:
+        configure_script = build_incremental_script('%s/configure.stamp' % output_dirname,
+            'distribution_json=%s\n%s\nOPENSSL_ROOT_DIR=${OPENSSL_ROOT_DIR:-}\n./configure %s'
+            % (distro_hash, version_stamp, ' '.join(configure_args)),
+            configure_script, 'Configure inputs are unchanged, skipping configure')
+
+    script_steps.append(BuildStep('configure', 'Running configure', configure_script,
+                                  ['install_deps', 'clean', 'openssl_env', 'ccache'], 'Unix'))
+    script_steps.append(BuildStep('make', 'Running make', 'OUTPUTDIR="$( pwd )/{0}" make -f build.mak -j{1}'.format(
+        output_dirname, args.jobs or ''), ['configure'], 'Unix'))
+    script_steps.append(BuildStep('copy_libmi', 'Copying libmi to pwsh build dir',
         '''if [ -d '../PSWSMan/lib/{0}' ]; then
     echo "Clearing existing build folder at 'PSWSMan/lib/{0}'"
     rm -rf '../PSWSMan/lib/{0}'
@@ -171,52 +191,137 @@ fi
 mkdir '../PSWSMan/lib/{0}'
 
 echo "Copying '{1}/lib/libmi.{2}' -> 'PSWSMan/lib/{0}/'"
-cp '{1}/lib/libmi.{2}' '../PSWSMan/lib/{0}/\''''.format(distribution, output_dirname, library_extension)))
-
-    script_steps.append(('Cloning upstream psl-omi-provider repo',
-        '''cd ../psl-omi-provider
-if [ -d repo ]; then
-    echo "Clearing existing psl-omi-provider repo"
-    rm -rf repo
-fi
-git clone https://github.com/PowerShell/psl-omi-provider.git repo
-cd repo'''))
+cp '{1}/lib/libmi.{2}' '../PSWSMan/lib/{0}/\''''.format(distribution, output_dirname, library_extension),
+        ['make'], 'Unix'))
 
     # Get a list of patches to apply to psl-omi-provider and sort them by the leading digit in the filename.
     psl_patches = [p for p in os.listdir(os.path.join(OMI_REPO, 'psl-omi-provider'))
         if re.match(r'^\d+\..*\.diff$', p)]
     psl_patches.sort(key=lambda p: int(p.split('.')[0]))
+    patch_script = '\n'.join(['''echo "Applying '{0}'"
+git apply "${{OMI_REPO}}/psl-omi-provider/{0}"'''.format(p) for p in psl_patches])
+
+    patch_hash = hashlib.sha256()
+    for patch in psl_patches:
+        with open(os.path.join(OMI_REPO, 'psl-omi-provider', patch), mode='rb') as fd:
+            patch_hash.update(patch.encode('utf-8') + b'\0' + fd.read())
+    psl_stamp = 'repo-%s/.psl-stamp' % distribution
+
+    if psl_cache:
+        tree_stamp = '${PSL_COMMIT}-%s' % patch_hash.hexdigest()[:16]
+        copy_script = '''rm -rf 'repo-{0}'
+cp -R "${{PSL_TREE}}" 'repo-{0}\''''.format(distribution)
+        if args.incremental:
+            copy_script = build_incremental_script(psl_stamp, tree_stamp, copy_script,
+                'Keeping the existing psl-omi-provider tree for the incremental build')
 
-    script_steps.append(('Applying psl-omi-provider patches', '\n'.join(['''echo "Applying '{0}'"
-git apply "${{OMI_REPO}}/psl-omi-provider/{0}"'''.format(p) for p in psl_patches])))
+        else:
+            # Still record the tree so a later incremental build can keep it.
+            copy_script += '\necho "%s" > \'%s\'' % (tree_stamp, psl_stamp)
+
+        # The upstream repo is kept as a mirror that is fetched incrementally. The patched tree for each upstream
+        # commit and patch set is cached so a repeat build only needs to copy it. Parallel builds share the cache
+        # so a lock ensures only one of them updates it at a time.
+        update_cache = build_lock_script(psl_cache, '''psl_git() {{
+    git -c safe.directory='*' --git-dir "${{PSL_CACHE}}/mirror.git" "$@"
+}}
+
+if [ -d "${{PSL_CACHE}}/mirror.git" ]; then
+    echo "Fetching upstream psl-omi-provider changes into mirror"
+    psl_git fetch --prune origin
+else
+    git clone --mirror https://github.com/PowerShell/psl-omi-provider.git "${{PSL_CACHE}}/mirror.git"
+fi
 
-    built_type = 'Debug' if args.debug else 'Release'
-    script_steps.append(('Building libpsrpclient', '''rm -rf omi
-ln -s "${{OMI_REPO}}" omi
+PSL_COMMIT="$( psl_git rev-parse HEAD )"
+PSL_TREE="${{PSL_CACHE}}/trees/${{PSL_COMMIT}}-{0}"
 
-if [ -e omi/Unix/output ]; then
-    rm omi/Unix/output
+if [ -d "${{PSL_TREE}}" ]; then
+    echo "Using cached patched tree for psl-omi-provider ${{PSL_COMMIT}}"
+else
+    echo "Creating patched tree for psl-omi-provider ${{PSL_COMMIT}}"
+    rm -rf "${{PSL_TREE}}.tmp"
+    mkdir -p "${{PSL_TREE}}.tmp"
+    psl_git archive "${{PSL_COMMIT}}" | tar -x -C "${{PSL_TREE}}.tmp"
+
+    cd "${{PSL_TREE}}.tmp"
+    git init -q
+{1}
+    rm -rf .git
+
+    mv "${{PSL_TREE}}.tmp" "${{PSL_TREE}}"
+fi'''.format(patch_hash.hexdigest()[:16], patch_script))
+
+        script_steps.append(BuildStep('psl_source', 'Getting patched psl-omi-provider tree', '''PSL_CACHE='{0}'
+{1}
+
+cd "${{OMI_REPO}}/psl-omi-provider"
+{2}
+cd 'repo-{3}\''''.format(psl_cache, update_cache, copy_script, distribution), ['install_deps'], 'Unix'))
+
+    else:
+        clone_script = '''cd ../psl-omi-provider
+if [ -d 'repo-{0}' ]; then
+    echo "Clearing existing psl-omi-provider repo"
+    rm -rf 'repo-{0}'
 fi
-ln -s {0} omi/Unix/output
+git clone https://github.com/PowerShell/psl-omi-provider.git 'repo-{0}'
+cd 'repo-{0}\''''.format(distribution)
+
+        if args.incremental:
+            # The upstream commit isn't known until it is cloned, an existing clone is kept until the patches change.
+            clone_lines = clone_script.splitlines()
+            clone_script = clone_lines[0] + '\n' + build_incremental_script(psl_stamp, patch_hash.hexdigest(),
+                '%s\n%s\ncd ..' % ('\n'.join(clone_lines[1:]), patch_script),
+                'Keeping the existing psl-omi-provider repo for the incremental build') + "\ncd 'repo-%s'" % distribution
+            script_steps.append(BuildStep('psl_source', 'Cloning and patching upstream psl-omi-provider repo',
+                                          clone_script, ['install_deps'], 'Unix'))
+
+        else:
+            script_steps.append(BuildStep('psl_clone', 'Cloning upstream psl-omi-provider repo', clone_script,
+                                          ['install_deps'], 'Unix'))
+            script_steps.append(BuildStep('psl_source', 'Applying psl-omi-provider patches', patch_script,
+                                          ['psl_clone'], 'psl-omi-provider/repo-%s' % distribution))
+
+    built_type = 'Debug' if args.debug else 'Release'
+    cmake_script = '''echo -e "Running cmake with\\n\\t-DCMAKE_BUILD_TYPE={0}"
+{1}cmake -DCMAKE_BUILD_TYPE={0} .'''.format(built_type, cmake_env)
+    if args.incremental:
+        cmake_script = build_incremental_script('cmake.stamp',
+            'distribution_json=%s\n%s\nCC=${OMI_CC:-}\nCXX=${OMI_CXX:-}\n%s'
+            % (distro_hash, version_stamp, cmake_script.splitlines()[-1]),
+            cmake_script, 'cmake inputs are unchanged, skipping cmake')
+
+    # The psl-omi-provider build expects the OMI build at omi/Unix/output, link each Unix entry individually so
+    # the output link is local to this distribution's checkout.
+    psl_repo = 'psl-omi-provider/repo-%s' % distribution
+    script_steps.append(BuildStep('psrpclient', 'Building libpsrpclient', '''rm -rf omi
+mkdir -p omi/Unix
+for entry in "${{OMI_REPO}}"/Unix/*; do
+    ln -s "${{entry}}" "omi/Unix/$( basename "${{entry}}" )"
+done
+
+rm -f omi/Unix/output
+ln -s "${{OMI_REPO}}/Unix/{0}" omi/Unix/output
 
 cd src
-echo -e "Running cmake with\\n\\t-DCMAKE_BUILD_TYPE={1}"
-cmake -DCMAKE_BUILD_TYPE={1} .
+{1}
 make psrpclient
-cp libpsrpclient.* "${{OMI_REPO}}/PSWSMan/lib/{2}/"'''.format(output_dirname, built_type, distribution)))
+cp libpsrpclient.* "${{OMI_REPO}}/PSWSMan/lib/{2}/"'''.format(output_dirname, cmake_script, distribution),
+        ['psl_source', 'copy_libmi', 'openssl_env', 'ccache'], psl_repo))
 
     if distribution.startswith('macOS'):
-        script_steps.append(('Patch libmi dylib path for libpsrpclient',
+        script_steps.append(BuildStep('patch_psrpclient', 'Patch libmi dylib path for libpsrpclient',
             '''echo "Patching '${{OMI_REPO}}/PSWSMan/lib/{0}/libpsrpclient.dylib' libmi location"
 install_name_tool -change \\
     '@rpath/libmi.dylib' \\
     '@loader_path/libmi.dylib' \\
-    "${{OMI_REPO}}/PSWSMan/lib/{0}/libpsrpclient.dylib"'''.format(distribution)))
+    "${{OMI_REPO}}/PSWSMan/lib/{0}/libpsrpclient.dylib"'''.format(distribution), ['psrpclient'], ''))
 
         if distro_details['openssl_version']:
             openssl_version = distro_details['openssl_version']
 
-        script_steps.append(('Patch OpenSSL dylib path for libmi',
+        script_steps.append(BuildStep('patch_openssl', 'Patch OpenSSL dylib path for libmi',
         '''echo "Patching '${{OMI_REPO}}/PSWSMan/lib/{1}/libmi.dylib' SSL locations"
 
 LIB_DIR='/tmp/openssl-{0}-build'
@@ -232,65 +337,500 @@ for file in "${{LIB_DIR}}"/lib/lib*.dylib; do
             "@loader_path/${{FILENAME}}" \\
             "${{OMI_REPO}}/PSWSMan/lib/{1}/libmi.dylib"
     fi
-done'''.format(openssl_version, distribution)))
+done'''.format(openssl_version, distribution), ['psrpclient'], ''))
 
-        script_steps.append(('Output linked information',
+        script_steps.append(BuildStep('linked_info', 'Output linked information',
             '''echo "libpsrpclient links"
 otool -L "${{OMI_REPO}}/PSWSMan/lib/{0}/libpsrpclient.dylib"
 
 echo "libmi links"
 otool -L "${{OMI_REPO}}/PSWSMan/lib/{0}/libmi.dylib"
-'''.format(distribution)))
+'''.format(distribution), ['psrpclient', 'patch_psrpclient', 'patch_openssl'], ''))
 
     else:
-        script_steps.append(('Output linked information',
+        script_steps.append(BuildStep('linked_info', 'Output linked information',
             '''echo "libpsrpclient links"
 ldd "${{OMI_REPO}}/PSWSMan/lib/{0}/libpsrpclient.so" || true
 
 echo "libmi links"
 ldd "${{OMI_REPO}}/PSWSMan/lib/{0}/libmi.so" || true
-'''.format(distribution)))
+'''.format(distribution), ['psrpclient', 'patch_psrpclient', 'patch_openssl'], ''))
+
+    if ccache_dir:
+        # ccache 4 has a machine readable stats format, fall back to the human readable one of older versions.
+        script_steps.append(BuildStep('ccache_stats', 'ccache statistics', '''if command -v ccache > /dev/null; then
+    ccache --show-stats
+
+    if CCACHE_STATS="$( ccache --print-stats 2> /dev/null )"; then
+        CCACHE_HITS="$( echo "${CCACHE_STATS}" | awk '/^(direct|preprocessed)_cache_hit/ {s += $2} END {print s + 0}' )"
+        CCACHE_MISSES="$( echo "${CCACHE_STATS}" | awk '/^cache_miss/ {s += $2} END {print s + 0}' )"
+    else
+        CCACHE_STATS="$( ccache --show-stats )"
+        CCACHE_HITS="$( echo "${CCACHE_STATS}" | awk '/^cache hit \\(/ {s += $NF} END {print s + 0}' )"
+        CCACHE_MISSES="$( echo "${CCACHE_STATS}" | awk '/^cache miss/ {s += $NF} END {print s + 0}' )"
+    fi
 
-    build_script = build_bash_script(script_steps)
+    echo "ccache: ${CCACHE_HITS} hits, ${CCACHE_MISSES} misses"
+fi''', ['psrpclient'], ''))
 
     if args.output_script:
-        print(build_script)
+        # The equivalent script that runs each step one after the other.
+        print(build_bash_script(script_steps))
 
     else:
-        with tempfile.NamedTemporaryFile(dir=OMI_REPO, prefix='build-', suffix='-%s.sh' % distribution) as temp_fd:
-            temp_fd.write(build_script.encode('utf-8'))
-            temp_fd.flush()
+        env_vars = {}
 
-            configure_dir = os.path.join(OMI_REPO, 'Unix')
-            build_dir = os.path.join(configure_dir, output_dirname)
+        # Get the omi.version from the PSWSMan module manifest
+        try:
+            version = get_version()
+        except RuntimeError:
+            warnings.warn("Failed to find Moduleversion in PSWSMan manifest, defaulting to upstream behaviour")
+        else:
+            env_vars['OMI_BUILDVERSION_MAJOR'] = version.major
+            env_vars['OMI_BUILDVERSION_MINOR'] = version.minor
+            env_vars['OMI_BUILDVERSION_PATCH'] = version.patch
 
-            env_vars = {}
+        for key, value in os.environ.items():
+            if key.startswith('OMI_BUILDVERSION_'):
+                env_vars[key] = value
 
-            # Get the omi.version from the PSWSMan module manifest
-            try:
-                version = get_version()
-            except RuntimeError:
-                warnings.warn("Failed to find Moduleversion in PSWSMan manifest, defaulting to upstream behaviour")
-            else:
-                env_vars['OMI_BUILDVERSION_MAJOR'] = version.major
-                env_vars['OMI_BUILDVERSION_MINOR'] = version.minor
-                env_vars['OMI_BUILDVERSION_PATCH'] = version.patch
+        libmi_path = os.path.join(OMI_REPO, 'PSWSMan', 'lib', distribution)
+        artifact_dir = os.path.join(args.cache_dir, 'artifacts')
+        cache_key = None
+        if not args.no_cache:
+            cache_key = get_cache_key(distribution, distro_details, args, env_vars)
+            if restore_cached_build(artifact_dir, cache_key, libmi_path):
+                print("Restored cached build %s\n\t%s" % (cache_key, libmi_path))
+                return
+
+        if ccache_dir:
+            env_vars['CCACHE_DIR'] = ccache_dir
+
+        # Each step writes its output to its own log in the step log dir, only the progress is shown here.
+        build_script = build_dag_script(script_steps, 'build-logs/%s' % distribution)
+
+        with tempfile.NamedTemporaryFile(dir=OMI_REPO, prefix='build-', suffix='-%s.sh' % distribution) as temp_fd:
+            temp_fd.write(build_script.encode('utf-8'))
+            temp_fd.flush()
 
             if args.docker:
-                for key, value in os.environ.items():
-                    if key.startswith('OMI_BUILDVERSION_'):
-                        env_vars[key] = value
+                image = distro_details['container_image']
+                if use_builder_image:
+                    image = build_builder_image(distro_details, test_deps=args.builder_test_deps)
 
-                docker_run(distro_details['container_image'], '/omi/%s' % os.path.basename(temp_fd.name),
-                    cwd='/omi', env=env_vars, shell=distro_details['shell'])
+                docker_run(image, '/omi/%s' % os.path.basename(temp_fd.name),
+                    cwd='/omi', env=env_vars, shell=distro_details['shell'], volumes=volumes)
 
             else:
                 print("Running build locally")
                 env_vars.update(os.environ.copy())
                 subprocess.check_call(['bash', temp_fd.name], cwd=OMI_REPO, env=env_vars)
 
-            libmi_path = os.path.join(OMI_REPO, 'PSWSMan', 'lib', distribution)
-            print("Successfully built\n\t{0}/libmi.{1}\n\t{0}/libpsrpclient.{1}".format(libmi_path, library_extension))
+        print("Successfully built\n\t{0}/libmi.{1}\n\t{0}/libpsrpclient.{1}".format(libmi_path, library_extension))
+
+        if cache_key:
+            save_cached_build(artifact_dir, cache_key, libmi_path)
+            evict_cache(artifact_dir, args.cache_size * 1024 * 1024, keep=cache_key)
+
+
+def build_incremental_script(stamp_path, stamp, script, skip_message):  # type: (str, str, str, str) -> str
+    """ Wraps a script so it only runs when the stamp differs from the one recorded when it last succeeded. """
+    return '''BUILD_STAMP="$( cat << EOL
+{1}
+EOL
+)"
+if [ -f '{0}' ] && [ "$( cat '{0}' )" = "${{BUILD_STAMP}}" ]; then
+    echo "{3}"
+else
+{2}
+
+    echo "${{BUILD_STAMP}}" > '{0}'
+fi'''.format(stamp_path, stamp, '\n'.join(('    ' + l) if l else l for l in script.splitlines()), skip_message)
+
+
+def build_lock_script(lock_path, script):  # type: (str, str) -> str
+    """ Wraps a script so it runs while holding a lock shared by the builds that use the same cache path. """
+    # flock is released by the kernel when the build exits, even when it is killed. macOS has no flock so it falls
+    # back to a lock dir that records its owner, a lock left behind by a process that no longer runs is broken.
+    return '''BUILD_LOCK='{0}'
+BUILD_LOCK_DIR=''
+if command -v flock > /dev/null 2>&1; then
+    exec 9> "${{BUILD_LOCK}}.flock"
+    if ! flock -n 9; then
+        echo "Waiting for another build to release '${{BUILD_LOCK}}.flock'"
+        flock 9
+    fi
+else
+    until mkdir "${{BUILD_LOCK}}.lock" 2> /dev/null; do
+        LOCK_OWNER="$( cat "${{BUILD_LOCK}}.lock/owner" 2> /dev/null )"
+        LOCK_PID="${{LOCK_OWNER##* }}"
+        if [ "${{LOCK_OWNER% *}}" = "$( uname -n )" ] && [ -n "${{LOCK_PID}}" ] && ! kill -0 "${{LOCK_PID}}" 2> /dev/null; then
+            echo "Breaking stale lock '${{BUILD_LOCK}}.lock' of process ${{LOCK_PID}} that no longer runs"
+            rm -rf "${{BUILD_LOCK}}.lock"
+        else
+            echo "Waiting for another build to release '${{BUILD_LOCK}}.lock'"
+            sleep 10
+        fi
+    done
+    BUILD_LOCK_DIR="${{BUILD_LOCK}}.lock"
+    echo "$( uname -n ) $$" > "${{BUILD_LOCK_DIR}}/owner"
+    trap 'rm -rf "${{BUILD_LOCK_DIR}}"' EXIT
+fi
+
+{1}
+
+if [ -n "${{BUILD_LOCK_DIR}}" ]; then
+    rm -rf "${{BUILD_LOCK_DIR}}"
+    trap - EXIT
+else
+    exec 9>&-
+fi'''.format(lock_path, script)
+
+
+def build_parallel(distributions, args):  # type: (List[str], argparse.Namespace) -> None
+    """ Builds multiple distributions in Docker containers concurrently. """
+    parallel = args.parallel or get_parallel_limit()
+    jobs = args.jobs or max(1, multiprocessing.cpu_count() // min(parallel, len(distributions)))
+
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    print("Building %d distributions, %d at a time with make -j%d, logs are in '%s'"
+          % (len(distributions), parallel, jobs, LOG_DIR))
+
+    queued = list(distributions)
+    running = {}
+    results = {}
+    start = time.time()
+    last_summary = 0
+
+    while queued or running:
+        while queued and len(running) < parallel:
+            distribution = queued.pop(0)
+            log_path = os.path.join(LOG_DIR, '%s.log' % distribution)
+            command = [sys.executable, os.path.abspath(__file__), distribution, '--docker', '--jobs', str(jobs)]
+            command.extend(get_forwarded_args(args))
+
+            log_fd = open(log_path, mode='wb')
+            process = subprocess.Popen(command, cwd=OMI_REPO, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+                                       stdin=open(os.devnull, mode='rb'), stdout=log_fd, stderr=subprocess.STDOUT)
+            running[distribution] = (process, log_fd, time.time())
+            print("[%s] Started %s" % (format_duration(time.time() - start), distribution))
+
+        time.sleep(1)
+
+        changed = False
+        for distribution, (process, log_fd, started) in list(running.items()):
+            rc = process.poll()
+            if rc is None:
+                continue
+
+            log_fd.close()
+            del running[distribution]
+            results[distribution] = (rc, time.time() - started)
+            changed = True
+            print("[%s] %s %s" % (format_duration(time.time() - start), 'Finished' if rc == 0 else 'FAILED',
+                                  distribution))
+
+        if changed or time.time() - last_summary >= 30:
+            last_summary = time.time()
+            failed = len([r for r in results.values() if r[0] != 0])
+            print("[%s] %d/%d done, %d failed, running: %s" % (
+                format_duration(time.time() - start), len(results), len(distributions), failed,
+                ', '.join('%s (%s)' % (d, format_duration(time.time() - r[2])) for d, r in sorted(running.items()))
+                or 'none'))
+
+    print("\n%-20s %-8s %-10s %-14s %s" % ('Distribution', 'Result', 'Duration', 'ccache hits', 'Log'))
+    for distribution in distributions:
+        rc, duration = results[distribution]
+        log_path = os.path.join(LOG_DIR, '%s.log' % distribution)
+        print("%-20s %-8s %-10s %-14s %s" % (distribution, 'PASS' if rc == 0 else 'FAIL', format_duration(duration),
+                                            get_ccache_hit_rate(log_path), log_path))
+
+    failed = sorted(d for d, r in results.items() if r[0] != 0)
+    if failed:
+        raise RuntimeError("Failed to build %s" % ", ".join(failed))
+
+
+def compile_openssl(openssl_version, script_steps, configure_args, distribution, cache_path=None):
+    build_path = '/tmp/openssl-%s-build' % openssl_version
+
+    if distribution.startswith('macOS'):
+        compile_arg = 'MACOSX_DEPLOYMENT_TARGET=10.15 ./Configure darwin64-x86_64-cc shared'
+    else:
+        compile_arg = 'CFLAGS=-fPIC ./config shared'
+
+    jobs = ''
+    if openssl_version.startswith('1.0'):
+        # OpenSSL 1.0.x is problematic with concurrently builds so set the max to just 1.
+        jobs = '1'
+
+    compile_openssl = '''wget \
+    -q -O '/tmp/openssl-{0}.tar.gz' \
+    'https://www.openssl.org/source/openssl-{0}.tar.gz'
+
+tar -xf '/tmp/openssl-{0}.tar.gz' -C /tmp
+cd '/tmp/openssl-{0}'
+
+{1} \
+    '--prefix={2}'
+make -j{3}
+make install_sw'''.format(openssl_version, compile_arg, build_path, jobs)
+
+    if cache_path:
+        # The build path is linked to the cache so the prefix compiled into OpenSSL stays the same. Parallel builds
+        # can share the same cache entry so a lock ensures only one of them compiles it.
+        cache_path = '%s-%s' % (cache_path, openssl_version)
+        compile_openssl = '''OPENSSL_CACHE='{0}'
+rm -rf '{1}'
+ln -s "${{OPENSSL_CACHE}}" '{1}'
+
+if [ -f "${{OPENSSL_CACHE}}/.complete" ]; then
+    echo "Using cached OpenSSL build at '${{OPENSSL_CACHE}}'"
+else
+    rm -rf "${{OPENSSL_CACHE}}"
+    mkdir "${{OPENSSL_CACHE}}"
+
+{2}
+
+    touch "${{OPENSSL_CACHE}}/.complete"
+fi'''.format(cache_path, build_path, '\n'.join(('    ' + l) if l else l for l in compile_openssl.splitlines()))
+        compile_openssl = build_lock_script(cache_path, compile_openssl)
+
+    script_steps.append(BuildStep('openssl', 'Compiling OpenSSL %s' % openssl_version, compile_openssl,
+                                  ['install_deps'], ''))
+
+    # TODO: Enable this once AZP opens up the Big Sur agents so we can actually run this in CI.
+    if distribution.startswith('macOS') and False:
+        # We want to create a fat (x64 and arm) library so we can compile mi for arm.
+        compile_openssl = '''cd '/tmp/openssl-{1}'
+
+MACOSX_DEPLOYMENT_TARGET=10.15 ./Configure \
+    darwin64-arm64-cc shared \
+    '--prefix={0}-arm64'
+make clean
+make -j
+make install_sw
+
+echo "Combining x86_64 and arm64 binaries"
+
+LIB_DIR='{0}'
+
+# Loops through all the .a and .dylibs in lib (that aren't symlinks) and combines them
+for file in "${{LIB_DIR}}"/lib/lib*; do
+    if [ -f "${{file}}" ] && [ ! -L "${{file}}" ]; then
+        FILENAME="$( basename "${{file}}" )"
+        echo "Combining OpenSSL lib ${{file}}"
+        lipo -create "${{file}}" "${{LIB_DIR}}-arm64/lib/${{FILENAME}}" -output "${{file}}"
+    fi
+done
+
+lipo -create \
+    '{0}/bin/openssl' \
+    '{0}-arm64/bin/openssl' \
+    -output '{0}/bin/openssl'
+'''.format(build_path, openssl_version)
+        script_steps.append(BuildStep('openssl_arm', 'Compiling OpenSSL for arm64', compile_openssl, ['openssl'], ''))
+
+    script_steps.append(BuildStep('openssl_env', 'Finalise OpenSSL install',
+                                  'step_export OPENSSL_ROOT_DIR \'{0}\''.format(build_path), ['openssl', 'openssl_arm'],
+                                  ''))
+
+    configure_args.extend([
+        '--openssl="{0}/bin/openssl"'.format(build_path),
+        '--opensslcflags="-I{0}/include"'.format(build_path),
+        '--openssllibs="-L{0}/lib -lssl -lcrypto -lz"'.format(build_path),
+        '--openssllibdir="{0}/lib"'.format(build_path),
+    ])
+
+
+def evict_cache(cache_dir, max_size, keep=None):  # type: (str, int, Optional[str]) -> None
+    """ Removes the least recently used entries in a cache directory until it is under the max size in bytes. """
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if '.tmp-' in name or name == keep or not os.path.isdir(path):
+            continue
+
+        size = 0
+        for root, dummy, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+        entries.append((os.path.getmtime(path), size, path))
+        total_size += size
+
+    for dummy, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        print("Evicting cache entry '%s'" % path)
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def format_duration(seconds):  # type: (float) -> str
+    """ Formats a duration in seconds as mm:ss. """
+    return '%02d:%02d' % divmod(int(seconds), 60)
+
+
+def get_cache_key(distribution, distro_details, args, env_vars):
+    # type: (str, Dict[str, any], argparse.Namespace, Dict[str, str]) -> str
+    """ Gets a hash of every input that affects the libraries built for a distribution. """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({
+        'debug': args.debug,
+        'distribution': distribution,
+        'env': env_vars,
+        'openssl_version': distro_details['openssl_version'],
+        'prefix': args.prefix,
+    }, sort_keys=True).encode('utf-8'))
+
+    paths = ['build.py', 'utils.py', os.path.join('distribution_meta', '%s.json' % distribution)]
+    paths.extend(os.path.join('psl-omi-provider', p) for p in os.listdir(os.path.join(OMI_REPO, 'psl-omi-provider'))
+                 if p.endswith('.diff'))
+
+    for root, dirs, files in os.walk(os.path.join(OMI_REPO, 'Unix')):
+        if root == os.path.join(OMI_REPO, 'Unix'):
+            # Skip the build output and files configure generates in the source tree.
+            dirs[:] = [d for d in dirs if not d.startswith(('build-', 'output'))]
+            files = [f for f in files if f != 'GNUmakefile']
+
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        paths.extend(os.path.relpath(os.path.join(root, f), OMI_REPO) for f in files if not f.endswith('.pyc'))
+
+    for path in sorted(paths):
+        full_path = os.path.join(OMI_REPO, path)
+        if not os.path.isfile(full_path):
+            continue
+
+        hasher.update(path.replace(os.sep, '/').encode('utf-8') + b'\0')
+        with open(full_path, mode='rb') as fd:
+            hasher.update(fd.read())
+
+    return hasher.hexdigest()
+
+
+def get_ccache_hit_rate(log_path):  # type: (str) -> str
+    """ Gets the ccache hit rate reported at the end of a build log. """
+    hit_rate = '-'
+    with open(log_path, mode='rb') as fd:
+        for line in fd.read().decode('utf-8', 'replace').splitlines():
+            match = re.match(r'^ccache: (\d+) hits, (\d+) misses', line)
+            if match:
+                hits, misses = int(match.group(1)), int(match.group(2))
+                hit_rate = '%d/%d (%d%%)' % (hits, hits + misses, 100 * hits // max(1, hits + misses))
+
+    return hit_rate
+
+
+def get_forwarded_args(args):  # type: (argparse.Namespace) -> List[str]
+    """ Gets the build.py arguments to pass through to each distribution build run in parallel. """
+    forwarded = ['--prefix', args.prefix, '--cache-dir', args.cache_dir, '--cache-size', str(args.cache_size)]
+    for name, enabled in [('--builder-test-deps', args.builder_test_deps), ('--debug', args.debug),
+                          ('--incremental', args.incremental),
+                          ('--no-builder-image', args.no_builder_image), ('--no-cache', args.no_cache),
+                          ('--skip-clear', args.skip_clear), ('--skip-deps', args.skip_deps)]:
+        if enabled:
+            forwarded.append(name)
+
+    return forwarded
+
+
+def get_parallel_limit():  # type: () -> int
+    """ Gets the number of distribution builds the host can run at the same time based on its CPU and memory. """
+    cpu_limit = max(1, multiprocessing.cpu_count() // BUILD_CPUS)
+
+    memory = None
+    try:
+        with open('/proc/meminfo', mode='r') as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+
+    except (IOError, OSError):
+        pass
+
+    if memory is None:
+        try:
+            memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return cpu_limit
+
+    return max(1, min(cpu_limit, memory // BUILD_MEMORY))
+
+
+def main():
+    """Main program body."""
+    args = parse_args()
+    distributions = select_distributions(args)
+    if not distributions:
+        return
+
+    if len(distributions) > 1:
+        build_parallel(distributions, args)
+
+    else:
+        build_distribution(distributions[0], args)
+
+
+def restore_cached_build(cache_dir, key, lib_path):  # type: (str, str, str) -> bool
+    """ Copies the libraries of a cached build into the PSWSMan lib folder, returns False on a cache miss. """
+    entry_path = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_path):
+        return False
+
+    if os.path.exists(lib_path):
+        shutil.rmtree(lib_path)
+    shutil.copytree(entry_path, lib_path, symlinks=True)
+
+    # Eviction removes the least recently used entries first.
+    os.utime(entry_path, None)
+
+    return True
+
+
+def save_cached_build(cache_dir, key, lib_path):  # type: (str, str, str) -> None
+    """ Adds the libraries in the PSWSMan lib folder to the cache. """
+    entry_path = os.path.join(cache_dir, key)
+    if os.path.exists(entry_path):
+        return
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Copy to a temporary path first so a parallel build never restores a partially written entry.
+    temp_path = '%s.tmp-%d' % (entry_path, os.getpid())
+    shutil.copytree(lib_path, temp_path, symlinks=True)
+    try:
+        os.rename(temp_path, entry_path)
+    except OSError:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    print("Saved build to cache %s" % key)
+
+
+def select_distributions(args):  # type: (argparse.Namespace) -> List[str]
+    """ Selects the distributions to build from the args or prompts the user for one. """
+    if not args.distribution:
+        distribution = select_distribution(args)
+        return [distribution] if distribution else []
+
+    valid_distributions = sorted(complete_distribution())
+    if 'all' in args.distribution:
+        return [d for d in valid_distributions if load_distribution_config(d)['container_image']]
+
+    distributions = []
+    for distribution in args.distribution:
+        if distribution not in valid_distributions:
+            raise ValueError("Invalid distribution choice '%s', valid distribution: '%s'"
+                             % (distribution, "', '".join(valid_distributions)))
+
+        if distribution not in distributions:
+            distributions.append(distribution)
+
+    return distributions
 
 
 def parse_args():
@@ -299,15 +839,66 @@ def parse_args():
 
     parser.add_argument('distribution',
                         metavar='distribution',
-                        nargs='?',
+                        nargs='*',
                         default=None,
-                        help='The distribution to build.').completer = complete_distribution
+                        help='The distribution(s) to build, use all to build every distribution with a '
+                             'container_image.').completer = complete_distribution
+
+    parser.add_argument('--builder-test-deps',
+                        dest='builder_test_deps',
+                        action='store_true',
+                        help='Also install the test dependencies in the builder image used with --docker.')
+
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        default=CACHE_DIR,
+                        action='store',
+                        help='The directory used to cache builds (default=%s).' % CACHE_DIR)
+
+    parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        type=int,
+                        default=2048,
+                        action='store',
+                        help='The size in MiB the cached builds can use before the oldest are evicted '
+                             '(default=2048).')
 
     parser.add_argument('--debug',
                         dest='debug',
                         action='store_true',
                         help='Whether to produce a debug build.')
 
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        action='store_true',
+                        help="Keep the existing build files and only run configure and cmake again when their inputs "
+                             "have changed.")
+
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        type=int,
+                        action='store',
+                        help='The number of make jobs for each build (default=unlimited, or the CPU count shared '
+                             'between parallel builds).')
+
+    parser.add_argument('--no-builder-image',
+                        dest='no_builder_image',
+                        action='store_true',
+                        help="Don't build a builder image with the dependencies installed, install them in the "
+                             "container_image on every --docker build.")
+
+    parser.add_argument('--no-cache',
+                        dest='no_cache',
+                        action='store_true',
+                        help="Don't restore or save the build in the cache.")
+
+    parser.add_argument('--parallel',
+                        dest='parallel',
+                        type=int,
+                        action='store',
+                        help='The number of distributions to build at the same time (default=based on the host CPU '
+                             'and memory).')
+
     parser.add_argument('--prefix',
                         dest='prefix',
                         default='/opt/omi',
@@ -340,6 +931,10 @@ def parse_args():
 
     args = parser.parse_args()
 
+    if len(args.distribution or []) > 1 or 'all' in (args.distribution or []):
+        if not args.docker:
+            parser.error('argument distribution: building multiple distributions must be set with argument --docker')
+
     return args
 
 
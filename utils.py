@@ -5,12 +5,15 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import collections
+import hashlib
 import json
 import os
 import os.path
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
 
 try:
     import argcomplete
@@ -27,13 +30,30 @@ except ImportError:
 
 OMIVersion = collections.namedtuple('OMIVersion', ['major', 'minor', 'patch'])
 
+# A build script step, requires is a list of step keys that must succeed before it runs and cwd is the path relative
+# to the repo root that the step starts in.
+BuildStep = collections.namedtuple('BuildStep', ['key', 'name', 'script', 'requires', 'cwd'])
+
 OMI_REPO = os.path.abspath(os.path.dirname(__file__))
 
 
-def build_bash_script(steps):  # type: (List[Tuple[str, str]]) -> str
+def build_bash_script(steps):  # type: (List[Union[Tuple[str, str], BuildStep]]) -> str
     """ Generates a bash script based on the steps specified. """
     script = '#!/usr/bin/env bash\n\nset -o pipefail -eu'
 
+    if steps and isinstance(steps[0], BuildStep):
+        # Run the steps one after the other in dependency order, each one starting in its own cwd.
+        script += '''
+
+OMI_REPO="$( pwd )"
+echo "Current Directory: $OMI_REPO"
+
+step_export() {
+    export "$1=$2"
+}'''
+        steps = [(s.name, 'cd "${OMI_REPO}%s"\n%s' % ('/' + s.cwd if s.cwd else '', s.script))
+                 for s in sort_build_steps(steps)]
+
     for step_name, step_script in steps:
         step_name = '| ' + step_name.center(76) + ' |'
         step_border = '-' * len(step_name)
@@ -49,6 +69,174 @@ echo ""
     return script
 
 
+def build_builder_image(distro_details, test_deps=False):  # type: (Dict[str, any], bool) -> str
+    """ Builds a Docker image with the distribution dependencies installed if it doesn't already exist. """
+    package_manager = distro_details['package_manager']
+    install_steps = [('Installing build pre-requisite packages',
+        build_package_command(package_manager, distro_details['build_deps']))]
+
+    if test_deps:
+        install_steps.append(('Setting up the Microsoft package manager repo',
+            build_package_repo_command(package_manager, distro_details['microsoft_repo'])))
+        install_steps.append(('Installing test dependency packages',
+            build_package_command(package_manager, distro_details['test_deps'])))
+
+    install_script = build_bash_script(install_steps)
+    dockerfile = '''FROM {0}
+COPY install-deps.sh /tmp/install-deps.sh
+RUN {1} /tmp/install-deps.sh && rm /tmp/install-deps.sh
+LABEL omi.builder="{0}"
+'''.format(distro_details['container_image'], distro_details['shell'] or '/bin/bash')
+
+    # The tag is based on the generated files so the image is only rebuilt when the dependencies change.
+    config_hash = hashlib.sha256((dockerfile + install_script).encode('utf-8')).hexdigest()[:16]
+    image = 'omi-builder-%s:%s' % (re.sub(r'[^a-z0-9]+', '-', distro_details['container_image'].lower()),
+        config_hash)
+
+    with open(os.devnull, mode='wb') as devnull:
+        if subprocess.call(['docker', 'image', 'inspect', image], stdout=devnull, stderr=devnull) == 0:
+            print("Using existing builder image %s" % image)
+            return image
+
+    build_dir = tempfile.mkdtemp(prefix='omi-builder-')
+    try:
+        for name, content in [('Dockerfile', dockerfile), ('install-deps.sh', install_script)]:
+            with open(os.path.join(build_dir, name), mode='wb') as fd:
+                fd.write(content.encode('utf-8'))
+
+        print("Building builder image %s" % image)
+        subprocess.check_call(['docker', 'build', '-t', image, build_dir])
+
+    finally:
+        shutil.rmtree(build_dir)
+
+    return image
+
+
+def build_dag_script(steps, log_dir):  # type: (List[BuildStep], str) -> str
+    """ Generates a bash script that runs the steps concurrently as soon as the steps they require have succeeded. """
+    steps = sort_build_steps(steps)
+    keys = set(s.key for s in steps)
+
+    script = '''#!/usr/bin/env bash
+
+set -o pipefail -eu
+
+OMI_REPO="$( pwd )"
+echo "Current Directory: $OMI_REPO"
+
+BUILD_LOG_DIR="${{OMI_REPO}}/{0}"
+rm -rf "${{BUILD_LOG_DIR}}"
+mkdir -p "${{BUILD_LOG_DIR}}"
+: > "${{BUILD_LOG_DIR}}/state.sh"
+: > "${{BUILD_LOG_DIR}}/times.tsv"
+BUILD_START="$( date +%s )"
+BUILD_FAILED=0
+
+# Steps run in their own subshell, variables they export are added to state.sh for the steps that run after them.
+# The value is single quoted with any single quote in it escaped, printf %q isn't available in every /bin/sh.
+step_export() {{
+    export "$1=$2"
+    printf "export %s='%s'\\n" "$1" "$( printf '%s' "$2" | sed "s/'/'\\"'\\"'/g" )" >> "${{BUILD_LOG_DIR}}/state.sh"
+}}
+
+run_step() {{
+    STEP_KEY="$1"
+    STEP_NAME="$2"
+    STEP_CWD="$3"
+    shift 3
+
+    for STEP_DEP in "$@"; do
+        until [ -f "${{BUILD_LOG_DIR}}/${{STEP_DEP}}.rc" ]; do
+            sleep 1
+        done
+
+        if [ "$( cat "${{BUILD_LOG_DIR}}/${{STEP_DEP}}.rc" )" != "0" ]; then
+            echo "Skipping '${{STEP_NAME}}' as '${{STEP_DEP}}' did not succeed"
+            echo "skipped" > "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc.tmp"
+            mv "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc.tmp" "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc"
+            return 0
+        fi
+    done
+
+    echo "[$(( $( date +%s ) - BUILD_START ))s] Starting '${{STEP_NAME}}'"
+    STEP_START="$( date +%s )"
+
+    set +e
+    (
+        set -o pipefail -eu
+        cd "${{OMI_REPO}}/${{STEP_CWD}}"
+        . "${{BUILD_LOG_DIR}}/state.sh"
+        "step_${{STEP_KEY}}"
+    ) > "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.log" 2>&1
+    STEP_RC=$?
+    set -e
+
+    STEP_TIME="$(( $( date +%s ) - STEP_START ))"
+    echo "${{STEP_TIME}}" > "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.time"
+    echo "${{STEP_RC}}" > "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc.tmp"
+    mv "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc.tmp" "${{BUILD_LOG_DIR}}/${{STEP_KEY}}.rc"
+
+    if [ "${{STEP_RC}}" = "0" ]; then
+        echo "[$(( $( date +%s ) - BUILD_START ))s] Finished '${{STEP_NAME}}' in ${{STEP_TIME}}s"
+    else
+        echo "[$(( $( date +%s ) - BUILD_START ))s] FAILED '${{STEP_NAME}}', see '${{BUILD_LOG_DIR}}/${{STEP_KEY}}.log'"
+    fi
+}}
+
+report_step() {{
+    STEP_RC="$( cat "${{BUILD_LOG_DIR}}/$1.rc" 2> /dev/null || echo "missing" )"
+    STEP_TIME="$( cat "${{BUILD_LOG_DIR}}/$1.time" 2> /dev/null || echo "-" )"
+    printf "%s\\t%s\\t%s\\n" "$1" "${{STEP_RC}}" "${{STEP_TIME}}" >> "${{BUILD_LOG_DIR}}/times.tsv"
+
+    case "${{STEP_RC}}" in
+        0) STEP_RESULT="PASS" ;;
+        skipped) STEP_RESULT="SKIP" ;;
+        *) STEP_RESULT="FAIL"; BUILD_FAILED=1 ;;
+    esac
+    printf "%-62s %-6s %s\\n" "$2" "${{STEP_RESULT}}" "${{STEP_TIME}}"
+}}
+'''.format(log_dir)
+
+    for step in steps:
+        script += '\nstep_%s() {\n%s\n}\n' % (step.key, step.script or ':')
+
+    script += '\n'
+    for step in steps:
+        requires = [r for r in (step.requires or []) if r in keys]
+        script += "run_step %s '%s' '%s'%s &\n" % (step.key, step.name.replace("'", "'\\''"), step.cwd,
+                                                  ''.join(' ' + r for r in requires))
+
+    script += '''wait
+
+echo ""
+printf "%-62s %-6s %s\\n" "Step" "Result" "Seconds"
+'''
+    for step in steps:
+        script += "report_step %s '%s'\n" % (step.key, step.name.replace("'", "'\\''"))
+
+    script += '''echo "Total build time: $(( $( date +%s ) - BUILD_START ))s, step logs are in '${BUILD_LOG_DIR}'"
+
+if [ "${BUILD_FAILED}" != "0" ]; then
+    for STEP_LOG in "${BUILD_LOG_DIR}"/*.log; do
+        STEP_KEY="$( basename "${STEP_LOG}" .log )"
+        case "$( cat "${BUILD_LOG_DIR}/${STEP_KEY}.rc" 2> /dev/null || echo "missing" )" in
+            0|skipped) ;;
+            *)
+                echo ""
+                echo "Output of failed step '${STEP_KEY}'"
+                cat "${STEP_LOG}"
+                ;;
+        esac
+    done
+
+    exit 1
+fi
+'''
+
+    return script
+
+
 def build_multiline_command(command, extras):  # type: (str, List[str]) -> str
     """ Generates a command that spans multiple lines per option. """
     return '%s \\\n    %s' % (command, ' \\\n    '.join(extras))
@@ -235,8 +423,8 @@ def complete_distribution():  # type: () -> List[str]
     return distributions
 
 
-def docker_run(image, script, cwd='/omi', env=None, interactive=False, shell=None):
-    # type: (str, str, str, Optional[Dict[str, str]], bool) -> None
+def docker_run(image, script, cwd='/omi', env=None, interactive=False, shell=None, volumes=None):
+    # type: (str, str, str, Optional[Dict[str, str]], bool, Optional[str], Optional[Dict[str, str]]) -> None
     """ Runs docker run with the arguments specified. """
     volume_type = ':Z' if SELINUX_ENABLED else ''
     docker_args = [
@@ -245,6 +433,9 @@ def docker_run(image, script, cwd='/omi', env=None, interactive=False, shell=Non
         '-v', '%s:/omi%s' % (OMI_REPO, volume_type),
     ]
 
+    for host_path, container_path in (volumes or {}).items():
+        docker_args.extend(['-v', '%s:%s%s' % (host_path, container_path, volume_type)])
+
     if interactive:
         docker_args.append('-it')
 
@@ -315,6 +506,34 @@ def load_distribution_config(distribution):  # type: (str) -> Dict[str, any]
     return distro_details
 
 
+def sort_build_steps(steps):  # type: (List[BuildStep]) -> List[BuildStep]
+    """ Sorts the build steps so each one comes after the steps it requires, otherwise keeping the original order.
+
+    Requiring a step that isn't in the list, like an optional step that wasn't added, is ignored.
+    """
+    keys = [s.key for s in steps]
+    if len(set(keys)) != len(keys):
+        raise ValueError("Build step keys must be unique: '%s'" % "', '".join(keys))
+
+    sorted_steps = []
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        for step in remaining:
+            if all(r in done or r not in keys for r in (step.requires or [])):
+                break
+
+        else:
+            raise ValueError("Build steps have a circular dependency: '%s'"
+                             % "', '".join(s.key for s in remaining))
+
+        remaining.remove(step)
+        sorted_steps.append(step)
+        done.add(step.key)
+
+    return sorted_steps
+
+
 def select_distribution(args):
     """ Selects the distribution from the args or prompts the user. """
     valid_distributions = sorted(complete_distribution())
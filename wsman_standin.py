@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+
+# Copyright: (c) 2020, Jordan Borean (@jborean93) <jborean93@gmail.com>
+# MIT License (see LICENSE or https://opensource.org/licenses/MIT)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import os.path
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+    import http.client as httplib
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+    import httplib
+
+from utils import (
+    argcomplete,
+)
+
+
+ENUMERATE_ACTION = 'http://schemas.xmlsoap.org/ws/2004/09/enumeration/Enumerate'
+PULL_ACTION = 'http://schemas.xmlsoap.org/ws/2004/09/enumeration/Pull'
+
+SOAP_CONTENT_TYPE = 'application/soap+xml;charset=UTF-8'
+
+FAULT_TEMPLATE = u'''<?xml version="1.0" encoding="UTF-8"?>
+<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:w="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd">
+<s:Header>
+<a:Action>http://schemas.dmtf.org/wbem/wsman/1/wsman/fault</a:Action>
+<a:MessageID>uuid:{message_id}</a:MessageID>
+<a:RelatesTo>{relates_to}</a:RelatesTo>
+</s:Header>
+<s:Body>
+<s:Fault>
+<s:Code><s:Value>s:Sender</s:Value><s:Subcode><s:Value>{subcode}</s:Value></s:Subcode></s:Code>
+<s:Reason><s:Text xml:lang="en-US">{reason}</s:Text></s:Reason>
+</s:Fault>
+</s:Body>
+</s:Envelope>'''
+
+
+def main():
+    """Main program body."""
+    args = parse_args()
+    store = RecordingStore(args.recordings)
+
+    if args.mode == 'record':
+        handler = RecordHandler
+        target = urlparse(args.target)
+        if target.scheme not in ['http', 'https']:
+            raise ValueError("Unsupported --target scheme '%s', must be http or https" % target.scheme)
+
+    else:
+        handler = ReplayHandler
+        if not store.entries:
+            raise ValueError("No recordings found in '%s', run this script in record mode first" % args.recordings)
+
+    server = StandInServer((args.listen, args.port), handler, store, args)
+    scheme = 'http'
+    if args.certificate:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(args.certificate, args.key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+
+    if args.mode == 'record' and scheme == 'http':
+        # The client only leaves NTLM/Kerberos messages unencrypted when it connects to the proxy over https.
+        print("WARNING: Recording on an http listener only works with Basic auth, clients encrypt NTLM/Kerberos "
+              "messages over http so they cannot be recorded. Set --certificate/--key and connect over https.")
+
+    print("Running in %s mode on %s://%s:%d/wsman with %d recorded responses"
+          % (args.mode, scheme, args.listen, args.port, len(store.entries)))
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+
+    print("Handled %d requests" % server.request_count)
+
+
+def get_element(xml, name):  # type: (str, str) -> Optional[str]
+    """ Gets the text of the first element with the local name specified. """
+    match = re.search(r'<(?:[\w\-]+:)?%s\b[^>]*>([^<]*)</' % name, xml)
+    return match.group(1).strip() if match else None
+
+
+def set_element(xml, name, value):  # type: (str, str, str) -> str
+    """ Replaces the text of every element with the local name specified. """
+    return re.sub(r'(<(?:[\w\-]+:)?%s\b[^>]*>)[^<]*(</)' % name,
+                  lambda m: m.group(1) + value + m.group(2), xml)
+
+
+def multiply_items(xml, count):  # type: (str, int) -> str
+    """ Repeats the children of an enumeration Items element to scale up the payload size. """
+    if count < 2:
+        return xml
+
+    return re.sub(r'(<([\w\-]+:)?Items\b[^>]*>)(.*?)(</\2Items>)',
+                  lambda m: m.group(1) + m.group(3) * count + m.group(4), xml, flags=re.DOTALL)
+
+
+def decode_body(body, content_type):  # type: (bytes, str) -> str
+    """ Decodes a SOAP payload based on the charset of the Content-Type or BOM. """
+    match = re.search(r'charset=["\']?([\w\-]+)', content_type or '', re.IGNORECASE)
+    encoding = match.group(1) if match else 'utf-8'
+    if body.startswith(b'\xff\xfe') or body.startswith(b'\xfe\xff'):
+        encoding = 'utf-16'
+
+    text = body.decode(encoding)
+    if text.startswith(u'\ufeff'):
+        text = text[1:]
+
+    # Recordings are always stored and replayed as UTF-8.
+    return re.sub(r'^(<\?xml[^>]*encoding=["\'])[^"\']+', r'\g<1>UTF-8', text)
+
+
+class RecordingStore:
+
+    def __init__(self, path):  # type: (str) -> None
+        """ A directory of recorded responses described by an index.json file. """
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.entries = []
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, mode='r') as fd:
+                self.entries = json.load(fd)
+
+    def add(self, entry, body):  # type: (Dict[str, any], str) -> None
+        """ Saves a recorded response body and adds its entry to the index. """
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            entry['file'] = '%04d-%s.xml' % (len(self.entries), entry['action'].split('/')[-1])
+            with open(os.path.join(self.path, entry['file']), mode='wb') as fd:
+                fd.write(body.encode('utf-8'))
+
+            self.entries.append(entry)
+            with open(self.index_path, mode='w') as fd:
+                json.dump(self.entries, fd, indent=2, sort_keys=True)
+
+    def load(self, entry):  # type: (Dict[str, any]) -> str
+        """ Loads the response body of a recorded entry. """
+        with open(os.path.join(self.path, entry['file']), mode='rb') as fd:
+            return fd.read().decode('utf-8')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, handler, store, args):
+        """ The WS-Man stand-in server, holds the state shared by each connection handler. """
+        HTTPServer.__init__(self, address, handler)
+        self.store = store
+        self.args = args
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+        # Record mode, maps a live enumeration context to the index of the Enumerate entry that started it.
+        self.sequences = {}
+
+        # Replay mode, responses grouped by (action, resource_uri) and the Pull responses of each enumeration.
+        self.responses = {}
+        self.pulls = {}
+        self.cursors = {}
+        self.enumerations = {}
+
+        for entry in store.entries:
+            if entry['action'] == PULL_ACTION:
+                self.pulls.setdefault(entry.get('sequence'), []).append(entry)
+
+            else:
+                self.responses.setdefault((entry['action'], entry['resource_uri']), []).append(entry)
+
+    def next_response(self, action, resource_uri):  # type: (str, str) -> Optional[Dict[str, any]]
+        """ Selects the next recorded response for a request, cycling through each one recorded. """
+        key = (action, resource_uri)
+        if key not in self.responses:
+            # Fall back to any recording of the action, e.g. the same method invoked on another resource.
+            key = next((k for k in self.responses if k[0] == action), None)
+            if not key:
+                return
+
+        with self.lock:
+            entries = self.responses[key]
+            cursor = self.cursors.get(key, 0)
+            self.cursors[key] = cursor + 1
+
+        return entries[cursor % len(entries)]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self._read_body()
+        with self.server.lock:
+            self.server.request_count += 1
+
+        # Each mode implements handle_soap with the raw request body.
+        self.handle_soap(body, self.headers.get('Content-Type', ''))
+
+    def log_message(self, format, *args):
+        if self.server.args.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _read_body(self):  # type: () -> bytes
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        body = b''
+        while True:
+            length = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            chunk = self.rfile.read(length + 2)
+            if not length:
+                return body
+
+            body += chunk[:-2]
+
+    def _send(self, status, body, content_type=SOAP_CONTENT_TYPE, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RecordHandler(StandInHandler):
+
+    upstream = None
+
+    def handle_soap(self, body, content_type):  # type: (bytes, str) -> None
+        """ Forwards the request to the target and records the SOAP response. """
+        # Forward every request as is so connection based auth like NTLM continues to work through the proxy.
+        status, headers, response = self._forward(body)
+        self._send(status, response, headers.get('content-type', SOAP_CONTENT_TYPE),
+                   headers=dict((k, v) for k, v in headers.items() if k == 'www-authenticate'))
+
+        response_type = headers.get('content-type', '')
+        if not response or not body or 'soap+xml' not in response_type or 'soap+xml' not in content_type:
+            return
+
+        request = decode_body(body, content_type)
+        self.record(request, status, decode_body(response, response_type))
+
+    def record(self, request, status, response):  # type: (str, int, str) -> None
+        """ Adds the response to the store, tracking which Enumerate started each Pull sequence. """
+        action = get_element(request, 'Action')
+        entry = {
+            'action': action,
+            'resource_uri': get_element(request, 'ResourceURI'),
+            'status': status,
+            'sequence': None,
+        }
+
+        with self.server.lock:
+            if action == PULL_ACTION:
+                entry['sequence'] = self.server.sequences.pop(get_element(request, 'EnumerationContext'), None)
+
+            elif action == ENUMERATE_ACTION:
+                entry['sequence'] = len(self.server.store.entries)
+
+            self.server.store.add(entry, response)
+
+            context = get_element(response, 'EnumerationContext')
+            if context and entry['sequence'] is not None and get_element(response, 'EndOfSequence') is None:
+                self.server.sequences[context] = entry['sequence']
+
+        if self.server.args.verbose:
+            print("Recorded %s for %s" % (entry['file'], entry['resource_uri']))
+
+    def _forward(self, body):  # type: (bytes) -> Tuple[int, Dict[str, str], bytes]
+        target = urlparse(self.server.args.target)
+        if not self.upstream:
+            if target.scheme == 'https':
+                context = ssl.create_default_context()
+                if self.server.args.no_verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+
+                self.upstream = httplib.HTTPSConnection(target.hostname, target.port or 5986, context=context)
+
+            else:
+                self.upstream = httplib.HTTPConnection(target.hostname, target.port or 5985)
+
+        headers = dict((k, v) for k, v in self.headers.items()
+                       if k.lower() not in ['host', 'connection', 'transfer-encoding', 'content-length'])
+        self.upstream.request('POST', target.path or '/wsman', body=body, headers=headers)
+        response = self.upstream.getresponse()
+
+        return response.status, dict((k.lower(), v) for k, v in response.getheaders()), response.read()
+
+
+class ReplayHandler(StandInHandler):
+
+    def handle_soap(self, body, content_type):  # type: (bytes, str) -> None
+        """ Replies with a recorded response with the addressing headers adjusted to match the request. """
+        if content_type.startswith('multipart/encrypted'):
+            self._send(400, b'', 'text/plain')
+            return
+
+        if not self._authenticate():
+            return
+
+        request = decode_body(body, content_type)
+        server = self.server
+        action = get_element(request, 'Action')
+        resource_uri = get_element(request, 'ResourceURI')
+        message_id = get_element(request, 'MessageID') or ''
+
+        context = None
+        if action == PULL_ACTION:
+            context = get_element(request, 'EnumerationContext')
+            with server.lock:
+                state = server.enumerations.get(context)
+                pulls = server.pulls.get(state['sequence'], []) if state else []
+                if pulls:
+                    entry = pulls[min(state['position'], len(pulls) - 1)]
+                    state['position'] += 1
+
+            if not pulls:
+                self._fault(message_id, 'w:InvalidEnumerationContext',
+                            'The enumeration context supplied in the message is not valid.')
+                return
+
+        else:
+            entry = server.next_response(action, resource_uri)
+            if not entry:
+                self._fault(message_id, 'w:ActionNotSupported',
+                            'No recorded response for %s on %s.' % (action, resource_uri))
+                return
+
+            if action == ENUMERATE_ACTION:
+                context = 'uuid:%s' % str(uuid.uuid4()).upper()
+                with server.lock:
+                    server.enumerations[context] = {'sequence': entry['sequence'], 'position': 0}
+
+        response = server.store.load(entry)
+        response = set_element(response, 'MessageID', 'uuid:%s' % str(uuid.uuid4()).upper())
+        response = set_element(response, 'RelatesTo', message_id)
+        response = multiply_items(response, server.args.item_multiplier)
+
+        if context:
+            if get_element(response, 'EndOfSequence') is None:
+                response = set_element(response, 'EnumerationContext', context)
+
+            else:
+                with server.lock:
+                    server.enumerations.pop(context, None)
+
+        delay = server.args.latency + random.uniform(0, server.args.jitter)
+        if delay:
+            time.sleep(delay / 1000)
+
+        self._send(entry['status'], response.encode('utf-8'))
+
+    def _authenticate(self):  # type: () -> bool
+        # Any Basic credentials are accepted, the client only needs to send something.
+        if self.headers.get('Authorization', '').startswith('Basic '):
+            return True
+
+        self._send(401, b'', 'text/plain', headers={'WWW-Authenticate': 'Basic realm="WSMAN"'})
+        return False
+
+    def _fault(self, message_id, subcode, reason):  # type: (str, str, str) -> None
+        fault = FAULT_TEMPLATE.format(message_id=str(uuid.uuid4()).upper(), relates_to=message_id,
+                                      subcode=subcode, reason=reason)
+        self._send(500, fault.encode('utf-8'))
+
+
+def parse_args():
+    """Parse and return args."""
+    parser = argparse.ArgumentParser(description='Run a local WS-Man stand-in that records or replays SOAP '
+                                                 'responses for client load tests.')
+
+    parser.add_argument('mode',
+                        choices=['record', 'replay'],
+                        help='Record responses from --target or replay the responses already recorded.')
+
+    parser.add_argument('recordings',
+                        help='The directory that stores the recorded responses.')
+
+    parser.add_argument('--listen',
+                        dest='listen',
+                        default='127.0.0.1',
+                        help='The address to listen on (default: 127.0.0.1).')
+
+    parser.add_argument('--port',
+                        dest='port',
+                        type=int,
+                        default=5985,
+                        help='The port to listen on (default: 5985).')
+
+    parser.add_argument('--certificate',
+                        dest='certificate',
+                        help='Serve over HTTPS with this PEM certificate.')
+
+    parser.add_argument('--key',
+                        dest='key',
+                        help='The PEM key for --certificate if not included in the certificate file.')
+
+    parser.add_argument('--target',
+                        dest='target',
+                        help='The WS-Man endpoint to record from, e.g. https://server:5986/wsman.')
+
+    parser.add_argument('--no-verify',
+                        dest='no_verify',
+                        action='store_true',
+                        help='Do not verify the --target HTTPS certificate.')
+
+    parser.add_argument('--latency',
+                        dest='latency',
+                        type=float,
+                        default=0,
+                        help='Milliseconds to wait before sending each replayed response.')
+
+    parser.add_argument('--jitter',
+                        dest='jitter',
+                        type=float,
+                        default=0,
+                        help='Add a random delay of up to this many milliseconds to --latency.')
+
+    parser.add_argument('--item-multiplier',
+                        dest='item_multiplier',
+                        type=int,
+                        default=1,
+                        help='Repeat the items in each replayed Enumerate/Pull response to scale the payload size.')
+
+    parser.add_argument('--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        help='Log each request that is handled.')
+
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+
+    if args.mode == 'record' and not args.target:
+        parser.error('argument --target: must be set when recording')
+
+    if args.key and not args.certificate:
+        parser.error('argument --key: must be set with argument --certificate')
+
+    return args
+
+
+if __name__ == '__main__':
+    main()